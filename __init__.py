@@ -10,6 +10,8 @@ from . import party
 from . import sale
 from . import invoice
 from . import project
+from . import email_queue
+from . import ir
 
 
 def register():
@@ -23,11 +25,16 @@ def register():
         galatea.GalateaUser,
         galatea.GalateaUserWebSite,
         galatea.GalateaRemoveCacheStart,
+        galatea.GalateaRemoveCacheResult,
         galatea.GalateaSendPasswordStart,
         galatea.GalateaSendPasswordResult,
         static_file.GalateaStaticFolder,
         static_file.GalateaStaticFile,
+        static_file.GalateaStaticFileImportStart,
+        static_file.GalateaStaticFileImportResult,
         party.Party,
+        email_queue.GalateaEmailQueue,
+        ir.Cron,
         module='galatea', type_='model')
     Pool.register(
         sale.Sale,
@@ -44,5 +51,6 @@ def register():
     Pool.register(
         galatea.GalateaRemoveCache,
         galatea.GalateaSendPassword,
+        static_file.GalateaStaticFileImport,
         party.PartyReplace,
         module='galatea', type_='wizard')
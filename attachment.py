@@ -1,10 +1,30 @@
 # This file is part galatea module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+import mimetypes
+import os
+import shutil
+
+from sql import Cast, Literal, Union
+from sql.operators import Concat
+
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
+from trytond.transaction import Transaction
+from .tools import IMAGE_TYPES
+from . import thumbnail
+from .zip_stream import iter_zip, unique_name
 
-__all__ = ['Attachment']
+__all__ = ['Attachment', 'GalateaPartyResourceMixin']
+
+# Image type: derivative format keeping the type
+DERIVATIVE_FORMATS = {
+    'image/jpeg': 'jpeg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    }
 
 
 class Attachment(metaclass=PoolMeta):
@@ -14,3 +34,256 @@ class Attachment(metaclass=PoolMeta):
         help='Allow attachment to login users')
     galatea_party = fields.Boolean('Galatea Party',
         help='Allow attachment to party (login user)')
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Attachment, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        table.index_action(['resource', 'galatea_party', 'allow_galatea'],
+            'add')
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_evict = []
+        for attachments, values in zip(actions, actions):
+            if {'data', 'file_id', 'type', 'link'} & set(values):
+                to_evict.extend(attachments)
+        super(Attachment, cls).write(*args)
+        cls.evict_galatea_derivatives(to_evict)
+
+    @classmethod
+    def delete(cls, attachments):
+        ids = [a.id for a in attachments]
+        super(Attachment, cls).delete(attachments)
+        cls.evict_galatea_derivatives(cls.browse(ids))
+
+    @staticmethod
+    def get_galatea_derivative_sizes():
+        '''
+        Return the widths of the derivatives, configured by
+        galatea/attachment_sizes (comma separated)
+        '''
+        sizes = config.get('galatea', 'attachment_sizes',
+            default='150,300,600,1200')
+        return sorted(int(s) for s in sizes.split(',') if s.strip())
+
+    @classmethod
+    def get_galatea_derivative_directory(cls, attachment_id=None):
+        '''
+        Return the directory of the derivatives of the attachment or of all
+        the attachments:
+        <galatea base path>/.attachment-cache/<attachment id>
+        '''
+        StaticFile = Pool().get('galatea.static.file')
+        path = os.path.join(StaticFile.get_galatea_base_path(),
+            '.attachment-cache')
+        if attachment_id is not None:
+            path = os.path.join(path, str(attachment_id))
+        return path
+
+    @property
+    def galatea_image_type(self):
+        "The image type of the attachment data or None"
+        if self.type != 'data' or not self.name:
+            return
+        type_, _ = mimetypes.guess_type(self.name)
+        if type_ in IMAGE_TYPES:
+            return type_
+
+    def is_galatea_allowed(self, user=None):
+        '''
+        Return True if the attachment can be shown to the Galatea user (a
+        galatea.user or its SessionUser) or to anonymous visitors (None):
+        the party attachments only to the party of their resource and the
+        session attachments only to the login users.
+        '''
+        if not self.allow_galatea:
+            return False
+        if self.galatea_party:
+            party = getattr(self.resource, 'party', None)
+            return (user is not None and party is not None
+                and int(party) == int(user.party))
+        if self.galatea_session:
+            return user is not None
+        return True
+
+    def get_galatea_derivative(self, width, format_=None, crop=False,
+            user=None):
+        '''
+        Return the path of a derivative of the image no wider (nor higher)
+        than width or None if the attachment is not a Galatea image allowed
+        to user (see is_galatea_allowed).
+
+        The width is rounded up to the nearest configured size (the biggest
+        by default) so the number of derivatives is bounded. The
+        derivatives are cached on disk by attachment id, content checksum
+        and parameters.
+
+        :param width: the requested width in pixels
+        :param format_: jpeg, png, webp or gif (the image format by default)
+        :param crop: crop the image to a square
+        :param user: the login user or None
+        '''
+        image_type = self.galatea_image_type
+        if not image_type or not self.is_galatea_allowed(user):
+            return
+        format_ = format_ or DERIVATIVE_FORMATS[image_type]
+        if format_ not in thumbnail.FORMATS:
+            return
+        sizes = self.get_galatea_derivative_sizes()
+        if not sizes:
+            # The derivatives are disabled
+            return
+        size = next((s for s in sizes if s >= width), sizes[-1])
+
+        if self.file_id:
+            key = self.file_id
+        else:
+            date = self.write_date or self.create_date
+            key = '%x' % int(date.timestamp() * 1000000)
+        directory = self.get_galatea_derivative_directory(self.id)
+        path = os.path.join(directory,
+            thumbnail.thumbnail_name(key, size, format_, crop))
+        if os.path.exists(path):
+            return path
+        if not self.data:
+            return
+        paths = thumbnail.generate(self.data, directory, [size],
+            formats=(format_,), crop=crop, key=key)
+        if paths:
+            return paths[(size, format_)]
+
+    @staticmethod
+    def _galatea_party_models():
+        "Return the models whose attachments are shown to their party"
+        return ['account.invoice', 'sale.sale', 'project.work']
+
+    @classmethod
+    def search_galatea_party(cls, party, limit=20, after=None, models=None):
+        '''
+        Return a page of the attachments allowed to Galatea and to the party
+        of the invoices, sales and works of party, the newest first.
+        All the resources are searched by a single query and the pages are
+        paginated by key: after is the key returned with the previous page.
+
+        :param models: the resource models, all by default
+        :return: a tuple (attachments, key of the next page or None)
+        '''
+        pool = Pool()
+        attachment = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        resources = []
+        for name in models or cls._galatea_party_models():
+            try:
+                Model = pool.get(name)
+            except KeyError:
+                # The module of the model is not activated
+                continue
+            resources.append(Model.get_galatea_party_resources(party))
+        if not resources:
+            return [], None
+        elif len(resources) == 1:
+            resources, = resources
+        else:
+            resources = Union(*resources, all_=True)
+
+        where = (attachment.resource.in_(resources)
+            & (attachment.allow_galatea == Literal(True))
+            & (attachment.galatea_party == Literal(True)))
+        if after:
+            where &= attachment.id < after
+        cursor.execute(*attachment.select(attachment.id,
+                where=where, order_by=attachment.id.desc, limit=limit))
+        ids = [i for i, in cursor]
+        return cls.browse(ids), ids[-1] if len(ids) == limit else None
+
+    def iter_galatea_data(self, chunk_size=64 * 1024):
+        '''
+        Yield the data of the attachment in chunks, read from the filestore
+        when it is stored there so only one attachment is loaded at a time
+        '''
+        if self.type != 'data':
+            return
+        if self.file_id:
+            prefix = self._fields['data'].store_prefix
+            if prefix is None:
+                prefix = Transaction().database.name
+            data = filestore.get(self.file_id, prefix=prefix)
+        else:
+            data = self.data
+        if not data:
+            return
+        data = memoryview(data)
+        for i in range(0, len(data), chunk_size):
+            yield bytes(data[i:i + chunk_size])
+
+    @classmethod
+    def iter_galatea_party_zip(cls, party,
+            models=('account.invoice', 'sale.sale')):
+        '''
+        Yield the bytes of a zip archive of the attachments allowed to
+        Galatea and to the party of the invoices and sales of party.
+
+        The archive is built as it is consumed, in bounded memory: the
+        attachments are searched by pages, each file is read from the
+        filestore and written in a directory named by its resource.
+        The generator must be consumed inside the transaction.
+        '''
+        pool = Pool()
+
+        def get_rec_names(attachments):
+            "Return the rec_name of the resources of the attachments"
+            ids = {}
+            for attachment in attachments:
+                resource = attachment.resource
+                ids.setdefault(resource.__name__, set()).add(resource.id)
+            rec_names = {}
+            for model, model_ids in ids.items():
+                Model = pool.get(model)
+                for record in Model.read(list(model_ids), ['rec_name']):
+                    rec_names[(model, record['id'])] = record['rec_name']
+            return rec_names
+
+        def members():
+            names = set()
+            after = None
+            while True:
+                attachments, after = cls.search_galatea_party(party,
+                    limit=100, after=after, models=models)
+                attachments = [a for a in attachments if a.type == 'data']
+                rec_names = get_rec_names(attachments)
+                for attachment in attachments:
+                    resource = attachment.resource
+                    key = (resource.__name__, resource.id)
+                    directory = (rec_names.get(key) or '%s-%s' % key
+                        ).replace('/', '-')
+                    name = unique_name('%s/%s' % (directory,
+                            attachment.name.replace('/', '-')), names)
+                    yield (name, attachment.create_date,
+                        attachment.data_size, attachment.iter_galatea_data())
+                if not after:
+                    break
+
+        return iter_zip(members())
+
+    @classmethod
+    def evict_galatea_derivatives(cls, attachments):
+        "Remove the cached derivatives of the attachments"
+        for attachment in attachments:
+            shutil.rmtree(cls.get_galatea_derivative_directory(attachment.id),
+                ignore_errors=True)
+
+
+class GalateaPartyResourceMixin(object):
+    "Resource whose Galatea attachments are shown to its party"
+
+    @classmethod
+    def get_galatea_party_resources(cls, party):
+        "Return the query of the resource values of the records of party"
+        table = cls.__table__()
+        return table.select(
+            Concat(cls.__name__ + ',', Cast(table.id, 'VARCHAR')),
+            where=table.party == int(party))
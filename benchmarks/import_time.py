@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Measure the import time of the galatea modules with python -X importtime.
+
+Trytond is imported first so only the cost of galatea is reported. It exits
+with an error when a lazily imported dependency is loaded at import time or
+when the galatea import takes more than --max-ms milliseconds.
+
+    python benchmarks/import_time.py [--runs 5] [--max-ms 50] [--top 15]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Dependencies which must only be imported on first use
+LAZY = ['PIL', 'flask_login', 'pytz', 'zoneinfo', 'smtplib', 'redis',
+    'argon2', 'email.mime.text', 'multiprocessing', 'pickle',
+    'concurrent.futures.process', 'tarfile', 'mmap']
+PRELOAD = 'import trytond.model, trytond.wizard, trytond.pool'
+MODULE = 'trytond.modules.galatea'
+MARKER = '-- galatea --'
+
+
+def importtime():
+    "Return a dictionary of module: (self us, cumulative us)"
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            '%s; import sys; sys.stderr.write(%r); sys.stderr.flush(); '
+            'import %s' % (PRELOAD, MARKER + '\n', MODULE)],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True)
+    times = {}
+    lines = process.stderr.splitlines()
+    # The modules imported by PRELOAD are listed before the marker
+    for line in lines[lines.index(MARKER) + 1:]:
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        name = name.strip()
+        times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=None)
+    parser.add_argument('--top', type=int, default=15)
+    options = parser.parse_args()
+
+    runs = [importtime() for _ in range(options.runs)]
+    total = statistics.median(r[MODULE][1] for r in runs) / 1000
+    last = runs[-1]
+    print('%s: %.1f ms (median of %s runs)' % (MODULE, total, options.runs))
+    print()
+    print('%-50s %10s %10s' % ('module', 'self ms', 'cumul. ms'))
+    for name, (self_us, cumulative_us) in sorted(last.items(),
+            key=lambda i: i[1][0], reverse=True)[:options.top]:
+        print('%-50s %10.1f %10.1f' % (name, self_us / 1000,
+                cumulative_us / 1000))
+
+    errors = []
+    for name in LAZY:
+        if name in last:
+            errors.append('%s is imported at import time' % name)
+    if options.max_ms is not None and total > options.max_ms:
+        errors.append('import takes %.1f ms, more than %s ms'
+            % (total, options.max_ms))
+    if errors:
+        print()
+        for error in errors:
+            print('ERROR: %s' % error)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Report the logins/second that the galatea password hashers can verify for
+several cost settings, serially and through the password thread pool.
+
+    python benchmarks/password_hashing.py [--seconds 2] [--threads 4]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.modules.galatea.password import get_hasher, argon2
+
+SETTINGS = [
+    ('pbkdf2_sha256', {'iterations': 100000}),
+    ('pbkdf2_sha256', {'iterations': 200000}),
+    ('pbkdf2_sha256', {'iterations': 600000}),
+    ('scrypt', {'n': 2 ** 14, 'r': 8, 'p': 1}),
+    ('scrypt', {'n': 2 ** 15, 'r': 8, 'p': 1}),
+    ('argon2', {'time_cost': 2, 'memory_cost': 65536, 'parallelism': 1}),
+    ('argon2', {'time_cost': 3, 'memory_cost': 65536, 'parallelism': 1}),
+    ]
+
+
+def run(hasher, hashed, seconds, threads):
+    password = 'benchmark-password'
+    count = 0
+    start = time.perf_counter()
+    if threads <= 1:
+        while time.perf_counter() - start < seconds:
+            hasher.verify(password, hashed)
+            count += 1
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while time.perf_counter() - start < seconds:
+                futures = [executor.submit(hasher.verify, password, hashed)
+                    for _ in range(threads)]
+                for future in futures:
+                    future.result()
+                count += threads
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    options = parser.parse_args()
+
+    print('%-15s %-40s %12s %12s' % ('hasher', 'parameters', 'logins/s',
+            'logins/s (%d threads)' % options.threads))
+    for name, params in SETTINGS:
+        if name == 'argon2' and argon2 is None:
+            continue
+        hasher = get_hasher(name, **params)
+        hashed = hasher.hash('benchmark-password')
+        serial = run(hasher, hashed, options.seconds, 1)
+        parallel = run(hasher, hashed, options.seconds, options.threads)
+        print('%-15s %-40s %12.1f %12.1f' % (name,
+                ', '.join('%s=%s' % i for i in sorted(params.items())),
+                serial, parallel))
+
+
+if __name__ == '__main__':
+    main()
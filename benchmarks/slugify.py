@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Compare the slug engine of tools with the slug package based functions it
+replaces (when the slug package is installed).
+
+    python benchmarks/slugify.py [--names 10000] [--distinct 1000]
+"""
+import argparse
+import random
+import time
+
+from trytond.modules.galatea import tools
+
+try:
+    import slug
+except ImportError:
+    slug = None
+
+WORDS = ['Café', 'Straße', 'Informe', 'año', 'Œuvre', 'Łódź', 'photo',
+    'DSC', 'final', 'v2', 'Résumé', 'naïve', 'ÆON', 'product', 'image']
+EXTENSIONS = ['jpg', 'png', 'pdf', 'tar.gz', 'css', 'js']
+
+
+def make_names(count, distinct):
+    names = ['%s %s_%s.%s' % (random.choice(WORDS), random.choice(WORDS),
+            i, random.choice(EXTENSIONS)) for i in range(distinct)]
+    return [random.choice(names) for _ in range(count)]
+
+
+def slug_slugify_file(value):
+    "The slug package based slugify_file of previous versions"
+    fname = value.lower().split('.')
+    if len(fname) > 1:
+        return '%s.%s' % (slug.slug(fname[0]), fname[1])
+    return slug.slug(value)
+
+
+def report(name, count, start):
+    elapsed = time.perf_counter() - start
+    print('%-40s %8.3fs %12.0f names/s' % (name, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--names', type=int, default=10000)
+    parser.add_argument('--distinct', type=int, default=1000)
+    options = parser.parse_args()
+
+    names = make_names(options.names, options.distinct)
+
+    if slug is not None:
+        start = time.perf_counter()
+        for name in names:
+            slug_slugify_file(name)
+        report('slug package', len(names), start)
+    else:
+        print('slug package not installed, skipping it')
+
+    tools.slugify.cache_clear()
+    tools.slugify_file.cache_clear()
+    start = time.perf_counter()
+    for name in names:
+        tools.slugify_file.__wrapped__(name)
+    report('slugify_file (no memo)', len(names), start)
+
+    start = time.perf_counter()
+    for name in names:
+        tools.slugify_file(name)
+    report('slugify_file (memo)', len(names), start)
+
+    tools.slugify.cache_clear()
+    tools.slugify_file.cache_clear()
+    start = time.perf_counter()
+    tools.slugify_files(names)
+    report('slugify_files (batch)', len(names), start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Compare the throughput of one tools.thumbly call per size with one
+thumbnail.generate call for all the sizes.
+
+    python benchmarks/thumbnails.py [--images 20] [--workers 4]
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+from trytond.modules.galatea.tools import thumbly
+from trytond.modules.galatea.thumbnail import generate, generate_batch
+
+SIZES = [1200, 600, 300]
+
+
+def make_images(count, width=3000, height=2000):
+    images = []
+    for i in range(count):
+        image = Image.effect_mandelbrot((width, height),
+            (-2 + i * 0.01, -1.5, 1, 1.5), 100).convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def report(name, count, start):
+    elapsed = time.perf_counter() - start
+    print('%-40s %8.2fs %10.1f images/s' % (name, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    images = make_images(options.images)
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        for i, data in enumerate(images):
+            for size in SIZES:
+                thumbly(directory, os.path.join(directory,
+                        'thumbly-%s-%s.jpg' % (i, size)), data, size=size)
+        report('thumbly (one call per size)', len(images), start)
+
+        start = time.perf_counter()
+        for data in images:
+            generate(data, os.path.join(directory, 'engine'), SIZES)
+        report('generate (jpeg, cold cache)', len(images), start)
+
+        start = time.perf_counter()
+        for data in images:
+            generate(data, os.path.join(directory, 'engine'), SIZES)
+        report('generate (jpeg, warm cache)', len(images), start)
+
+        start = time.perf_counter()
+        for data in images:
+            generate(data, os.path.join(directory, 'webp'), SIZES,
+                formats=('jpeg', 'webp'))
+        report('generate (jpeg + webp, cold cache)', len(images), start)
+
+        start = time.perf_counter()
+        generate_batch([{
+                    'data': data,
+                    'directory': os.path.join(directory, 'batch'),
+                    'sizes': SIZES,
+                    } for data in images], workers=options.workers)
+        report('generate_batch (%s processes)' % options.workers,
+            len(images), start)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['purge', 'evict', 'purge_in_background']
+
+logger = logging.getLogger(__name__)
+
+
+def _scan(directory, recursive=True):
+    "Yield the DirEntry of all the files under directory"
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    else:
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+def _remove_empty_dirs(directory, keep=None):
+    for root, dirs, files in os.walk(directory, topdown=False):
+        if root != keep and not os.listdir(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+
+def _purge_directory(path, root, recursive, prefix, before, sources):
+    files = size = 0
+    for entry in _scan(path, recursive=recursive):
+        if prefix and not os.path.relpath(entry.path, root).startswith(
+                prefix):
+            continue
+        if sources and not sources.match(entry.name):
+            continue
+        try:
+            stat = entry.stat(follow_symlinks=False)
+            if before is not None and stat.st_mtime >= before:
+                continue
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+        files += 1
+        size += stat.st_size
+    if recursive:
+        _remove_empty_dirs(path, keep=root)
+    return files, size
+
+
+def purge(directories, prefix=None, older_than=None, sources=None,
+        workers=None):
+    '''
+    Remove the cached files of directories in parallel.
+
+    :param directories: the cache directories
+    :param prefix: only remove files whose path relative to the cache
+        directory starts with prefix
+    :param older_than: only remove files modified more than older_than
+        seconds ago
+    :param sources: only remove files derived from these source file names
+        (cached file names start with the source name without extension, a
+        dash, 16 hexadecimal digits and a dash like the thumbnail.generate
+        derivatives of source)
+    :param workers: the number of threads
+    :return: a tuple (number of files, bytes) removed
+    '''
+    before = time.time() - older_than if older_than is not None else None
+    if sources:
+        sources = re.compile(r'^(?:%s)-[0-9a-f]{16}-' % '|'.join(
+                re.escape(os.path.splitext(s)[0]) for s in sources))
+    # Each first level subdirectory is purged by its own task so large
+    # caches are removed by several threads
+    tasks = []
+    for directory in directories:
+        tasks.append((directory, directory, False))
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    tasks.append((entry.path, directory, True))
+
+    def run(task):
+        path, root, recursive = task
+        return _purge_directory(path, root, recursive, prefix, before,
+            sources)
+
+    if workers is None:
+        workers = min(len(tasks), (os.cpu_count() or 1) * 4)
+    files = size = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for task_files, task_size in executor.map(run, tasks):
+            files += task_files
+            size += task_size
+    logger.info('Purged %s files (%s bytes) from %s', files, size,
+        ', '.join(directories))
+    return files, size
+
+
+def evict(directory, max_bytes):
+    '''
+    Remove the least recently used files of directory until its size is
+    below max_bytes.
+
+    :return: a tuple (number of files, bytes) removed
+    '''
+    entries = []
+    total = 0
+    for entry in _scan(directory):
+        stat = entry.stat(follow_symlinks=False)
+        # atime is not updated on noatime mounts, mtime is the fallback
+        entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size,
+                entry.path))
+        total += stat.st_size
+    files = size = 0
+    if total <= max_bytes:
+        return files, size
+    entries.sort()
+    for _, entry_size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        total -= entry_size
+        files += 1
+        size += entry_size
+    _remove_empty_dirs(directory, keep=directory)
+    logger.info('Evicted %s files (%s bytes) from %s', files, size,
+        directory)
+    return files, size
+
+
+def purge_in_background(directories, **kwargs):
+    "Run purge in a daemon thread and return the thread"
+    thread = threading.Thread(target=purge, args=(directories,),
+        kwargs=kwargs, name='galatea-cache-purge', daemon=True)
+    thread.start()
+    return thread
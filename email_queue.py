@@ -0,0 +1,215 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import logging
+import time
+
+from sql import Null
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['GalateaEmailQueue']
+
+logger = logging.getLogger(__name__)
+
+
+class GalateaEmailQueue(ModelSQL, ModelView):
+    'Galatea Email Queue'
+    __name__ = 'galatea.email.queue'
+    smtp_server = fields.Many2One('smtp.server', 'SMTP Server',
+        required=True, ondelete='CASCADE', readonly=True)
+    from_ = fields.Char('From', required=True, readonly=True)
+    to = fields.Char('To', required=True, readonly=True,
+        help='Comma separated recipients')
+    subject = fields.Char('Subject', readonly=True)
+    message = fields.Text('Message', readonly=True,
+        help='Cleared once the email is sent as it may contain passwords')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True,
+        select=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    latency = fields.Function(fields.TimeDelta('Latency',
+            help='Time between the email is queued and it is sent'),
+        'get_latency')
+    error = fields.Text('Error', readonly=True, states={
+            'invisible': ~Eval('error'),
+            }, depends=['error'])
+
+    @classmethod
+    def __setup__(cls):
+        super(GalateaEmailQueue, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    'depends': ['state'],
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    def get_latency(self, name):
+        if self.sent_date and self.create_date:
+            return self.sent_date - self.create_date
+
+    @classmethod
+    def enqueue(cls, emails):
+        '''
+        Add emails to the queue
+
+        :param emails: a list of (smtp server, recipients, message) tuples
+        :return: the queued records
+        '''
+        from email.utils import formatdate
+        for _, _, msg in emails:
+            if 'Date' not in msg:
+                msg['Date'] = formatdate()
+        return cls.create([{
+                    'smtp_server': server.id,
+                    'from_': msg['From'],
+                    'to': ', '.join(recipients),
+                    'subject': str(msg['Subject'] or ''),
+                    'message': msg.as_string(),
+                    } for server, recipients, msg in emails])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, emails):
+        cls.write(emails, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                })
+
+    @classmethod
+    def _get_next_attempt(cls, attempts):
+        "Return when to retry an email after it failed attempts times"
+        delay = config.getint('galatea', 'email_queue_retry_delay',
+            default=60)
+        delay = min(delay * 2 ** (attempts - 1), 24 * 60 * 60)
+        return datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+    @classmethod
+    def send_all(cls):
+        '''
+        Send the pending emails in batches (cron).
+        The emails of an SMTP server are sent over a single connection and
+        at most galatea/email_queue_rate emails per second are sent to it.
+        The selected emails are locked so concurrent runs skip them.
+        '''
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        batch_size = config.getint('galatea', 'email_queue_batch',
+            default=500)
+        now = datetime.datetime.now()
+        query = table.select(table.id,
+            where=(table.state == 'pending')
+            & ((table.next_attempt == Null) | (table.next_attempt <= now)),
+            order_by=[table.smtp_server.asc, table.id.asc],
+            limit=batch_size)
+        if database.has_select_for():
+            # The emails locked by a concurrent run are left to it
+            For = database.get_select_for_skip_locked()
+            query.for_ = For('UPDATE')
+        cursor.execute(*query)
+        emails = cls.browse([i for i, in cursor])
+
+        by_server = {}
+        for email in emails:
+            by_server.setdefault(email.smtp_server, []).append(email)
+        for server, server_emails in by_server.items():
+            cls._send_server(server, server_emails)
+
+    @classmethod
+    def _send_server(cls, server, emails):
+        import smtplib
+        rate = config.getfloat('galatea', 'email_queue_rate', default=0)
+        max_attempts = config.getint('galatea', 'email_queue_attempts',
+            default=5)
+        interval = 1. / rate if rate else 0
+
+        sent, failed = [], []
+        try:
+            smtp = server.get_smtp_server()
+        except Exception as exception:
+            logger.warning('Unable to connect to "%s"', server.rec_name,
+                exc_info=True)
+            failed = [(e, str(exception)) for e in emails]
+        else:
+            last = 0
+            for email in emails:
+                if interval:
+                    wait = last + interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    last = time.monotonic()
+                recipients = [r.strip() for r in email.to.split(',')]
+                try:
+                    try:
+                        smtp.sendmail(email.from_, recipients, email.message)
+                    except smtplib.SMTPServerDisconnected:
+                        smtp = server.get_smtp_server()
+                        smtp.sendmail(email.from_, recipients, email.message)
+                except Exception as exception:
+                    logger.warning('Unable to send email %s', email.id,
+                        exc_info=True)
+                    failed.append((email, str(exception)))
+                else:
+                    sent.append(email)
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                pass
+
+        to_write = []
+        if sent:
+            to_write.extend((sent, {
+                        'state': 'sent',
+                        'sent_date': datetime.datetime.now(),
+                        'error': None,
+                        'message': None,
+                        }))
+        for email, error in failed:
+            attempts = email.attempts + 1
+            values = {
+                'attempts': attempts,
+                'error': error,
+                }
+            if attempts >= max_attempts:
+                values['state'] = 'failed'
+            else:
+                values['next_attempt'] = cls._get_next_attempt(attempts)
+            to_write.extend(([email], values))
+        if to_write:
+            cls.write(*to_write)
+        logger.info('Sent %s emails with "%s" (%s failed)', len(sent),
+            server.rec_name, len(failed))
+
+    @classmethod
+    def delete_sent(cls, days=None):
+        "Delete the sent emails older than days"
+        if days is None:
+            days = config.getint('galatea', 'email_queue_keep_days',
+                default=30)
+        date = datetime.datetime.now() - datetime.timedelta(days=days)
+        cls.delete(cls.search([
+                    ('state', '=', 'sent'),
+                    ('sent_date', '<', date),
+                    ]))
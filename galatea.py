@@ -2,32 +2,96 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.model import ModelView, ModelSQL, fields, Unique
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
-from trytond.sendmail import SMTPDataManager, sendmail_transactional
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
-from email.utils import make_msgid
-from email.header import Header
-from email.mime.text import MIMEText
-from flask_login import UserMixin
-import subprocess
-import pytz
-import random
+from collections import namedtuple
+from functools import partial
+from sql import Literal
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Lower
 import string
-import hashlib
 import os
 import secrets
+import logging
+import threading
+import time
+from . import cache_manager
+from . import sitemap
+from .sitemap import GalateaSitemapMixin
+from .tools import timezones
+from .rate_limit import (MemoryBackend, RedisBackend, RateLimiter,
+    parse_rule, parse_networks, client_ip)
+from .password import (hash_password, hash_passwords,
+    verify_password)
 
 __all__ = ['GalateaWebSite', 'GalateaWebsiteCountry', 'GalateaWebsiteLang',
     'GalateaWebsiteCurrency', 'GalateaUser', 'GalateaUserWebSite',
-    'GalateaRemoveCacheStart', 'GalateaRemoveCache',
+    'GalateaRemoveCacheStart', 'GalateaRemoveCacheResult',
+    'GalateaRemoveCache',
     'GalateaSendPasswordStart', 'GalateaSendPasswordResult',
-    'GalateaSendPassword']
+    'GalateaSendPassword', 'WebSiteSnapshot', 'SessionUser']
 
+logger = logging.getLogger(__name__)
 
-class GalateaWebSite(ModelSQL, ModelView):
+_login_limiter = None
+_login_limiter_lock = threading.Lock()
+
+# Immutable, precomputed view of a galatea.website used by the web layer.
+# Many2One values are ids, languages are codes and Many2Many are id tuples.
+WebSiteSnapshot = namedtuple('WebSiteSnapshot', [
+        'id', 'name', 'uri', 'folder', 'static_folder', 'company', 'active',
+        'registration', 'country', 'countries', 'languages', 'currency',
+        'currencies', 'timezone', 'smtp_server', 'metadescription',
+        'metakeyword', 'metatitle',
+        ])
+
+
+class SessionUser(object):
+    '''
+    Compact snapshot of a galatea.user loaded by the web layer on each
+    authenticated request. Many2One values are ids and websites is a
+    frozenset of ids. It implements the flask_login user interface.
+    '''
+    __slots__ = ('id', 'display_name', 'email', 'party', 'party_name',
+        'lang', 'company', 'manager', 'timezone', 'websites')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def __getstate__(self):
+        return {n: getattr(self, n) for n in self.__slots__}
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+    def __eq__(self, other):
+        if isinstance(other, SessionUser):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<SessionUser %s %s>' % (self.id, self.email)
+
+    def get_id(self):
+        return str(self.id)
+
+
+class GalateaWebSite(GalateaSitemapMixin, ModelSQL, ModelView):
     'Galatea Web Site'
     __name__ = "galatea.website"
     name = fields.Char('Name', required=True, select=True)
@@ -48,9 +112,7 @@ class GalateaWebSite(ModelSQL, ModelView):
     languages = fields.Many2Many('galatea.website-ir.lang',
         'website', 'language', 'Languages')
     currency = fields.Many2One('currency.currency', 'Currency', required=True)
-    timezone = fields.Selection(
-        [(x, x) for x in pytz.common_timezones], 'Timezone', translate=False
-        )
+    timezone = fields.Selection('get_timezones', 'Timezone', translate=False)
     smtp_server = fields.Many2One('smtp.server', 'SMTP Server',
         domain=[('state', '=', 'done')], required=True)
     metadescription = fields.Char('Meta Description', translate=True,
@@ -58,6 +120,8 @@ class GalateaWebSite(ModelSQL, ModelView):
             'than 155 characters of plain text')
     metakeyword = fields.Char('Meta Keyword', translate=True)
     metatitle = fields.Char('Meta Title', translate=True)
+    _snapshot_cache = Cache('galatea_website.snapshot', context=False)
+    _uri_cache = Cache('galatea_website.uri', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -69,12 +133,17 @@ class GalateaWebSite(ModelSQL, ModelView):
             ]
         cls._buttons.update({
                 'remove_cache': {},
+                'generate_sitemaps': {},
                 })
 
     @staticmethod
     def default_timezone():
         return 'UTC'
 
+    @staticmethod
+    def get_timezones():
+        return timezones()
+
     @staticmethod
     def default_active():
         return True
@@ -87,22 +156,149 @@ class GalateaWebSite(ModelSQL, ModelView):
     def default_company():
         return Transaction().context.get('company')
 
-    @staticmethod
-    def send_email(server, recipients, subject, body):
-        from_ = server.smtp_email
-        if server.smtp_use_email:
-            from_ = server.smtp_email
+    @classmethod
+    def create(cls, vlist):
+        websites = super(GalateaWebSite, cls).create(vlist)
+        cls.clear_snapshot_cache()
+        return websites
 
-        msg = MIMEText(body, _charset='utf-8')
-        msg['Subject'] = Header(subject, 'utf-8')
-        msg['From'] = from_
-        msg['To'] = ', '.join(recipients)
-        msg['Reply-to'] = server.smtp_email
-        msg['Message-ID'] = make_msgid()
+    @classmethod
+    def write(cls, *args):
+        super(GalateaWebSite, cls).write(*args)
+        cls.clear_snapshot_cache()
+        # The company of the websites filters the login users
+        Pool().get('galatea.user').clear_login_miss_cache()
 
-        datamanager = SMTPDataManager()
-        datamanager._server = server.get_smtp_server()
-        sendmail_transactional(from_, recipients, msg, datamanager=datamanager)
+    @classmethod
+    def delete(cls, websites):
+        super(GalateaWebSite, cls).delete(websites)
+        cls.clear_snapshot_cache()
+        Pool().get('galatea.user').clear_login_miss_cache()
+
+    @classmethod
+    def clear_snapshot_cache(cls):
+        "Invalidate the website snapshots in all the worker processes"
+        cls._snapshot_cache.clear()
+        cls._uri_cache.clear()
+
+    @classmethod
+    def get_snapshot(cls, website):
+        '''
+        Return the WebSiteSnapshot of a website (record or id).
+        Translated fields are resolved with the transaction language.
+        '''
+        website_id = int(website)
+        key = (website_id, Transaction().language)
+        snapshot = cls._snapshot_cache.get(key)
+        if snapshot is None:
+            snapshot = cls._build_snapshot(cls(website_id))
+            cls._snapshot_cache.set(key, snapshot)
+        return snapshot
+
+    @classmethod
+    def get_registration_websites(cls):
+        "Return the ids of the websites added to the registered users"
+        website_ids = cls._snapshot_cache.get('registration')
+        if website_ids is None:
+            website_ids = [w.id for w in cls.search([
+                        ('registration', '=', True),
+                        ])]
+            cls._snapshot_cache.set('registration', website_ids)
+        return list(website_ids)
+
+    @classmethod
+    def get_snapshot_by_uri(cls, uri):
+        "Return the WebSiteSnapshot of the website with this uri or None"
+        website_id = cls._uri_cache.get(uri)
+        if website_id is None:
+            websites = cls.search([('uri', '=', uri)], limit=1)
+            if not websites:
+                return
+            website_id = websites[0].id
+            cls._uri_cache.set(uri, website_id)
+        return cls.get_snapshot(website_id)
+
+    @classmethod
+    def _build_snapshot(cls, website):
+        WebsiteCurrency = Pool().get('galatea.website-currency.currency')
+        currencies = WebsiteCurrency.search([
+                ('website', '=', website.id),
+                ], order=[('id', 'ASC')])
+        return WebSiteSnapshot(
+            id=website.id,
+            name=website.name,
+            uri=website.uri,
+            folder=website.folder,
+            static_folder=website.static_folder,
+            company=website.company.id,
+            active=website.active,
+            registration=website.registration,
+            country=website.country.id,
+            countries=tuple(c.id for c in website.countries),
+            languages=tuple(l.code for l in website.languages),
+            currency=website.currency.id,
+            currencies=tuple(c.currency.id for c in currencies),
+            timezone=website.timezone,
+            smtp_server=website.smtp_server.id,
+            metadescription=website.metadescription,
+            metakeyword=website.metakeyword,
+            metatitle=website.metatitle,
+            )
+
+    @classmethod
+    def get_smtp_datamanager(cls, server):
+        '''
+        Return the SMTP data manager of the transaction for the server.
+        All the emails sent with the same server in a transaction share the
+        data manager and so a single SMTP connection.
+        '''
+        from trytond.sendmail import SMTPDataManager
+        datamanager = Transaction().join(
+            SMTPDataManager(uri='galatea-smtp-server:%s' % server.id))
+        if datamanager._server is None:
+            datamanager._server = server.get_smtp_server()
+        return datamanager
+
+    @classmethod
+    def send_email(cls, server, recipients, subject, body):
+        cls.send_emails([(server, recipients, subject, body)])
+
+    @classmethod
+    def send_emails(cls, emails):
+        '''
+        Send emails. They are added to the galatea email queue, unless
+        galatea/email_queue is disabled, in which case they are sent when
+        the transaction is committed.
+
+        :param emails: a list of (smtp server, recipients, subject, body)
+        '''
+        from email.header import Header
+        from email.mime.text import MIMEText
+        from email.utils import make_msgid
+        EmailQueue = Pool().get('galatea.email.queue')
+
+        messages = []
+        for server, recipients, subject, body in emails:
+            from_ = server.smtp_email
+            if server.smtp_use_email:
+                from_ = server.smtp_email
+
+            msg = MIMEText(body, _charset='utf-8')
+            msg['Subject'] = Header(subject, 'utf-8')
+            msg['From'] = from_
+            msg['To'] = ', '.join(recipients)
+            msg['Reply-to'] = server.smtp_email
+            msg['Message-ID'] = make_msgid()
+            messages.append((server, recipients, msg))
+
+        if config.getboolean('galatea', 'email_queue', default=True):
+            EmailQueue.enqueue(messages)
+        else:
+            from trytond.sendmail import sendmail_transactional
+            for server, recipients, msg in messages:
+                datamanager = cls.get_smtp_datamanager(server)
+                sendmail_transactional(msg['From'], recipients, msg,
+                    datamanager=datamanager)
 
     @classmethod
     def cache_directories(cls, website):
@@ -110,11 +306,153 @@ class GalateaWebSite(ModelSQL, ModelView):
         directories.append('%s/media/cache' % (website.folder))
         return directories
 
+    @classmethod
+    def evict_cache(cls):
+        '''
+        Remove the least recently used files of the websites cache
+        directories and of the attachment derivatives bigger than
+        galatea/cache_max_size megabytes (cron)
+        '''
+        Attachment = Pool().get('ir.attachment')
+        max_size = config.getint('galatea', 'cache_max_size', default=0)
+        if not max_size:
+            return
+        directories = [Attachment.get_galatea_derivative_directory()]
+        for website in cls.search([]):
+            directories.extend(cls.cache_directories(website))
+        for directory in directories:
+            if os.path.isdir(directory):
+                cache_manager.evict(directory, max_size * 1024 * 1024)
+
     @classmethod
     @ModelView.button_action('galatea.wizard_galatea_remove_cache')
     def remove_cache(cls, websites):
         pass
 
+    @classmethod
+    def _sitemap_models(cls):
+        "Return the models whose records are listed in the sitemaps"
+        return ['galatea.website']
+
+    @classmethod
+    def get_sitemap_domain(cls, website):
+        "The home page of the website"
+        return [('id', '=', website.id)]
+
+    def get_sitemap_path(self, website, lang):
+        return '/%s/' % website.get_url_lang(lang)
+
+    @staticmethod
+    def get_url_lang(lang):
+        '''
+        Return the language of the website urls (/<lang>/...) of the
+        language code lang: es_ES and es are /es/
+        '''
+        return lang.split('_')[0].lower()
+
+    def get_sitemap_directory(self):
+        "Return the directory of the sitemaps: the static folder"
+        return os.path.join(self.folder, self.static_folder)
+
+    def get_sitemap_url(self, path):
+        return '%s/%s' % (self.uri.rstrip('/'), path.lstrip('/'))
+
+    @classmethod
+    @ModelView.button
+    def generate_sitemaps(cls, websites):
+        "Generate the sitemaps of the websites in their static folder"
+        for website in websites:
+            website._generate_sitemaps()
+
+    @classmethod
+    def generate_all_sitemaps(cls):
+        "Generate the sitemaps of all the websites (cron)"
+        for website in cls.search([]):
+            website._generate_sitemaps()
+
+    def _iter_sitemap_keys(self, Model, first=None, last=None):
+        "Yield the (id, timestamp) of the sitemap records of Model by id"
+        table = Model.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = table.id.in_(
+            Model.search(Model.get_sitemap_domain(self), query=True))
+        if first is not None:
+            where &= (table.id >= first) & (table.id <= last)
+        cursor.execute(*table.select(table.id,
+                Coalesce(table.write_date, table.create_date),
+                where=where, order_by=table.id.asc))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+    def _iter_sitemap_urls(self, Model, first, last, langs):
+        '''
+        Yield the sitemap urls of the records of Model from the id first to
+        last: one url by language with the alternates of all the languages
+        '''
+        transaction = Transaction()
+        keys = self._iter_sitemap_keys(Model, first, last)
+        for sub_keys in sitemap.iter_chunks(keys, 500):
+            ids = [i for i, _ in sub_keys]
+            paths = {}
+            for lang in langs:
+                with transaction.set_context(language=lang):
+                    paths[lang] = [r.get_sitemap_path(self, lang)
+                        for r in Model.browse(ids)]
+            for i, (_, timestamp) in enumerate(sub_keys):
+                urls = [(lang.replace('_', '-'),
+                        self.get_sitemap_url(paths[lang][i]))
+                    for lang in langs if paths[lang][i]]
+                alternates = []
+                if len(urls) > 1:
+                    alternates = urls + [('x-default', urls[0][1])]
+                for _, url in urls:
+                    yield url, timestamp, alternates
+
+    def _generate_sitemaps(self):
+        '''
+        Write the sitemaps of the website and their index (sitemap.xml).
+
+        The records of each model are split by ranges of ids in shards of
+        at most 50000 urls. The digest of the (id, timestamp) keys of each
+        shard is kept in a manifest so only the shards whose records changed
+        are written again. The files are streamed and replaced atomically.
+        '''
+        pool = Pool()
+        directory = self.get_sitemap_directory()
+        if not os.path.isdir(directory):
+            logger.warning('Missing static folder of %s: %s', self.rec_name,
+                directory)
+            return
+        start = time.time()
+        url_langs = {}
+        for code in ([l.code for l in self.languages]
+                or [Transaction().language]):
+            # The languages which share their url are listed once
+            url_langs.setdefault(self.get_url_lang(code), code)
+        langs = list(url_langs.values())
+
+        def sources():
+            for model_name in self._sitemap_models():
+                try:
+                    Model = pool.get(model_name)
+                except KeyError:
+                    # The module of the model is not activated
+                    continue
+                prefix = 'sitemap-%s' % model_name.replace(
+                    '.', '-').replace('_', '-')
+                yield (prefix, self._iter_sitemap_keys(Model),
+                    partial(self._iter_sitemap_urls, Model, langs=langs))
+
+        written, total = sitemap.generate(directory, sources(),
+            (self.uri, langs), max(sitemap.MAX_URLS // len(langs), 1),
+            self.get_sitemap_url)
+        logger.info('Sitemaps of %s: %s written, %s unchanged in %.2fs',
+            self.rec_name, written, total - written, time.time() - start)
+
 
 class GalateaWebsiteCountry(ModelSQL):
     "Website Country Relations"
@@ -122,6 +460,22 @@ class GalateaWebsiteCountry(ModelSQL):
     website = fields.Many2One('galatea.website', 'Website')
     country = fields.Many2One('country.country', 'Country')
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(GalateaWebsiteCountry, cls).create(vlist)
+        Pool().get('galatea.website').clear_snapshot_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(GalateaWebsiteCountry, cls).write(*args)
+        Pool().get('galatea.website').clear_snapshot_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(GalateaWebsiteCountry, cls).delete(records)
+        Pool().get('galatea.website').clear_snapshot_cache()
+
 
 class GalateaWebsiteLang(ModelSQL):
     "Website Language Relations"
@@ -129,6 +483,22 @@ class GalateaWebsiteLang(ModelSQL):
     website = fields.Many2One('galatea.website', 'Website')
     language = fields.Many2One('ir.lang', 'Language')
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(GalateaWebsiteLang, cls).create(vlist)
+        Pool().get('galatea.website').clear_snapshot_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(GalateaWebsiteLang, cls).write(*args)
+        Pool().get('galatea.website').clear_snapshot_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(GalateaWebsiteLang, cls).delete(records)
+        Pool().get('galatea.website').clear_snapshot_cache()
+
 
 class GalateaWebsiteCurrency(ModelSQL):
     "Currencies to be made available on website"
@@ -141,8 +511,24 @@ class GalateaWebsiteCurrency(ModelSQL):
         'currency.currency', 'Currency',
         ondelete='CASCADE', select=1, required=True)
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(GalateaWebsiteCurrency, cls).create(vlist)
+        Pool().get('galatea.website').clear_snapshot_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(GalateaWebsiteCurrency, cls).write(*args)
+        Pool().get('galatea.website').clear_snapshot_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(GalateaWebsiteCurrency, cls).delete(records)
+        Pool().get('galatea.website').clear_snapshot_cache()
 
-class GalateaUser(ModelSQL, ModelView, UserMixin):
+
+class GalateaUser(ModelSQL, ModelView):
     """Galatea Users"""
     __name__ = "galatea.user"
     _rec_name = 'display_name'
@@ -151,23 +537,41 @@ class GalateaUser(ModelSQL, ModelView, UserMixin):
         ondelete='CASCADE')
     display_name = fields.Char('Display Name', required=True)
     email = fields.Char("e-Mail", required=True)
+    email_normalized = fields.Char("Normalized e-Mail", readonly=True,
+        help='Lower-cased e-mail used to login')
     password = fields.Char('Password', required=True)
     salt = fields.Char('Salt', size=8)
     activation_code = fields.Char('Unique Activation Code')
     company = fields.Many2One('company.company', 'Company', required=True)
-    timezone = fields.Selection(
-        [(x, x) for x in pytz.common_timezones], 'Timezone', translate=False
-        )
+    timezone = fields.Selection('get_timezones', 'Timezone', translate=False)
     manager = fields.Boolean('Manager', help='Allow user in manager sections')
     active = fields.Boolean('Active', help='Allow login users')
     websites = fields.Many2Many('galatea.user-galatea.website',
         'user', 'website', 'Websites',
         help='Users will be available in those websites to login')
+    _login_miss_cache = Cache('galatea_user.login_miss', context=False,
+        duration=config.getint('galatea', 'login_miss_cache', default=60))
+    # Keyed by (id, write date) so the snapshots of a modified user are
+    # reloaded by all the processes
+    _session_cache = Cache('galatea_user.session', context=False,
+        duration=config.getint('galatea', 'session_cache', default=3600))
 
     @staticmethod
     def default_timezone():
         return "UTC"
 
+    @staticmethod
+    def get_timezones():
+        return timezones()
+
+    # flask_login user interface
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
     @staticmethod
     def default_active():
         return True
@@ -179,7 +583,7 @@ class GalateaUser(ModelSQL, ModelView, UserMixin):
     @staticmethod
     def default_websites():
         Website = Pool().get('galatea.website')
-        return [p.id for p in Website.search([('registration', '=', True)])]
+        return Website.get_registration_websites()
 
     @classmethod
     def __setup__(cls):
@@ -188,23 +592,57 @@ class GalateaUser(ModelSQL, ModelView, UserMixin):
         cls._sql_constraints += [
             ('unique_email_company', Unique(t, t.email, t.company),
                 'Email must be unique in a company'),
+            ('unique_email_normalized_company',
+                Unique(t, t.email_normalized, t.company),
+                'galatea.msg_user_email_normalized_unique'),
         ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        table = cls.__table_handler__(module_name)
+        normalized_exist = table.column_exist('email_normalized')
+
+        super(GalateaUser, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        # Migration from 5.6: fill normalized email
+        if not normalized_exist:
+            cursor.execute(*sql_table.update(
+                    [sql_table.email_normalized],
+                    [Lower(sql_table.email)]))
+            # The e-mails which differ only by their case can not login
+            # until they are merged, the unique constraint is added then
+            cursor.execute(*sql_table.select(
+                    sql_table.company, sql_table.email_normalized,
+                    group_by=[sql_table.company, sql_table.email_normalized],
+                    having=Count(Literal('*')) > 1))
+            for company, email in cursor:
+                logger.warning('Galatea users of company %s with the same '
+                    'e-mail "%s" in another case must be merged',
+                    company, email)
+        table.index_action(['company', 'email_normalized', 'active'], 'add')
+
     @staticmethod
-    def _convert_values(values):
+    def normalize_email(email):
+        return email.strip().lower() if email else email
+
+    @classmethod
+    def _convert_values(cls, values):
         """
         A helper method which looks if the password is specified in the values.
-        If it is, then the salt is also made and added
+        If it is, then it is hashed with the configured password hasher
+        (the salt is stored in the hash)
 
         :param values: A dictionary of field: value pairs
         """
-        if values.get('password'):
-            values['salt'] = ''.join(random.sample(
-                string.ascii_letters + string.digits, 8))
-            password = values['password'].encode('utf-8')
-            password += values['salt'].encode('utf-8')
-            digest = hashlib.sha1(password).hexdigest()
-            values['password'] = digest
+        if 'email' in values:
+            values['email_normalized'] = cls.normalize_email(values['email'])
+        if (values.get('password')
+                and not Transaction().context.get('_galatea_password_hashed')):
+            values['password'] = hash_password(values['password'])
+            values['salt'] = None
 
         return values
 
@@ -212,41 +650,330 @@ class GalateaUser(ModelSQL, ModelView, UserMixin):
     def create(cls, vlist):
         "Add salt before saving"
         vlist = [cls._convert_values(vals.copy()) for vals in vlist]
-        return super(GalateaUser, cls).create(vlist)
+        users = super(GalateaUser, cls).create(vlist)
+        cls.clear_login_miss_cache()
+        return users
+
+    @classmethod
+    def delete(cls, users):
+        super(GalateaUser, cls).delete(users)
+        cls.clear_login_miss_cache()
 
     @classmethod
-    def write(cls, users, values):
+    def write(cls, *args):
         "Update salt before saving"
-        values = cls._convert_values(values)
-        return super(GalateaUser, cls).write(users, values)
+        actions = iter(args)
+        args = []
+        for users, values in zip(actions, actions):
+            args.extend((users, cls._convert_values(values.copy())))
+        super(GalateaUser, cls).write(*args)
+        cls.clear_login_miss_cache()
+
+    @classmethod
+    def clear_login_miss_cache(cls):
+        '''
+        Forget the unknown login emails, the users, their websites or the
+        websites changed
+        '''
+        cls._login_miss_cache.clear()
+
+    def check_password(self, password):
+        '''
+        Check the password of the user. The hash is upgraded to the current
+        hasher and cost parameters when the password is valid.
+        The hashlib KDFs release the GIL so the other requests keep running.
+        '''
+        valid, needs_update = verify_password(
+            password, self.password, self.salt)
+        if valid and needs_update:
+            self.write([self], {'password': password})
+        return valid
+
+    def get_session_user(self):
+        "Return the SessionUser snapshot of the user"
+        return SessionUser(
+            id=self.id,
+            display_name=self.display_name,
+            email=self.email,
+            party=self.party.id,
+            party_name=self.party.rec_name,
+            lang=self.party.lang.code if self.party.lang else None,
+            company=self.company.id,
+            manager=bool(self.manager),
+            timezone=self.timezone,
+            websites=frozenset(w.id for w in self.websites),
+            )
+
+    @classmethod
+    def load_session_user(cls, user_id):
+        '''
+        Return the SessionUser of the active user id or None (flask_login
+        user loader). Only the write date of the user is read, the
+        snapshots are cached by id and write date for galatea/session_cache
+        seconds.
+        '''
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return
+        key = cls._get_session_key(user_id)
+        if key is None:
+            return
+        snapshot = cls._session_cache.get(key)
+        if snapshot is None:
+            snapshot = cls(user_id).get_session_user()
+            cls._session_cache.set(key, snapshot)
+        return snapshot
+
+    @classmethod
+    def _get_session_key(cls, user_id):
+        "Return the session cache key of the active user id or None"
+        user = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*user.select(
+                Coalesce(user.write_date, user.create_date),
+                where=(user.id == user_id) & (user.active == Literal(True))))
+        row = cursor.fetchone()
+        if row:
+            return (user_id, row[0])
 
     @classmethod
-    def signal_login(cls, user, session=None, website=None):
+    def touch_sessions(cls, user_ids):
+        "Update the write date of the users so their snapshots are reloaded"
+        user = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(list(user_ids)):
+            cursor.execute(*user.update(
+                    [user.write_date, user.write_uid],
+                    [CurrentTimestamp(), Transaction().user],
+                    where=reduce_ids(user.id, sub_ids)))
+
+    @classmethod
+    def signal_login(cls, user, session=None, website=None, request=None):
         "Flask signal to login"
-        return
+        user = cls(int(user.id))
+        key = cls._get_session_key(user.id)
+        if key is not None:
+            cls._session_cache.set(key, user.get_session_user())
+        if website is not None and request is not None:
+            cls.get_login_limiter().reset('email', cls._get_login_email_key(
+                    website, user.email_normalized, request))
 
     @classmethod
     def signal_logout(cls, user, session=None, website=None):
         "Flask signal to logout"
-        return
+        # The snapshots are only user data: the session of the request
+        # grants the login, so they are kept for the next logins
 
     @classmethod
     def signal_registration(cls, user, data=None, website=None):
         "Flask signal to registration"
         return
 
+    @classmethod
+    def signal_registrations(cls, users, website=None):
+        "Signal the registration of a batch of users"
+        for user in users:
+            cls.signal_registration(user, website=website)
+
+    @classmethod
+    def register_users(cls, vlist, website=None, skip_existing=False,
+            batch_size=1000):
+        '''
+        Create the users of vlist in batches (bulk registration or import).
+
+        The defaults are computed once, the e-mails already used in the
+        company are found with one query per batch, the passwords are
+        hashed in the password thread pool and the website links are
+        inserted with one multi-row insert per batch.
+
+        :param vlist: a list of dictionaries of values, websites is a list
+            of website ids (the registration websites by default)
+        :param skip_existing: skip the users whose e-mail is already used
+            instead of raising an error
+        :return: the list of created users
+        '''
+        pool = Pool()
+        UserWebsite = pool.get('galatea.user-galatea.website')
+        user = cls.__table__()
+        user_website = UserWebsite.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        start = time.time()
+        defaults = cls.default_get(
+            [f for f in cls._fields if f != 'websites'],
+            with_rec_name=False)
+        registration_websites = None
+        created = []
+        for sub_vlist in grouped_slice(vlist, batch_size):
+            sub_vlist = [v.copy() for v in sub_vlist]
+            keys = set()
+            for values in sub_vlist:
+                for field, value in defaults.items():
+                    values.setdefault(field, value)
+                values['email_normalized'] = cls.normalize_email(
+                    values.get('email'))
+                keys.add((values['company'], values['email_normalized']))
+
+            cursor.execute(*user.select(user.company, user.email_normalized,
+                    where=user.company.in_(list({c for c, _ in keys}))
+                    & user.email_normalized.in_([e for _, e in keys])))
+            existing = set(cursor)
+
+            to_create = []
+            for values in sub_vlist:
+                key = (values['company'], values['email_normalized'])
+                if key in existing:
+                    if skip_existing:
+                        continue
+                    raise UserError(gettext('galatea.msg_user_email_exists',
+                            email=values.get('email')))
+                existing.add(key)
+                to_create.append(values)
+            if not to_create:
+                continue
+
+            hashes = iter(hash_passwords(
+                    [v['password'] for v in to_create if v.get('password')]))
+            user_websites = []
+            for values in to_create:
+                if values.get('password'):
+                    values['password'] = next(hashes)
+                    values['salt'] = None
+                websites = values.get('websites')
+                if websites is None:
+                    if registration_websites is None:
+                        registration_websites = cls.default_websites()
+                    websites = registration_websites
+                user_websites.append(websites)
+                # Linked below, an empty list prevents create to add the
+                # default websites
+                values['websites'] = []
+
+            with transaction.set_context(_galatea_password_hashed=True):
+                users = cls.create(to_create)
+            links = [[u.id, int(w), transaction.user, CurrentTimestamp()]
+                for u, websites in zip(users, user_websites)
+                for w in websites]
+            if links:
+                cursor.execute(*user_website.insert([
+                            user_website.user, user_website.website,
+                            user_website.create_uid,
+                            user_website.create_date,
+                            ], values=links))
+            cls.signal_registrations(users, website=website)
+            created.extend(users)
+            logger.info('Register users: %s/%s users', len(created),
+                len(vlist))
+
+        elapsed = time.time() - start
+        logger.info('Registered %s users in %.2fs (%.1f users/s)',
+            len(created), elapsed, len(created) / elapsed if elapsed else 0)
+        return created
+
     @classmethod
     def _get_user_domain(cls, website, request):
+        '''
+        Return the domain of the user of the website login request, on the
+        (company, email_normalized, active) index
+        '''
+        Website = Pool().get('galatea.website')
+        snapshot = Website.get_snapshot(website)
         return [
-            ('email', '=', request.form.get('email')),
+            ('company', '=', snapshot.company),
+            ('email_normalized', '=',
+                cls.normalize_email(request.form.get('email'))),
             ('active', '=', True),
-            ('websites', 'in', [website]),
+            ('websites', 'in', [snapshot.id]),
             ]
 
+    @classmethod
+    def _get_user_query(cls, website, request):
+        "Return the SQL query of the user id of _get_user_domain"
+        return cls.search(cls._get_user_domain(website, request),
+            order=[('id', 'ASC')], limit=1, query=True)
+
+    @staticmethod
+    def get_login_limiter():
+        '''
+        Return the login RateLimiter of the process. The rules are
+        limit/seconds configured by galatea/login_rate_email (per website,
+        email and client address, 10/300 by default), login_rate_ip (30/60)
+        and login_rate_website (disabled), the counters are shared by the
+        processes when galatea/login_rate_backend is a Redis URL.
+        '''
+        global _login_limiter
+        with _login_limiter_lock:
+            if _login_limiter is None:
+                url = config.get('galatea', 'login_rate_backend', default='')
+                if url.startswith(('redis://', 'rediss://', 'unix://')):
+                    backend = RedisBackend(url)
+                else:
+                    backend = MemoryBackend()
+                _login_limiter = RateLimiter({
+                        'email': parse_rule(config.get('galatea',
+                                'login_rate_email', default='10/300')),
+                        'ip': parse_rule(config.get('galatea',
+                                'login_rate_ip', default='30/60')),
+                        'website': parse_rule(config.get('galatea',
+                                'login_rate_website', default='')),
+                        }, backend)
+            return _login_limiter
+
+    @classmethod
+    def get_login_rate_metrics(cls):
+        "Return the number of allowed and blocked login attempts"
+        return cls.get_login_limiter().metrics()
+
+    @staticmethod
+    def get_login_ip(request):
+        '''
+        Return the client address of the login request. Behind the proxies
+        listed by galatea/login_trusted_proxies (addresses or networks), it
+        is read from the galatea/login_forwarded_header header
+        (X-Forwarded-For by default).
+        '''
+        remote_addr = getattr(request, 'remote_addr', None)
+        proxies = parse_networks(
+            config.get('galatea', 'login_trusted_proxies', default=''))
+        if not proxies:
+            return remote_addr
+        header = config.get('galatea', 'login_forwarded_header',
+            default='X-Forwarded-For')
+        headers = getattr(request, 'headers', None) or {}
+        return client_ip(remote_addr, headers.get(header), proxies)
+
+    @classmethod
+    def _get_login_email_key(cls, website, email, request):
+        # With the client address, the attempts of an attacker on an e-mail
+        # do not lock its user out
+        return '%s:%s:%s' % (int(website), email, cls.get_login_ip(request))
+
     @classmethod
     def get_user(cls, website, request):
-        domain = cls._get_user_domain(website, request)
-        return cls.search(domain, limit=1)
+        email = cls.normalize_email(request.form.get('email'))
+        if not email:
+            return []
+        # Throttled attempts are rejected before any query or hash
+        if cls.get_login_limiter().hit(
+                email=cls._get_login_email_key(website, email, request),
+                ip=cls.get_login_ip(request),
+                website=int(website)):
+            return []
+        # Unknown emails are remembered for a short time so repeated login
+        # attempts do not reach the database
+        key = (int(website), email)
+        if cls._login_miss_cache.get(key):
+            return []
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*cls._get_user_query(website, request))
+        row = cursor.fetchone()
+        if not row:
+            cls._login_miss_cache.set(key, True)
+            return []
+        return cls.browse([row[0]])
 
     @classmethod
     def random_password(cls):
@@ -255,43 +982,66 @@ class GalateaUser(ModelSQL, ModelView, UserMixin):
 
     @classmethod
     def reset_password(cls, users, send_email=True):
+        '''
+        Set a new random password to the users and email it to them.
+        Passwords are hashed in parallel, email templates are rendered once
+        per language and all the emails are queued at once.
+        '''
         pool = Pool()
         Website = pool.get('galatea.website')
         User = pool.get('res.user')
-        GalateaUser = pool.get('galatea.user')
 
-        to_write = []
         for user in users:
-            password = cls.random_password()
-            recipients = [user.email]
-
             if not user.websites:
                 raise UserError(gettext('galatea.msg_missing_user_site',
                     user=user.rec_name))
 
-            if user.party.lang:
-                lang = user.party.lang.code
-            else:
-                ruser = User(Transaction().user)
-                lang = ruser.language and ruser.language.code or 'en'
-
-            with Transaction().set_context(language=lang):
-                subject = gettext('galatea.msg_email_subject',
-                    website=" ".join([w.name for w in user.websites]))
-                body = gettext('galatea.msg_email_text',
-                    name=user.display_name,
-                    email=user.email,
-                    password=password,
-                    websites="\n".join([w.uri for w in user.websites]))
-
-            if send_email and user.websites:
+        start = time.time()
+        ruser = User(Transaction().user)
+        default_lang = ruser.language and ruser.language.code or 'en'
+        passwords = [cls.random_password() for _ in users]
+        hashes = hash_passwords(passwords)
+
+        templates = {}
+        emails = []
+        to_write = []
+        for count, (user, password, hash_) in enumerate(
+                zip(users, passwords, hashes), 1):
+            if send_email:
+                if user.party.lang:
+                    lang = user.party.lang.code
+                else:
+                    lang = default_lang
+                if lang not in templates:
+                    templates[lang] = (
+                        gettext('galatea.msg_email_subject', lang),
+                        gettext('galatea.msg_email_text', lang))
+                subject, body = templates[lang]
+                subject %= {
+                    'website': " ".join([w.name for w in user.websites]),
+                    }
+                body %= {
+                    'name': user.display_name,
+                    'email': user.email,
+                    'password': password,
+                    'websites': "\n".join([w.uri for w in user.websites]),
+                    }
                 smtp_server = user.websites[0].smtp_server
-                Website.send_email(smtp_server, recipients, subject, body)
+                emails.append((smtp_server, [user.email], subject, body))
 
-            to_write.extend(([user], {'password': password}))
+            to_write.extend(([user], {'password': hash_}))
+            if not count % 500:
+                logger.info('Reset password: %s/%s users', count, len(users))
 
         if to_write:
-            GalateaUser.write(*to_write)
+            with Transaction().set_context(_galatea_password_hashed=True):
+                cls.write(*to_write)
+        if emails:
+            Website.send_emails(emails)
+
+        elapsed = time.time() - start
+        logger.info('Reset password of %s users in %.2fs (%.1f users/s)',
+            len(users), elapsed, len(users) / elapsed if elapsed else 0)
 
 
 class GalateaUserWebSite(ModelSQL):
@@ -303,10 +1053,50 @@ class GalateaUserWebSite(ModelSQL):
     website = fields.Many2One('galatea.website', 'Website',
         ondelete='RESTRICT', select=True, required=True)
 
+    @classmethod
+    def create(cls, vlist):
+        User = Pool().get('galatea.user')
+        records = super(GalateaUserWebSite, cls).create(vlist)
+        User.touch_sessions({r.user.id for r in records})
+        User.clear_login_miss_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        User = Pool().get('galatea.user')
+        ids = [r.id for r in sum(args[0:None:2], [])]
+        user_ids = {r.user.id for r in cls.browse(ids)}
+        super(GalateaUserWebSite, cls).write(*args)
+        user_ids.update(r.user.id for r in cls.browse(ids))
+        User.touch_sessions(user_ids)
+        User.clear_login_miss_cache()
+
+    @classmethod
+    def delete(cls, records):
+        User = Pool().get('galatea.user')
+        user_ids = {r.user.id for r in records}
+        super(GalateaUserWebSite, cls).delete(records)
+        User.touch_sessions(user_ids)
+        User.clear_login_miss_cache()
+
 
 class GalateaRemoveCacheStart(ModelView):
     'Galatea Remove Cache Start'
     __name__ = 'galatea.remove.cache.start'
+    prefix = fields.Char('Prefix',
+        help='Only remove the files whose path starts with this prefix')
+    older_than = fields.Integer('Older Than (days)',
+        help='Only remove the files not modified in these days')
+    sources = fields.Char('Source Files',
+        help='Comma separated source file names to remove the cache of')
+    background = fields.Boolean('Background',
+        help='Remove the files in background')
+
+
+class GalateaRemoveCacheResult(ModelView):
+    'Galatea Remove Cache Result'
+    __name__ = 'galatea.remove.cache.result'
+    info = fields.Text('Info', readonly=True)
 
 
 class GalateaRemoveCache(Wizard):
@@ -318,6 +1108,10 @@ class GalateaRemoveCache(Wizard):
             Button('Remove', 'remove', 'tryton-ok', default=True),
             ])
     remove = StateTransition()
+    result = StateView('galatea.remove.cache.result',
+        'galatea.galatea_remove_cache_result', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
 
     def transition_remove(self):
         pool = Pool()
@@ -325,17 +1119,35 @@ class GalateaRemoveCache(Wizard):
 
         websites = Website.browse(Transaction().context['active_ids'])
 
+        directories = []
         for website in websites:
-            cache_directories = Website.cache_directories(website)
-            for directory in cache_directories:
-                if os.path.exists(directory):
-                    process = subprocess.Popen(
-                        'rm -rf %s/*' % directory, shell=True)
-                    output, err = process.communicate()
-                else:
+            for directory in Website.cache_directories(website):
+                if not os.path.isdir(directory):
                     raise UserError(gettext('galatea.msg_not_dir_exist',
                         directory=directory))
-        return 'end'
+                directories.append(directory)
+
+        kwargs = {
+            'prefix': self.start.prefix,
+            'sources': [s.strip() for s in self.start.sources.split(',')
+                if s.strip()] if self.start.sources else None,
+            'older_than': (self.start.older_than * 24 * 60 * 60
+                if self.start.older_than else None),
+            }
+        if self.start.background:
+            cache_manager.purge_in_background(directories, **kwargs)
+            self.result.info = gettext(
+                'galatea.msg_remove_cache_background')
+        else:
+            files, size = cache_manager.purge(directories, **kwargs)
+            self.result.info = gettext('galatea.msg_remove_cache_info',
+                files=files, size=size)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'info': self.result.info,
+            }
 
 
 class GalateaSendPasswordStart(ModelView):
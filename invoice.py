@@ -3,10 +3,11 @@
 # the full copyright notices and license terms.
 from trytond.pool import PoolMeta
 from trytond.model import fields
+from .attachment import GalateaPartyResourceMixin
 
 __all__ = ['Invoice']
 
 
-class Invoice(metaclass=PoolMeta):
+class Invoice(GalateaPartyResourceMixin, metaclass=PoolMeta):
     __name__ = 'account.invoice'
     attachments = fields.One2Many('ir.attachment', 'resource', 'Attachments')
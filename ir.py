@@ -0,0 +1,25 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('galatea.email.queue|send_all', 'Send Galatea Emails'),
+                ('galatea.email.queue|delete_sent',
+                    'Delete Sent Galatea Emails'),
+                ('galatea.website|evict_cache',
+                    'Evict Galatea Websites Cache'),
+                ('galatea.website|generate_all_sitemaps',
+                    'Generate Galatea Websites Sitemaps'),
+                ('galatea.static.folder|sync_all_files',
+                    'Sync Galatea Static Folders'),
+                ])
@@ -0,0 +1,249 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.config import config
+
+__all__ = ['Hasher', 'SHA1Hasher', 'PBKDF2Hasher', 'ScryptHasher',
+    'Argon2Hasher', 'register_hasher', 'get_hasher', 'identify_hasher',
+    'hash_password', 'hash_passwords', 'verify_password']
+
+logger = logging.getLogger(__name__)
+HASHERS = {}
+
+
+def _b64encode(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+def _b64decode(value):
+    return base64.b64decode(value.encode('ascii'))
+
+
+class Hasher(object):
+    '''
+    Base password hasher.
+
+    Hashes are stored as "<name>$<params>$<salt>$<digest>" so the hasher and
+    the cost parameters used are known when the password is verified.
+    '''
+    name = None
+
+    def __init__(self, **params):
+        self.params = params
+
+    def hash(self, password):
+        raise NotImplementedError
+
+    def verify(self, password, hashed, salt=None):
+        raise NotImplementedError
+
+    def needs_update(self, hashed):
+        "Return True if hashed was not computed with the current parameters"
+        return True
+
+
+class SHA1Hasher(Hasher):
+    "Legacy salted SHA1 hash. The salt is stored in its own column"
+    name = 'sha1'
+
+    def hash(self, password):
+        raise ValueError('SHA1 is only supported to verify legacy passwords')
+
+    def verify(self, password, hashed, salt=None):
+        value = (password + (salt or '')).encode('utf-8')
+        digest = hashlib.sha1(value).hexdigest()
+        # compare_digest only accepts ASCII strings
+        return hmac.compare_digest(digest.encode('ascii'),
+            hashed.encode('utf-8'))
+
+
+class PBKDF2Hasher(Hasher):
+    name = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=None):
+        if iterations is None:
+            iterations = config.getint('galatea', 'pbkdf2_iterations',
+                default=200000)
+        super(PBKDF2Hasher, self).__init__(iterations=iterations)
+
+    def _digest(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+            iterations)
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        iterations = self.params['iterations']
+        return '$'.join([self.name, str(iterations), _b64encode(salt),
+                _b64encode(self._digest(password, salt, iterations))])
+
+    def verify(self, password, hashed, salt=None):
+        _, iterations, salt, digest = hashed.split('$', 3)
+        return hmac.compare_digest(
+            self._digest(password, _b64decode(salt), int(iterations)),
+            _b64decode(digest))
+
+    def needs_update(self, hashed):
+        _, iterations, _ = hashed.split('$', 2)
+        return int(iterations) != self.params['iterations']
+
+
+class ScryptHasher(Hasher):
+    name = 'scrypt'
+
+    def __init__(self, n=None, r=None, p=None):
+        super(ScryptHasher, self).__init__(
+            n=n or config.getint('galatea', 'scrypt_n', default=2 ** 14),
+            r=r or config.getint('galatea', 'scrypt_r', default=8),
+            p=p or config.getint('galatea', 'scrypt_p', default=1))
+
+    def _digest(self, password, salt, n, r, p):
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r,
+            p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+    def _params(self):
+        return ','.join(str(self.params[k]) for k in ('n', 'r', 'p'))
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        digest = self._digest(password, salt, **self.params)
+        return '$'.join([self.name, self._params(), _b64encode(salt),
+                _b64encode(digest)])
+
+    def verify(self, password, hashed, salt=None):
+        _, params, salt, digest = hashed.split('$', 3)
+        n, r, p = map(int, params.split(','))
+        return hmac.compare_digest(
+            self._digest(password, _b64decode(salt), n, r, p),
+            _b64decode(digest))
+
+    def needs_update(self, hashed):
+        _, params, _ = hashed.split('$', 2)
+        return params != self._params()
+
+
+class Argon2Hasher(Hasher):
+    "Argon2id hash, requires the argon2-cffi package"
+    name = 'argon2'
+
+    def __init__(self, time_cost=None, memory_cost=None, parallelism=None):
+        super(Argon2Hasher, self).__init__(
+            time_cost=time_cost or config.getint(
+                'galatea', 'argon2_time_cost', default=2),
+            memory_cost=memory_cost or config.getint(
+                'galatea', 'argon2_memory_cost', default=65536),
+            parallelism=parallelism or config.getint(
+                'galatea', 'argon2_parallelism', default=1))
+        try:
+            import argon2
+        except ImportError:
+            raise ImportError('Unable to import argon2. '
+                'Install argon2-cffi package.')
+        self._hasher = argon2.PasswordHasher(**self.params)
+        self._errors = (argon2.exceptions.VerificationError,
+            argon2.exceptions.InvalidHash)
+
+    def hash(self, password):
+        return '%s$%s' % (self.name, self._hasher.hash(password))
+
+    def verify(self, password, hashed, salt=None):
+        try:
+            return self._hasher.verify(hashed.split('$', 1)[1], password)
+        except self._errors:
+            return False
+
+    def needs_update(self, hashed):
+        return self._hasher.check_needs_rehash(hashed.split('$', 1)[1])
+
+
+def register_hasher(hasher_class):
+    "Register a Hasher class to be available by its name"
+    HASHERS[hasher_class.name] = hasher_class
+    return hasher_class
+
+
+for _hasher_class in (SHA1Hasher, PBKDF2Hasher, ScryptHasher, Argon2Hasher):
+    register_hasher(_hasher_class)
+
+
+def get_hasher(name=None, **params):
+    '''
+    Return a hasher instance. The default hasher is read from the
+    galatea/password_hasher configuration (pbkdf2_sha256 by default).
+    '''
+    if name is None:
+        name = config.get('galatea', 'password_hasher',
+            default='pbkdf2_sha256')
+    return HASHERS[name](**params)
+
+
+def identify_hasher(hashed):
+    "Return the hasher instance that computed hashed"
+    name = hashed.split('$', 1)[0] if '$' in hashed else None
+    if name in HASHERS:
+        return get_hasher(name)
+    return get_hasher(SHA1Hasher.name)
+
+
+def hash_password(password, hasher=None):
+    "Return the hash of password using hasher or the default one"
+    if hasher is None:
+        hasher = get_hasher()
+    return hasher.hash(password)
+
+
+def hash_passwords(passwords, hasher=None):
+    "Return the hashes of passwords computed in the password thread pool"
+    if hasher is None:
+        hasher = get_hasher()
+    return list(_get_executor().map(hasher.hash, passwords))
+
+
+def verify_password(password, hashed, salt=None):
+    '''
+    Check password against hashed.
+
+    :return: a tuple (valid, needs_update). needs_update is True when the
+        password is valid but was hashed by another hasher or with other
+        cost parameters than the current ones.
+    '''
+    if not password or not hashed:
+        return False, False
+    try:
+        hasher = identify_hasher(hashed)
+    except ImportError as exception:
+        # The package of the hasher is not installed
+        logger.warning('Unable to verify a password: %s', exception)
+        return False, False
+    try:
+        valid = hasher.verify(password, hashed, salt=salt)
+    except ValueError:
+        # Malformed hash
+        valid = False
+    if not valid:
+        return False, False
+    current = get_hasher()
+    needs_update = (hasher.name != current.name
+        or current.needs_update(hashed))
+    return True, needs_update
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = config.getint('galatea', 'password_workers', default=4)
+            _executor = ThreadPoolExecutor(max_workers=workers,
+                thread_name_prefix='galatea-password')
+    return _executor
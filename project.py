@@ -3,10 +3,11 @@
 # the full copyright notices and license terms.
 from trytond.pool import PoolMeta
 from trytond.model import fields
+from .attachment import GalateaPartyResourceMixin
 
 __all__ = ['Work']
 
 
-class Work(metaclass=PoolMeta):
+class Work(GalateaPartyResourceMixin, metaclass=PoolMeta):
     __name__ = 'project.work'
     attachments = fields.One2Many('ir.attachment', 'resource', 'Attachments')
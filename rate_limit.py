@@ -0,0 +1,193 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import ipaddress
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+__all__ = ['MemoryBackend', 'RedisBackend', 'RateLimiter', 'parse_rule',
+    'parse_networks', 'client_ip']
+
+logger = logging.getLogger(__name__)
+
+
+def _estimate(current, previous, now, start, window):
+    "Sliding window estimate from the counters of two fixed windows"
+    return previous * (1 - (now - start) / window) + current
+
+
+class MemoryBackend(object):
+    '''
+    Sliding window counters of the process. The least recently used keys
+    are dropped above max_keys.
+    '''
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, key, start, window):
+        entry = self._counters.get(key)
+        if entry is None or entry[0] < start - window:
+            entry = [start, 0, 0]
+        elif entry[0] < start:
+            entry = [start, 0, entry[1]]
+        return entry
+
+    def hit(self, key, window, now):
+        "Count a hit of key and return the estimated hits in the window"
+        start = now - now % window
+        with self._lock:
+            entry = self._entry(key, start, window)
+            entry[1] += 1
+            self._counters[key] = entry
+            self._counters.move_to_end(key)
+            while len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        return _estimate(entry[1], entry[2], now, start, window)
+
+    def reset(self, key, window, now):
+        with self._lock:
+            self._counters.pop(key, None)
+
+
+class RedisBackend(object):
+    "Sliding window counters shared by the processes in a Redis server"
+
+    def __init__(self, url, prefix='galatea:rate:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('The redis package is required for %s' % url)
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key, start):
+        return '%s%s:%d' % (self.prefix, ':'.join(map(str, key)), start)
+
+    def hit(self, key, window, now):
+        start = int(now - now % window)
+        current = self._key(key, start)
+        pipe = self.client.pipeline()
+        pipe.incr(current)
+        pipe.expire(current, int(window * 2))
+        pipe.get(self._key(key, start - int(window)))
+        count, _, previous = pipe.execute()
+        return _estimate(count, int(previous or 0), now, start, window)
+
+    def reset(self, key, window, now):
+        start = int(now - now % window)
+        self.client.delete(self._key(key, start),
+            self._key(key, start - int(window)))
+
+
+def parse_rule(value):
+    '''
+    Parse a limit/seconds rule like "5/300" into a tuple (limit, seconds)
+    or None when it is empty or the limit is 0
+    '''
+    if not value:
+        return
+    limit, _, seconds = value.partition('/')
+    limit, seconds = int(limit), int(seconds or 60)
+    if limit > 0 and seconds > 0:
+        return limit, seconds
+
+
+@lru_cache(maxsize=16)
+def parse_networks(value):
+    "Parse a comma separated list of addresses or networks"
+    return tuple(ipaddress.ip_network(v.strip(), strict=False)
+        for v in (value or '').split(',') if v.strip())
+
+
+def _trusted(address, networks):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in n for n in networks)
+
+
+def client_ip(remote_addr, forwarded=None, proxies=()):
+    '''
+    Return the address of the client of a request received from remote_addr.
+    When remote_addr is a trusted proxy, the forwarded addresses (the value
+    of an X-Forwarded-For header) are read from the right and the first one
+    which is not a trusted proxy is the client.
+
+    :param proxies: the networks of the trusted proxies
+    '''
+    if not forwarded or not _trusted(remote_addr, proxies):
+        return remote_addr
+    addresses = [a.strip() for a in forwarded.split(',') if a.strip()]
+    for address in reversed(addresses):
+        if not _trusted(address, proxies):
+            return address
+    return addresses[0] if addresses else remote_addr
+
+
+class RateLimiter(object):
+    '''
+    Sliding window rate limiter with a limit per scope (email, ip, website).
+    Every attempt is counted, so attackers stay blocked while they retry.
+    '''
+
+    def __init__(self, rules, backend=None):
+        '''
+        :param rules: a dictionary scope: (limit, seconds) or None
+        :param backend: the counters backend, a MemoryBackend by default
+        '''
+        self.rules = {s: r for s, r in rules.items() if r}
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._metrics = Counter()
+        self._metrics_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._metrics_lock:
+            self._metrics[name] += 1
+
+    def hit(self, **keys):
+        '''
+        Count an attempt for the keys of each scope (scope=value) and
+        return the first scope over its limit or None if it is allowed
+        '''
+        now = time.time()
+        for scope, value in keys.items():
+            rule = self.rules.get(scope)
+            if rule is None or value is None:
+                continue
+            limit, window = rule
+            try:
+                count = self.backend.hit((scope, value), window, now)
+            except Exception:
+                # The login must not depend on the counters store
+                logger.warning('Unable to count %s attempt', scope,
+                    exc_info=True)
+                continue
+            if count > limit:
+                self._count('blocked')
+                self._count('blocked_%s' % scope)
+                logger.info('Login attempts over the %s limit: %s', scope,
+                    value)
+                return scope
+        self._count('allowed')
+
+    def reset(self, scope, value):
+        "Reset the counter of value in scope (after a successful login)"
+        rule = self.rules.get(scope)
+        if rule is None:
+            return
+        try:
+            self.backend.reset((scope, value), rule[1], time.time())
+        except Exception:
+            logger.warning('Unable to reset %s counter', scope, exc_info=True)
+
+    def metrics(self):
+        "Return a dictionary of the number of allowed and blocked attempts"
+        with self._metrics_lock:
+            return dict(self._metrics)
@@ -0,0 +1,185 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['RemoteCache', 'get_remote_cache']
+
+logger = logging.getLogger(__name__)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class RemoteCache(object):
+    '''
+    On-disk cache of remote files.
+
+    Files are revalidated with ETag/Last-Modified once they are older than
+    ttl seconds and the least recently used ones are removed when the cache
+    is bigger than max_size bytes. Concurrent gets of the same URL, in
+    threads or processes, are collapsed into a single fetch.
+    '''
+
+    def __init__(self, directory, ttl=3600, max_size=1024 * 1024 * 1024,
+            timeout=30):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.timeout = timeout
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        directory = os.path.join(self.directory, key[:2])
+        path = os.path.join(directory, key)
+        return directory, path, path + '.json'
+
+    def _lock(self, url):
+        with self._locks_lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    @staticmethod
+    def _read_meta(meta_path):
+        try:
+            with open(meta_path) as file_:
+                return json.load(file_)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(meta_path),
+            prefix='.meta-')
+        with os.fdopen(fd, 'w') as file_:
+            json.dump(meta, file_)
+        os.replace(tmp_path, meta_path)
+
+    def _fresh(self, path, meta):
+        return (meta is not None and os.path.exists(path)
+            and time.time() - meta['fetched'] < self.ttl)
+
+    def get(self, url):
+        "Return the path of the cached content of url or None"
+        directory, path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path)
+        if self._fresh(path, meta):
+            self._touch(path)
+            return path
+
+        with self._lock(url):
+            os.makedirs(directory, 0o775, exist_ok=True)
+            lock_file = open(path + '.lock', 'w')
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another thread or process may have fetched it meanwhile
+                meta = self._read_meta(meta_path)
+                if self._fresh(path, meta):
+                    self._touch(path)
+                    return path
+                return self._fetch(url, path, meta_path, meta)
+            finally:
+                lock_file.close()
+
+    def _fetch(self, url, path, meta_path, meta):
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(url)
+        if meta is not None and os.path.exists(path):
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since',
+                    meta['last_modified'])
+        else:
+            meta = None
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as exception:
+            if exception.code == 304 and meta is not None:
+                meta['fetched'] = time.time()
+                self._write_meta(meta_path, meta)
+                self._touch(path)
+                return path
+            logger.warning('Unable to fetch %s: %s', url, exception)
+            return path if meta is not None else None
+        except (urllib.error.URLError, OSError) as exception:
+            # Serve the stale copy when the origin is not reachable
+            logger.warning('Unable to fetch %s: %s', url, exception)
+            return path if meta is not None else None
+
+        with response:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                prefix='.fetch-')
+            try:
+                with os.fdopen(fd, 'wb') as file_:
+                    shutil.copyfileobj(response, file_, 64 * 1024)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+            self._write_meta(meta_path, {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched': time.time(),
+                    })
+        self.evict()
+        return path
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        "Remove the least recently used files over max_size"
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if '.' in name:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            for name in (path, path + '.json', path + '.lock'):
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+def get_remote_cache(directory, **kwargs):
+    "Return the RemoteCache of the directory shared by the process"
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = RemoteCache(directory, **kwargs)
+        return _caches[directory]
@@ -3,10 +3,11 @@
 # the full copyright notices and license terms.
 from trytond.pool import PoolMeta
 from trytond.model import fields
+from .attachment import GalateaPartyResourceMixin
 
 __all__ = ['Sale']
 
 
-class Sale(metaclass=PoolMeta):
+class Sale(GalateaPartyResourceMixin, metaclass=PoolMeta):
     __name__ = 'sale.sale'
     attachments = fields.One2Many('ir.attachment', 'resource', 'Attachments')
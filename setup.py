@@ -42,14 +42,16 @@ major_version, minor_version, _ = version.split('.', 2)
 major_version = int(major_version)
 minor_version = int(minor_version)
 
-requires = ['Fabric', 'Flask-Login', 'pytz']
+requires = ['Fabric', 'Flask-Login', 'pytz; python_version < "3.9"',
+    'tzdata; python_version >= "3.9"']
 for dep in info.get('depends', []):
     if not re.match(r'(ir|res)(\W|$)', dep):
         prefix = MODULE2PREFIX.get(dep, 'trytond')
         requires.append(get_require_version('%s_%s' % (prefix, dep)))
 requires.append(get_require_version('trytond'))
 
-tests_require = []
+tests_require = [get_require_version('proteus'),
+    get_require_version('trytond_project')]
 series = '%s.%s' % (major_version, minor_version)
 if minor_version % 2:
     branch = 'default'
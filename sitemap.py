@@ -0,0 +1,197 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import json
+import os
+import tempfile
+from itertools import groupby
+from xml.sax.saxutils import escape
+
+__all__ = ['GalateaSitemapMixin', 'MAX_URLS', 'INDEX', 'MANIFEST',
+    'format_lastmod', 'iter_chunks', 'iter_urlset', 'iter_index',
+    'write_atomic', 'read_manifest', 'write_manifest', 'shard_digest',
+    'generate']
+
+# Maximum number of urls of a sitemap file
+MAX_URLS = 50000
+INDEX = 'sitemap.xml'
+MANIFEST = '.sitemap.json'
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+XMLNS_XHTML = 'http://www.w3.org/1999/xhtml'
+
+
+def format_lastmod(date):
+    "Return the W3C datetime of the UTC naive datetime date"
+    return date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def _lastmod(date):
+    if not isinstance(date, str):
+        date = format_lastmod(date)
+    return '<lastmod>%s</lastmod>' % date
+
+
+def iter_chunks(iterable, size):
+    "Yield lists of size items of iterable"
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_urlset(urls):
+    '''
+    Yield the bytes of a sitemap of urls as it is built
+
+    :param urls: an iterable of (loc, lastmod or None, alternates) where
+        lastmod is a datetime or a W3C datetime and alternates is a list of
+        (hreflang, href)
+    '''
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="%s" xmlns:xhtml="%s">\n'
+        % (XMLNS, XMLNS_XHTML)).encode('utf-8')
+    for loc, lastmod, alternates in urls:
+        parts = ['<url><loc>', escape(loc), '</loc>']
+        if lastmod:
+            parts.append(_lastmod(lastmod))
+        for hreflang, href in alternates:
+            parts.append('<xhtml:link rel="alternate" hreflang="%s" '
+                'href="%s"/>' % (escape(hreflang), escape(href)))
+        parts.append('</url>\n')
+        yield ''.join(parts).encode('utf-8')
+    yield b'</urlset>\n'
+
+
+def iter_index(sitemaps):
+    '''
+    Yield the bytes of a sitemap index
+
+    :param sitemaps: an iterable of (loc, lastmod or None)
+    '''
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<sitemapindex xmlns="%s">\n' % XMLNS).encode('utf-8')
+    for loc, lastmod in sitemaps:
+        parts = ['<sitemap><loc>', escape(loc), '</loc>']
+        if lastmod:
+            parts.append(_lastmod(lastmod))
+        parts.append('</sitemap>\n')
+        yield ''.join(parts).encode('utf-8')
+    yield b'</sitemapindex>\n'
+
+
+def write_atomic(path, chunks):
+    '''
+    Write the bytes chunks into path through a temporary file of the same
+    directory, so readers never see a partial file
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix='.sitemap-')
+    try:
+        with os.fdopen(fd, 'wb') as file_:
+            for chunk in chunks:
+                file_.write(chunk)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_manifest(directory):
+    "Return the dictionary of the sitemaps generated in directory"
+    try:
+        with open(os.path.join(directory, MANIFEST)) as file_:
+            return json.load(file_)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(directory, manifest):
+    write_atomic(os.path.join(directory, MANIFEST),
+        [json.dumps(manifest, sort_keys=True).encode('utf-8')])
+
+
+def shard_digest(settings, keys):
+    '''
+    Return the digest of a sitemap from the settings it depends on and the
+    (id, timestamp) keys of its records
+    '''
+    digest = hashlib.sha1(repr(settings).encode('utf-8'))
+    for id_, timestamp in keys:
+        digest.update(('%s:%s;' % (id_, timestamp)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def generate(directory, sources, settings, size, get_url):
+    '''
+    Write the sitemaps of the sources and their index in directory.
+
+    The keys of each source are split in shards by ranges of size ids, named
+    <prefix>-<first id>-<last id>.xml, so adding or removing a record only
+    changes the shard of its range. The digest of the keys of each shard and
+    of settings is kept in the manifest so only the shards which changed are
+    rendered again. The files are streamed and replaced atomically, the
+    sitemaps which are no more used are removed.
+
+    :param sources: an iterable of (prefix, keys, render) where keys is an
+        iterable of (id, timestamp) ordered by id and render(first, last)
+        returns the urls of the ids from first to last for iter_urlset
+    :param get_url: a function which returns the url of a sitemap name
+    :return: a tuple (number of sitemaps written, number of sitemaps)
+    '''
+    previous = read_manifest(directory)
+    manifest = {}
+    written = 0
+    for prefix, keys, render in sources:
+        for n, sub_keys in groupby(keys, key=lambda k: k[0] // size):
+            sub_keys = list(sub_keys)
+            first, last = n * size, (n + 1) * size - 1
+            name = '%s-%s-%s.xml' % (prefix, first, last)
+            digest = shard_digest(settings, sub_keys)
+            manifest[name] = {
+                'digest': digest,
+                'lastmod': format_lastmod(max(t for _, t in sub_keys)),
+                }
+            path = os.path.join(directory, name)
+            if (previous.get(name, {}).get('digest') == digest
+                    and os.path.exists(path)):
+                continue
+            write_atomic(path, iter_urlset(render(first, last)))
+            written += 1
+
+    removed = set(previous) - set(manifest)
+    for name in removed:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    index = os.path.join(directory, INDEX)
+    if written or removed or not os.path.exists(index):
+        write_atomic(index, iter_index(
+                (get_url(n), m['lastmod']) for n, m in manifest.items()))
+        write_manifest(directory, manifest)
+    return written, len(manifest)
+
+
+class GalateaSitemapMixin(object):
+    '''
+    Model whose records are listed in the sitemaps of the websites.
+    The model must be added to GalateaWebSite._sitemap_models.
+    '''
+
+    @classmethod
+    def get_sitemap_domain(cls, website):
+        "Return the domain of the records listed in the sitemaps of website"
+        return []
+
+    def get_sitemap_path(self, website, lang):
+        '''
+        Return the path of the page of the record in the language code lang
+        or None. The records are read with the language in the context.
+        '''
+        raise NotImplementedError
@@ -1,21 +1,214 @@
 # This file is part galatea module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
 import os
 import os.path
-import urllib.request, urllib.parse, urllib.error
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.wizard import Wizard, StateTransition, StateView, Button
+from trytond.cache import Cache
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.pool import Pool
 from trytond.pyson import Eval, Not, Equal
 from trytond.transaction import Transaction
 from trytond.config import config
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
-from .tools import slugify, slugify_file
+from .tools import (slugify, slugify_file, slugify_files, unique_file_slug,
+    parse_range)
+from .remote_cache import get_remote_cache
+from . import static_import
+from . import static_layout
+from . import static_pipeline
+from .static_pipeline import link_file
 
 
-__all__ = ['GalateaStaticFolder', 'GalateaStaticFile']
+__all__ = ['FilesDataManager', 'GalateaStaticFolder', 'GalateaStaticFile',
+    'GalateaStaticFileImportStart', 'GalateaStaticFileImportResult',
+    'GalateaStaticFileImport']
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Memoized galatea base path per database name
+_base_paths = {}
+
+
+def _write_content(path, value, blob_directory=None, chunk_size=CHUNK_SIZE):
+    '''
+    Write the file at path from bytes, a binary file object or an iterable
+    of chunks through a temporary file. When blob_directory is set, the
+    content is stored in it by its SHA-256 and path is a hard link to it.
+    It does not use the transaction so it can run in any thread.
+
+    :return: a tuple (SHA-256 hex digest, size) of the content
+    '''
+    # If the folder does not exist, create it recursively
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o775, exist_ok=True)
+    if blob_directory:
+        tmp_directory = blob_directory
+        os.makedirs(tmp_directory, 0o775, exist_ok=True)
+    else:
+        tmp_directory = directory
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_directory, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as file_writer:
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                chunks = [value]
+            elif hasattr(value, 'read'):
+                chunks = iter(lambda: value.read(chunk_size), b'')
+            else:
+                chunks = value
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                file_writer.write(chunk)
+        os.chmod(tmp_path, 0o644)
+        if blob_directory:
+            hexdigest = digest.hexdigest()
+            blob_path = os.path.join(blob_directory, hexdigest[:2],
+                hexdigest[2:4], hexdigest)
+            os.makedirs(os.path.dirname(blob_path), 0o775, exist_ok=True)
+            if os.path.exists(blob_path):
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, blob_path)
+            link_file(blob_path, path)
+        else:
+            os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return digest.hexdigest(), size
+
+
+def _hash_file(path, blob_directory=None):
+    '''
+    Return the SHA-256 hex digest of the file at path. When blob_directory
+    is set, the file is linked to its blob: it becomes the blob if there is
+    none or it is replaced by a hard link to the existing one.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_reader:
+        for chunk in iter(lambda: file_reader.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+    if blob_directory:
+        blob_path = os.path.join(blob_directory, hexdigest[:2],
+            hexdigest[2:4], hexdigest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), 0o775, exist_ok=True)
+            link_file(path, blob_path)
+        elif not os.path.samefile(path, blob_path):
+            link_file(blob_path, path)
+    return hexdigest
+
+
+class FilesDataManager(object):
+    '''
+    Transaction data manager of the file system changes of a transaction.
+    The temporary files replace their path, the files are renamed and the
+    commit callbacks run once the transaction is committed, the temporary
+    files are removed and the abort callbacks run if it is rolled back.
+    '''
+
+    def __init__(self):
+        self._moves = {}
+        self._renames = {}
+        self._lock = threading.Lock()
+        self._on_commit = []
+        self._on_abort = []
+
+    def __eq__(self, other):
+        return isinstance(other, FilesDataManager)
+
+    def move(self, tmp_path, path):
+        "Register the temporary file which replaces path (None to remove it)"
+        with self._lock:
+            self._moves[tmp_path] = path
+
+    def rename(self, path, new_path):
+        "Register the rename of path to new_path, path is kept on rollback"
+        with self._lock:
+            self._renames[path] = new_path
+
+    def discard(self, tmp_path):
+        "Remove the temporary file now"
+        with self._lock:
+            self._moves.pop(tmp_path, None)
+        _remove(tmp_path)
+
+    def on_commit(self, func, *args, **kwargs):
+        self._on_commit.append((func, args, kwargs))
+
+    def on_abort(self, func, *args, **kwargs):
+        self._on_abort.append((func, args, kwargs))
+
+    def abort(self, trans):
+        pass
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        for tmp_path, path in self._moves.items():
+            if path is None:
+                _remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), 0o775, exist_ok=True)
+                os.replace(tmp_path, path)
+        for path, new_path in self._renames.items():
+            if os.path.exists(new_path):
+                logger.warning('Skip rename of %s: %s exists', path, new_path)
+                continue
+            os.makedirs(os.path.dirname(new_path), 0o775, exist_ok=True)
+            os.rename(path, new_path)
+        self._run(self._on_commit)
+
+    def tpc_abort(self, trans):
+        for tmp_path in self._moves:
+            _remove(tmp_path)
+        self._run(self._on_abort)
+
+    def _run(self, callbacks):
+        for func, args, kwargs in callbacks:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.error('Unable to run %s', func, exc_info=True)
+        self._moves.clear()
+        self._renames.clear()
+        del self._on_commit[:]
+        del self._on_abort[:]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
 class GalateaStaticFolder(ModelSQL, ModelView):
@@ -25,6 +218,13 @@ class GalateaStaticFolder(ModelSQL, ModelView):
         help='Folder name contains az09 characters')
     description = fields.Char('Description', select=1)
     files = fields.One2Many('galatea.static.file', 'folder', 'Files')
+    last_sync = fields.Timestamp('Last Sync', readonly=True,
+        help='The files not modified since are not read by the next sync')
+    layout = fields.Selection([
+            (static_layout.FLAT, 'Flat'),
+            (static_layout.SHARDED, 'Sharded'),
+            ], 'Layout', readonly=True, required=True,
+        help='Sharded stores the files in sub-directories by name hash')
 
     @classmethod
     def __setup__(cls):
@@ -34,6 +234,24 @@ class GalateaStaticFolder(ModelSQL, ModelView):
             ('unique_folder', Unique(table, table.name),
              'Folder name needs to be unique')
         ]
+        cls._buttons.update({
+                'rebuild_assets': {},
+                'sync_files': {},
+                'shard_files': {
+                    'invisible': Equal(Eval('layout'),
+                        static_layout.SHARDED),
+                    'depends': ['layout'],
+                    },
+                'unshard_files': {
+                    'invisible': Not(Equal(Eval('layout'),
+                            static_layout.SHARDED)),
+                    'depends': ['layout'],
+                    },
+                })
+
+    @staticmethod
+    def default_layout():
+        return static_layout.FLAT
 
     @fields.depends('name')
     def on_change_with_name(self):
@@ -75,6 +293,272 @@ class GalateaStaticFolder(ModelSQL, ModelView):
     def copy(cls, files, default=None):
         raise UserError(gettext('galatea.not_allow_copy'))
 
+    def get_path(self):
+        "Return the directory of the folder files"
+        StaticFile = Pool().get('galatea.static.file')
+        return os.path.join(StaticFile.get_galatea_base_path(), self.name)
+
+    def get_file_path(self, name):
+        "Return the path of the file name of the folder"
+        return static_layout.file_path(self.get_path(), name, self.layout)
+
+    @classmethod
+    @ModelView.button
+    def shard_files(cls, folders):
+        cls.migrate_layout(folders, static_layout.SHARDED)
+
+    @classmethod
+    @ModelView.button
+    def unshard_files(cls, folders):
+        cls.migrate_layout(folders, static_layout.FLAT)
+
+    @classmethod
+    def migrate_layout(cls, folders, layout, workers=None):
+        '''
+        Move the files of the folders to layout while they are served.
+
+        The files are hard linked to their new path by batches of
+        galatea/sync_batch on a thread pool and then the folders use
+        layout. The marker file of the folders is set once the transaction
+        is committed and their old paths are removed by the next sync (or
+        migration) of the folders, the new paths are removed if it is rolled
+        back.
+
+        :param workers: the number of threads
+        '''
+        StaticFile = Pool().get('galatea.static.file')
+        batch_size = config.getint('galatea', 'sync_batch', default=1000)
+        datamanager = Transaction().join(FilesDataManager())
+        to_write = []
+        for folder in folders:
+            directory = folder.get_path()
+            if folder.layout == layout:
+                if os.path.isdir(directory):
+                    # The layout is already committed
+                    static_layout.set_layout(directory, layout)
+                    static_layout.remove_stale(directory, layout)
+                continue
+            if os.path.isdir(directory):
+                start = time.perf_counter()
+                count = static_layout.link_files(directory, layout,
+                    workers=workers, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+                logger.info('Linked %s files of folder "%s" to the %s '
+                    'layout in %.1fs: %.1f files/s', count, folder.name,
+                    layout, elapsed, count / elapsed if elapsed else 0)
+                datamanager.on_commit(
+                    static_layout.set_layout, directory, layout)
+                datamanager.on_abort(
+                    static_layout.remove_stale, directory, folder.layout)
+            to_write.append(folder)
+        if to_write:
+            cls.write(to_write, {'layout': layout})
+            StaticFile._lookup_cache.clear()
+
+    @classmethod
+    @ModelView.button
+    def rebuild_assets(cls, folders):
+        '''
+        Rebuild the fingerprinted and compressed assets of the local files
+        of the folders with the best compression levels
+        '''
+        for folder in folders:
+            names = dict.fromkeys(
+                f.name for f in folder.files if f.type == 'local')
+            for directory, sub_names in static_layout.group_by_directory(
+                    folder.get_path(), names, folder.layout).items():
+                static_pipeline.build_folder(directory, sub_names)
+
+    @classmethod
+    @ModelView.button
+    def sync_files(cls, folders):
+        "Reconcile the static files of the folders with their directory"
+        for folder in folders:
+            folder._sync_files()
+
+    @classmethod
+    def sync_all_files(cls, full=False):
+        '''
+        Reconcile the static files of all the folders with their directory
+        (cron)
+
+        :param full: read all the files instead of the files modified since
+            the last sync
+        '''
+        for folder in cls.search([]):
+            folder._sync_files(full=full)
+
+    def _sync_files(self, full=False):
+        '''
+        Reconcile the static files of the folder with its directory:
+
+        - files on disk without record are created (renamed to their slug
+          once committed) and, in a sharded folder, moved from the top to
+          their shard
+        - files modified since the last sync get their content hash updated
+        - records without file are deleted
+        - compressed and fingerprinted assets of missing files are removed
+        - the paths of the previous layout are removed once the migration
+          is committed
+
+        The directory is scanned with os.scandir, only the files whose mtime
+        or ctime is newer than the checkpoint are read and the records are
+        processed in batches of galatea/sync_batch.
+
+        :return: a dictionary with the number of new, changed, missing and
+            orphan files
+        '''
+        pool = Pool()
+        StaticFile = pool.get('galatea.static.file')
+        static_file = StaticFile.__table__()
+        cursor = Transaction().connection.cursor()
+        batch_size = config.getint('galatea', 'sync_batch', default=1000)
+
+        directory = self.get_path()
+        if not os.path.isdir(directory):
+            # Do not delete the records when the directory (or the volume)
+            # is not available
+            logger.warning('Skip sync of folder "%s": %s does not exist',
+                self.name, directory)
+            return
+        layout = self.layout
+        datamanager = Transaction().join(FilesDataManager())
+        # The paths of the previous layout once the marker of the migration
+        # is committed
+        datamanager.on_commit(static_layout.remove_stale, directory, layout)
+        if layout == static_layout.SHARDED:
+            static_layout.collect(directory)
+        checkpoint = datetime.datetime.utcnow()
+        since = None
+        if self.last_sync and not full:
+            since = self.last_sync.replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+
+        records = {}
+        cursor.execute(*static_file.select(
+                static_file.id, static_file.name, static_file.content_hash,
+                where=(static_file.folder == self.id)
+                & (static_file.type == 'local')))
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            for id_, name, content_hash in rows:
+                records[name] = (id_, content_hash)
+
+        assets = set()
+        for sub_directory in static_layout.iter_directories(
+                directory, layout):
+            assets.update(e['fingerprint'] for e in
+                static_pipeline.read_manifest(sub_directory).values())
+        on_disk = {}
+        for entry in static_layout.iter_files(directory, layout):
+            stat = entry.stat(follow_symlinks=False)
+            on_disk[entry.name] = max(stat.st_mtime, stat.st_ctime)
+
+        new, changed, orphans = [], [], []
+        for name, mtime in on_disk.items():
+            if name in records:
+                if since is None or mtime > since:
+                    changed.append(name)
+                continue
+            if name in assets:
+                continue
+            source = static_layout.asset_source(name)
+            if source in on_disk:
+                continue
+            elif source in records:
+                # The asset of a missing file
+                orphans.append(name)
+            else:
+                new.append(name)
+        missing = [records[n][0] for n in records if n not in on_disk]
+
+        # Files must be named by their slug like the created ones
+        paths = {}
+        for name in new:
+            slug = slugify_file(name)
+            if slug != name:
+                if (not slug or slug in on_disk or slug in records
+                        or slug in paths):
+                    logger.warning('Skip "%s" of folder "%s": its name is '
+                        'not a slug', name, self.name)
+                    continue
+                datamanager.rename(
+                    static_layout.file_path(directory, name, layout),
+                    static_layout.file_path(directory, slug, layout))
+            paths[slug] = static_layout.file_path(directory, name, layout)
+        new = list(paths)
+
+        blob_directory = (StaticFile.get_blob_path()
+            if StaticFile.content_addressed() else None)
+        to_build = {}
+        old_digests = []
+        with ThreadPoolExecutor() as executor:
+            def digests(names):
+                return dict(zip(names, executor.map(
+                            lambda n: _hash_file(paths.get(n)
+                                or static_layout.file_path(
+                                    directory, n, layout),
+                                blob_directory), names)))
+
+            for sub_names in grouped_slice(sorted(new), batch_size):
+                sub_digests = digests(list(sub_names))
+                StaticFile.create([{
+                            'name': n,
+                            'folder': self.id,
+                            'type': 'local',
+                            'content_hash': d,
+                            } for n, d in sub_digests.items()])
+                to_build.update(sub_digests)
+
+            changed_count = 0
+            for sub_names in grouped_slice(changed, batch_size):
+                sub_digests = digests(list(sub_names))
+                to_write = {}
+                for name, digest in sub_digests.items():
+                    id_, content_hash = records[name]
+                    if digest != content_hash:
+                        to_write.setdefault(digest, []).append(id_)
+                        old_digests.append(content_hash)
+                        to_build[name] = digest
+                if to_write:
+                    args = []
+                    for digest, ids in to_write.items():
+                        args.extend((StaticFile.browse(ids),
+                                {'content_hash': digest}))
+                    StaticFile.write(*args)
+                    changed_count += sum(len(i) for i in to_write.values())
+
+        for sub_ids in grouped_slice(missing, batch_size):
+            StaticFile.delete(StaticFile.browse(list(sub_ids)))
+        for name in orphans:
+            datamanager.on_commit(_remove,
+                static_layout.file_path(directory, name, layout))
+        # The assets are built once the files are renamed
+        if to_build and StaticFile.static_pipeline():
+            for sub_directory, files in static_layout.group_by_directory(
+                    directory, to_build, layout).items():
+                datamanager.on_commit(static_pipeline.build_files,
+                    sub_directory, files, workers=None)
+        if blob_directory:
+            datamanager.on_commit(StaticFile._release_blobs, old_digests)
+
+        self.write([self], {'last_sync': checkpoint})
+        result = {
+            'new': len(new),
+            'changed': changed_count,
+            'missing': len(missing),
+            'orphans': len(orphans),
+            }
+        logger.info('Synced folder "%s": %s new, %s changed, %s missing, '
+            '%s orphan files', self.name, result['new'], result['changed'],
+            result['missing'], result['orphans'])
+        return result
+
+    @classmethod
+    def delete(cls, folders):
+        StaticFile = Pool().get('galatea.static.file')
+        super(GalateaStaticFolder, cls).delete(folders)
+        StaticFile._lookup_cache.clear()
+
 
 class GalateaStaticFile(ModelSQL, ModelView):
     "Static files for Galatea"
@@ -95,9 +579,19 @@ class GalateaStaticFile(ModelSQL, ModelView):
     file_binary = fields.Function(fields.Binary('File', filename='name'),
         'get_file_binary', 'set_file_binary')
     file_path = fields.Function(fields.Char('File Path'),
-        'get_file_path')
+        'get_paths')
     url = fields.Function(fields.Char('URL'),
-        'get_url')
+        'get_paths')
+    content_hash = fields.Char('Content Hash', readonly=True, select=True,
+        help='SHA-256 of the file content')
+    _lookup_cache = Cache('galatea_static_file.lookup', context=False)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(GalateaStaticFile, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        table.index_action(['folder', 'name'], 'add')
 
     @staticmethod
     def default_folder():
@@ -114,17 +608,74 @@ class GalateaStaticFile(ModelSQL, ModelView):
         """
         Setter for static file that stores file in file system
 
-        :param value: The value to set
+        :param value: The value to set (bytes or a binary file object)
+        :return: the SHA-256 hex digest of the content
         """
         if self.type == 'local':
-            file_binary = bytes(value)
-            # If the folder does not exist, create it recursively
-            directory = os.path.dirname(self.file_path)
-            if not os.path.isdir(directory):
-                os.makedirs(directory, 0o775)
-            os.umask(0o022)
-            with open(self.file_path, 'wb') as file_writer:
-                file_writer.write(file_binary)
+            return self.write_file(value)
+
+    def write_file(self, value, chunk_size=CHUNK_SIZE):
+        '''
+        Write the local file from bytes, a binary file object or an iterable
+        of chunks. The content is written to a temporary file which replaces
+        the current one once the transaction is committed.
+
+        With the content-addressed storage (galatea/static_storage = cas),
+        the content is stored once by its SHA-256 and the file is a hard
+        link to it.
+
+        :return: the SHA-256 hex digest of the content
+        '''
+        blob_directory = (self.get_blob_path() if self.content_addressed()
+            else None)
+        datamanager = Transaction().join(FilesDataManager())
+        path = self.file_path
+        tmp_path = os.path.join(os.path.dirname(path),
+            '.upload-%s' % uuid.uuid4().hex)
+        datamanager.move(tmp_path, None)
+        digest, _ = _write_content(tmp_path, value,
+            blob_directory=blob_directory, chunk_size=chunk_size)
+        datamanager.move(tmp_path, path)
+        if blob_directory:
+            # The blob of a rolled back content is no more linked
+            datamanager.on_abort(self._release_blobs, [digest])
+        return digest
+
+    @staticmethod
+    def content_addressed():
+        "Return True if the content-addressed storage is used"
+        return config.get('galatea', 'static_storage',
+            default='files') == 'cas'
+
+    @classmethod
+    def get_blob_path(cls, digest=None):
+        '''
+        Return the path of the blob of the content-addressed storage with the
+        digest or the blobs directory:
+        <galatea base path>/.blobs/<digest[:2]>/<digest[2:4]>/<digest>
+        '''
+        path = os.path.join(cls.get_galatea_base_path(), '.blobs')
+        if digest:
+            path = os.path.join(path, digest[:2], digest[2:4], digest)
+        return path
+
+    @classmethod
+    def blob_references(cls, digest):
+        "Return the number of files linked to the blob with the digest"
+        try:
+            return os.stat(cls.get_blob_path(digest)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    @classmethod
+    def _release_blobs(cls, digests):
+        "Remove the blobs that are no more linked by any file"
+        for digest in filter(None, set(digests)):
+            if not cls.blob_references(digest):
+                try:
+                    os.remove(cls.get_blob_path(digest))
+                except FileNotFoundError:
+                    pass
 
     @classmethod
     def set_file_binary(cls, files, name, value):
@@ -135,29 +686,390 @@ class GalateaStaticFile(ModelSQL, ModelView):
         :param name: Ignored
         :param value: The file bytes
         """
+        os.umask(0o022)
+        old_digests = [f.content_hash for f in files]
+        files_by_digest = {}
+        for static_file in files:
+            if static_file.type != 'local':
+                continue
+            digest = static_file._set_file_binary(value)
+            files_by_digest.setdefault(digest, []).append(static_file)
+        to_write = []
+        for digest, digest_files in files_by_digest.items():
+            to_write.extend((digest_files, {'content_hash': digest}))
+        if to_write:
+            cls.write(*to_write)
+        datamanager = Transaction().join(FilesDataManager())
+        # The assets are built once the files are moved
+        if cls.static_pipeline():
+            to_build = {}
+            for digest, digest_files in files_by_digest.items():
+                for static_file in digest_files:
+                    directory, name = os.path.split(static_file.file_path)
+                    to_build.setdefault(directory, {})[name] = digest
+            for directory, names in to_build.items():
+                # Built in the request so use the fast compression levels,
+                # rebuild_assets uses the best ones
+                datamanager.on_commit(static_pipeline.build_files,
+                    directory, names, fast=True)
+        # After the pipeline which unlinks the previous fingerprinted links
+        if cls.content_addressed():
+            datamanager.on_commit(cls._release_blobs, old_digests)
+
+    @staticmethod
+    def static_pipeline():
+        "Return True if the assets are built when files are written"
+        return config.getboolean('galatea', 'static_pipeline', default=True)
+
+    @classmethod
+    def update_content_hashes(cls, files=None):
+        '''
+        Compute the content hash of the local files (all by default) from
+        the file system and link them to the content-addressed storage when
+        it is used. The files are read in place, not rewritten.
+        '''
+        if files is None:
+            files = cls.search([('type', '=', 'local')])
+        blob_directory = (cls.get_blob_path() if cls.content_addressed()
+            else None)
+        to_write = []
         for static_file in files:
-            static_file._set_file_binary(value)
+            if (static_file.type != 'local'
+                    or not os.path.exists(static_file.file_path)):
+                continue
+            digest = _hash_file(static_file.file_path, blob_directory)
+            if digest != static_file.content_hash:
+                to_write.extend(([static_file], {'content_hash': digest}))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def import_files(cls, source, folder=None, workers=None):
+        '''
+        Import the files of a directory, a zip or a tar archive (path or
+        binary file object).
+
+        The files are streamed to temporary files on a thread pool, then
+        the missing folders and the files are created in one batch and the
+        existing files are updated. The temporary files replace the files
+        once the transaction is committed and are removed if it is rolled
+        back. Nested directories are flattened into the file name
+        (css/main.css becomes css-main.css), the names which are the same
+        once slugified get a -2, -3... suffix.
+
+        :param folder: the folder of all the files, by default the first
+            directory of each file path is its folder and the files at the
+            root are skipped
+        :param workers: the number of threads of the import and the builds
+        :raise ImportLimitError: when a file or all the files are larger
+            than galatea/import_max_file_size or galatea/import_max_size
+        :return: a tuple (number of files, bytes, seconds)
+        '''
+        pool = Pool()
+        Folder = pool.get('galatea.static.folder')
+        start = time.perf_counter()
+        os.umask(0o022)
+        base_path = cls.get_galatea_base_path()
+        blob_directory = (cls.get_blob_path() if cls.content_addressed()
+            else None)
+        layouts = {f.name: f.layout for f in Folder.search([])}
+        datamanager = Transaction().join(FilesDataManager())
+
+        def get_path(folder_name, name):
+            return static_layout.file_path(
+                os.path.join(base_path, folder_name), name,
+                layouts.get(folder_name, static_layout.FLAT))
+
+        def write(parts, file_):
+            path = '/'.join(parts)
+            if folder:
+                folder_name = folder.name
+            elif len(parts) > 1:
+                folder_name, parts = slugify(parts[0]), parts[1:]
+            else:
+                logger.info('Skip %s: not in a folder', parts[0])
+                return
+            name = slugify_file('-'.join(parts))
+            if not folder_name or not name:
+                return
+            tmp_path = os.path.join(
+                os.path.dirname(get_path(folder_name, name)),
+                '.import-%s' % uuid.uuid4().hex)
+            datamanager.move(tmp_path, None)
+            digest, size = _write_content(tmp_path, file_,
+                blob_directory=blob_directory)
+            return path, folder_name, name, digest, size, tmp_path
+
+        results = [r for r in static_import.import_source(source, write,
+                workers=workers,
+                max_file_size=config.getint('galatea', 'import_max_file_size',
+                    default=100 * 1024 * 1024),
+                max_size=config.getint('galatea', 'import_max_size',
+                    default=1024 * 1024 * 1024)) if r]
+        sources = {}
+        for result in results:
+            # The last member of an archive with the same path wins
+            sources[result[0]] = result
+        imported = {}
+        used_names = {}
+        for path, folder_name, name, digest, size, tmp_path in results:
+            if sources[path][-1] != tmp_path:
+                datamanager.discard(tmp_path)
+                continue
+            name = unique_file_slug(name,
+                used_names.setdefault(folder_name, set()))
+            imported[(folder_name, name)] = (digest, size)
+            datamanager.move(tmp_path, get_path(folder_name, name))
+        if blob_directory:
+            # The blobs of the rolled back contents are no more linked
+            datamanager.on_abort(cls._release_blobs,
+                [d for d, _ in imported.values()])
+
+        folder_names = {k[0] for k in imported}
+        folders = {f.name: f for f in Folder.search([
+                    ('name', 'in', list(folder_names)),
+                    ])}
+        new_folders = sorted(folder_names - set(folders))
+        if new_folders:
+            folders.update((f.name, f) for f in Folder.create(
+                    [{'name': n} for n in new_folders]))
+        folder_ids = {f.id: f.name for f in folders.values()}
+
+        existing = {}
+        for sub_ids in grouped_slice(folder_ids):
+            for static_file in cls.search([
+                        ('folder', 'in', list(sub_ids)),
+                        ('type', '=', 'local'),
+                        ]):
+                key = (folder_ids[static_file.folder.id], static_file.name)
+                if key in imported:
+                    existing[key] = static_file
+
+        to_create = []
+        to_write = {}
+        old_digests = []
+        for key, (digest, _) in imported.items():
+            if key in existing:
+                static_file = existing[key]
+                if static_file.content_hash != digest:
+                    old_digests.append(static_file.content_hash)
+                    to_write.setdefault(digest, []).append(static_file)
+            else:
+                to_create.append({
+                        'name': key[1],
+                        'folder': folders[key[0]].id,
+                        'type': 'local',
+                        'content_hash': digest,
+                        })
+        if to_create:
+            cls.create(to_create)
+        if to_write:
+            args = []
+            for digest, files in to_write.items():
+                args.extend((files, {'content_hash': digest}))
+            cls.write(*args)
+        # The assets are built once the files are moved
+        if cls.static_pipeline():
+            to_build = {}
+            for (folder_name, name), (digest, _) in imported.items():
+                to_build.setdefault(folder_name, {})[name] = digest
+            for folder_name, names in to_build.items():
+                for directory, sub_names in (
+                        static_layout.group_by_directory(
+                            os.path.join(base_path, folder_name), names,
+                            folders[folder_name].layout).items()):
+                    datamanager.on_commit(static_pipeline.build_files,
+                        directory, sub_names, workers=workers)
+        if blob_directory:
+            datamanager.on_commit(cls._release_blobs, old_digests)
+
+        elapsed = time.perf_counter() - start
+        size = sum(s for _, s in imported.values())
+        logger.info('Imported %s files (%s bytes) in %.1fs: %.1f files/s',
+            len(imported), size, elapsed,
+            len(imported) / elapsed if elapsed else 0)
+        return len(imported), size, elapsed
+
+    def get_etag(self):
+        "Return a strong HTTP ETag of the content or None"
+        if self.content_hash:
+            return '"%s"' % self.content_hash
 
     def get_file_binary(self, name):
         '''
         Getter for the binary_file field. This fetches the file from the
         file system, coverts it to bytes and returns it.
+        Only the size is returned when the context asks for it.
 
         :param name: Field name
         :return: File bytes
         '''
+        location = self.get_location()
+        if not location:
+            return
+        if Transaction().context.get(
+                '%s.%s' % (self.__name__, name)) == 'size':
+            return os.path.getsize(location)
+        with open(location, 'rb') as file_reader:
+            return fields.Binary.cast(file_reader.read())
+
+    def get_location(self):
+        "Return the path of the file content on the file system or None"
         if self.type == 'local':
             location = self.file_path
-            if not os.path.exists(location):
+            if not location or not os.path.exists(location):
+                logger.warning('Missing file %s of static file %s',
+                    location, self.id)
                 return
         else:
-            try:
-                location = urllib.request.urlretrieve(self.remote_path)[0]
-            except:
-                return
+            location = self.get_remote_cache().get(self.remote_path)
+        return location
 
+    @classmethod
+    def get_remote_cache(cls):
+        '''
+        Return the cache of the remote files, stored in
+        <galatea base path>/.remote-cache
+        '''
+        return get_remote_cache(
+            os.path.join(cls.get_galatea_base_path(), '.remote-cache'),
+            ttl=config.getint('galatea', 'remote_cache_ttl', default=3600),
+            max_size=config.getint('galatea', 'remote_cache_size',
+                default=1024) * 1024 * 1024)
+
+    def get_size(self):
+        "Return the size of the file or None"
+        location = self.get_location()
+        if location:
+            return os.path.getsize(location)
+
+    def iter_file(self, start=0, end=None, chunk_size=CHUNK_SIZE):
+        '''
+        Yield the content of the file from start to end (excluded) in chunks
+        of chunk_size bytes, so the file is never loaded in memory.
+        '''
+        location = self.get_location()
+        if not location:
+            return
         with open(location, 'rb') as file_reader:
-            return fields.Binary.cast(file_reader.read())
+            file_reader.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                size = (chunk_size if remaining is None
+                    else min(chunk_size, remaining))
+                chunk = file_reader.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    @contextmanager
+    def mmap_file(self):
+        '''
+        Context manager that maps the file read-only in memory.
+        Slices only load the pages they use, which suits random access
+        such as HTTP Range requests.
+        '''
+        import mmap
+        location = self.get_location()
+        if not location:
+            yield None
+            return
+        with open(location, 'rb') as file_reader:
+            if not os.fstat(file_reader.fileno()).st_size:
+                yield b''
+                return
+            with mmap.mmap(file_reader.fileno(), 0,
+                    access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def read_range(self, start, end):
+        "Return the bytes of the file from start to end (excluded)"
+        with self.mmap_file() as mapped:
+            if mapped is not None:
+                return mapped[start:end]
+
+    def iter_range(self, range_header, chunk_size=CHUNK_SIZE):
+        '''
+        Return (start, end, size, chunks) for a HTTP Range header value.
+        start and end are None when the range is missing or not satisfiable
+        and then chunks iterate over the whole file.
+        '''
+        size = self.get_size()
+        if size is None:
+            return None, None, None, iter(())
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return None, None, size, self.iter_file(chunk_size=chunk_size)
+        start, end = byte_range
+        return start, end, size, self.iter_file(start, end + 1,
+            chunk_size=chunk_size)
+
+    @classmethod
+    def _get_folders(cls, files):
+        "Return a dictionary of folder id: (name, layout) of the files"
+        Folder = Pool().get('galatea.static.folder')
+        folder = Folder.__table__()
+        cursor = Transaction().connection.cursor()
+
+        folder_ids = {f.folder.id for f in files if f.folder}
+        names = {}
+        for sub_ids in grouped_slice(folder_ids):
+            cursor.execute(*folder.select(folder.id, folder.name,
+                    folder.layout,
+                    where=reduce_ids(folder.id, sub_ids)))
+            names.update((i, (n, l)) for i, n, l in cursor)
+        return names
+
+    @classmethod
+    def get_paths(cls, files, names):
+        """
+        Returns the full path to the file in the file system and its url.
+        The folder names of all the files are read in one query.
+
+        :param names: Field names
+        :return: a dictionary of field name: {file id: value}
+        """
+        base_path = cls.get_galatea_base_path()
+        folders = cls._get_folders(files)
+        manifests = {}
+        result = {name: {} for name in names}
+        for static_file in files:
+            if static_file.type == 'local':
+                folder_name, layout = folders.get(
+                    static_file.folder.id if static_file.folder else None,
+                    (None, None))
+                if folder_name is None:
+                    path = url = None
+                else:
+                    path = os.path.abspath(static_layout.file_path(
+                            os.path.join(base_path, folder_name),
+                            static_file.name, layout))
+                    directory = os.path.dirname(path)
+                    if 'url' in result and directory not in manifests:
+                        manifests[directory] = static_pipeline.read_manifest(
+                            directory)
+                    asset = manifests.get(directory, {}).get(
+                        static_file.name)
+                    if (asset and static_file.content_hash
+                            and asset['hash'] == static_file.content_hash):
+                        url = '/galatea-static/%s/%s' % (
+                            folder_name, asset['fingerprint'])
+                    else:
+                        url = '/galatea-static/%s/%s' % (
+                            folder_name, static_file.name)
+                        if static_file.content_hash:
+                            # The content changes the url so it can be
+                            # cached forever
+                            url += '?v=%s' % static_file.content_hash[:16]
+            else:
+                path = url = static_file.remote_path
+            if 'file_path' in result:
+                result['file_path'][static_file.id] = path
+            if 'url' in result:
+                result['url'][static_file.id] = url
+        return result
 
     def get_file_path(self, name):
         """
@@ -166,11 +1078,13 @@ class GalateaStaticFile(ModelSQL, ModelView):
         :param name: Field name
         :return: File path
         """
-        return (os.path.abspath(
-                os.path.join(
-                    self.get_galatea_base_path(),
-                    self.folder.name, self.name))
-            if self.type == 'local' else self.remote_path)
+        return self.get_paths([self], ['file_path'])['file_path'][self.id]
+
+    def get_url(self, name):
+        """Return the url if within an active request context or return
+        False values
+        """
+        return self.get_paths([self], ['url'])['url'][self.id]
 
     @staticmethod
     def get_galatea_base_path():
@@ -182,17 +1096,45 @@ class GalateaStaticFile(ModelSQL, ModelView):
 
         <Tryton Data Path>/<Database Name>/galatea
         """
-        return os.path.join(config.get('database', 'path'),
-            Transaction().database.name, "galatea")
+        database_name = Transaction().database.name
+        path = _base_paths.get(database_name)
+        if path is None:
+            path = _base_paths[database_name] = os.path.join(
+                config.get('database', 'path'), database_name, "galatea")
+        return path
 
-    def get_url(self, name):
-        """Return the url if within an active request context or return
-        False values
-        """
-        if self.type == 'local':
-            return '/galatea-static/%s/%s' % (self.folder.name, self.name)
-        elif self.type == 'remote':
-            return self.remote_path
+    @classmethod
+    def lookup(cls, folder_name, file_name):
+        '''
+        Return a tuple (id, path) of the local file named file_name in the
+        folder named folder_name or None.
+        It resolves /galatea-static/<folder name>/<file name> urls.
+        '''
+        key = (Transaction().database.name, folder_name, file_name)
+        result = cls._lookup_cache.get(key, -1)
+        if result != -1:
+            return result
+
+        Folder = Pool().get('galatea.static.folder')
+        static_file = cls.__table__()
+        folder = Folder.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*static_file.join(folder,
+                condition=static_file.folder == folder.id
+                ).select(static_file.id, folder.layout,
+                where=(folder.name == folder_name)
+                & (static_file.name == file_name)
+                & (static_file.type == 'local'),
+                limit=1))
+        row = cursor.fetchone()
+        result = None
+        if row:
+            id_, layout = row
+            result = (id_, os.path.abspath(static_layout.file_path(
+                        os.path.join(cls.get_galatea_base_path(),
+                            folder_name), file_name, layout)))
+        cls._lookup_cache.set(key, result)
+        return result
 
     @classmethod
     def validate(cls, static_files):
@@ -211,16 +1153,21 @@ class GalateaStaticFile(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        for vals in vlist:
-            vals['name'] = slugify_file(vals['name'])
-        return super(GalateaStaticFile, cls).create(vlist)
+        vlist = [v.copy() for v in vlist]
+        names = slugify_files([v['name'] for v in vlist])
+        for vals, name in zip(vlist, names):
+            vals['name'] = name
+        files = super(GalateaStaticFile, cls).create(vlist)
+        cls._lookup_cache.clear()
+        return files
 
     @classmethod
-    def write(cls, files, values):
+    def write(cls, files, values, *args):
         # TODO: Why? maybe a warning
         # if values.get('name'):
         #     raise UserError(gettext('galatea.change_file_name'))
-        return super(GalateaStaticFile, cls).write(files, values)
+        super(GalateaStaticFile, cls).write(files, values, *args)
+        cls._lookup_cache.clear()
 
     @classmethod
     def copy(cls, files, default=None):
@@ -228,7 +1175,112 @@ class GalateaStaticFile(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, files):
+        digests = []
+        to_remove = {}
         for f in files:
-            if f.type == 'local' and os.path.exists(f.file_path):
-                os.remove(f.file_path)
+            if f.type == 'local' and f.file_path:
+                directory, name = os.path.split(f.file_path)
+                to_remove.setdefault(directory, []).append(name)
+                if os.path.exists(f.file_path):
+                    os.remove(f.file_path)
+            digests.append(f.content_hash)
+        for directory, names in to_remove.items():
+            static_pipeline.remove(directory, names)
         super(GalateaStaticFile, cls).delete(files)
+        cls._lookup_cache.clear()
+        if cls.content_addressed():
+            cls._release_blobs(digests)
+
+
+class GalateaStaticFileImportStart(ModelView):
+    'Galatea Static File Import Start'
+    __name__ = 'galatea.static.file.import.start'
+    archive = fields.Binary('Archive', filename='archive_name',
+        help='A zip or tar archive')
+    archive_name = fields.Char('Archive Name')
+    path = fields.Char('Server Path',
+        help='A directory or an archive on the server, inside the '
+        'galatea/import_path directory of the configuration')
+    folder = fields.Many2One('galatea.static.folder', 'Folder',
+        help='The folder of all the files. Leave empty to use the first '
+        'directory of each file as its folder.')
+
+
+class GalateaStaticFileImportResult(ModelView):
+    'Galatea Static File Import Result'
+    __name__ = 'galatea.static.file.import.result'
+    info = fields.Text('Info', readonly=True)
+
+
+class GalateaStaticFileImport(Wizard):
+    'Galatea Static File Import'
+    __name__ = 'galatea.static.file.import'
+    start = StateView('galatea.static.file.import.start',
+        'galatea.galatea_static_file_import_start', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('galatea.static.file.import.result',
+        'galatea.galatea_static_file_import_result', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
+
+    def default_start(self, fields):
+        context = Transaction().context
+        if (context.get('active_model') == 'galatea.static.folder'
+                and len(context.get('active_ids') or []) == 1):
+            return {
+                'folder': context['active_id'],
+                }
+        return {}
+
+    def get_source(self):
+        "Return the path or the file object to import"
+        if self.start.path:
+            root = config.get('galatea', 'import_path')
+            path = os.path.realpath(self.start.path)
+            if not root or os.path.commonpath(
+                    [os.path.realpath(root), path]) != os.path.realpath(root):
+                raise UserError(gettext('galatea.msg_import_path_not_allowed',
+                        path=self.start.path))
+            if not os.path.exists(path):
+                raise UserError(gettext('galatea.msg_not_dir_exist',
+                        directory=self.start.path))
+            return path
+        elif self.start.archive:
+            # Spool the archive to disk so it is not kept twice in memory
+            source = tempfile.SpooledTemporaryFile(
+                max_size=config.getint('galatea', 'import_spool_size',
+                    default=16 * 1024 * 1024))
+            source.write(self.start.archive)
+            source.seek(0)
+            self.start.archive = None
+            return source
+        raise UserError(gettext('galatea.msg_import_missing_source'))
+
+    def transition_import_(self):
+        import tarfile
+        StaticFile = Pool().get('galatea.static.file')
+        source = self.get_source()
+        try:
+            files, size, elapsed = StaticFile.import_files(source,
+                folder=self.start.folder)
+        except (tarfile.TarError, zipfile.BadZipFile) as exception:
+            raise UserError(gettext('galatea.msg_import_invalid_archive',
+                    error=exception)) from exception
+        except static_import.ImportLimitError as exception:
+            raise UserError(gettext('galatea.msg_import_too_large',
+                    error=exception)) from exception
+        finally:
+            if not isinstance(source, str):
+                source.close()
+        self.result.info = gettext('galatea.msg_import_info',
+            files=files, size=size, seconds='%.1f' % elapsed,
+            rate='%.1f' % (files / elapsed if elapsed else 0))
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'info': self.result.info,
+            }
@@ -0,0 +1,134 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import os
+import stat
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+__all__ = ['ImportLimitError', 'open_source', 'import_source']
+
+
+class ImportLimitError(ValueError):
+    "A file or the whole source is larger than the import limits"
+
+
+def clean_path(path):
+    '''
+    Return the parts of the relative path of a member or None if it is
+    unsafe (absolute, parent references) or hidden (any part starts with .)
+    '''
+    parts = [p for p in path.replace('\\', '/').split('/') if p not in
+        ('', '.')]
+    if not parts or path.startswith('/'):
+        return
+    if any(p == '..' or p.startswith('.') or p == '__MACOSX' for p in parts):
+        return
+    return parts
+
+
+def _directory_members(directory):
+    # The symbolic links are not followed so only the files of directory
+    # are imported
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            path = os.path.join(root, name)
+            stat_ = os.lstat(path)
+            if stat.S_ISREG(stat_.st_mode):
+                yield (os.path.relpath(path, directory), stat_.st_size,
+                    partial(open, path, 'rb'))
+
+
+def _zip_members(archive):
+    # ZipExtFile reads at most file_size bytes
+    for info in archive.infolist():
+        if not info.is_dir():
+            yield info.filename, info.file_size, partial(archive.open, info)
+
+
+def _tar_members(archive):
+    for member in archive:
+        if member.isfile():
+            yield (member.name, member.size,
+                partial(archive.extractfile, member))
+
+
+@contextmanager
+def open_source(source):
+    '''
+    Open a directory, a zip or tar (optionally compressed) archive path or
+    binary file object.
+
+    Yield a tuple of the iterator of (path, size, open) of its regular
+    files and whether the files can be read in parallel. Tar archives are
+    read as a stream so their members must be read in order.
+    '''
+    if isinstance(source, str) and os.path.isdir(source):
+        yield _directory_members(source), True
+        return
+    is_zip = zipfile.is_zipfile(source)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    if is_zip:
+        # Members of a ZipFile can be read by several threads
+        with zipfile.ZipFile(source) as archive:
+            yield _zip_members(archive), True
+    else:
+        import tarfile
+        if isinstance(source, str):
+            archive = tarfile.open(source, mode='r|*')
+        else:
+            archive = tarfile.open(fileobj=source, mode='r|*')
+        with archive:
+            yield _tar_members(archive), False
+
+
+def _check_limits(members, max_file_size, max_size):
+    total = 0
+    for parts, size, open_ in members:
+        if max_file_size is not None and size > max_file_size:
+            raise ImportLimitError('"%s" is larger than %s bytes'
+                % ('/'.join(parts), max_file_size))
+        total += size
+        if max_size is not None and total > max_size:
+            raise ImportLimitError(
+                'The files are larger than %s bytes' % max_size)
+        yield parts, open_
+
+
+def import_source(source, write, workers=None, max_file_size=None,
+        max_size=None):
+    '''
+    Call write(parts, file object) for each regular file of source whose
+    path is safe. Files are streamed to write, on a thread pool when the
+    source allows it.
+
+    :param source: a directory, an archive path or binary file object
+    :param write: the function writing a file, parts is the list of the
+        path components
+    :param workers: the number of threads
+    :param max_file_size: the maximum size of a file in bytes
+    :param max_size: the maximum size of all the files in bytes
+    :raise ImportLimitError: when a limit is exceeded
+    :return: the list of the results of write
+    '''
+    def job(member):
+        parts, open_ = member
+        with open_() as file_:
+            return write(parts, file_)
+
+    with open_source(source) as (members, parallel):
+        members = ((parts, size, open_) for parts, size, open_ in (
+                (clean_path(path), size, open_)
+                for path, size, open_ in members)
+            if parts)
+        members = _check_limits(members, max_file_size, max_size)
+        if not parallel or workers == 1:
+            return [job(m) for m in members]
+        if workers is None:
+            workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(job, members))
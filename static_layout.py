@@ -0,0 +1,222 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from . import static_pipeline
+from .sitemap import iter_chunks
+
+__all__ = ['FLAT', 'SHARDED', 'MARKER', 'asset_source', 'relative_path',
+    'file_path', 'get_layout', 'set_layout', 'iter_files',
+    'iter_directories', 'group_by_directory', 'link_files', 'remove_stale',
+    'collect']
+
+# <folder>/<name>
+FLAT = 'flat'
+# <folder>/<ab>/<cd>/<name> where abcd starts the SHA-1 of the source name
+SHARDED = 'sharded'
+# Marker file of the sharded folders for the servers without database
+MARKER = '.sharded'
+# name.<first 12 characters of the SHA-256>.ext of static_pipeline
+_FINGERPRINTED = re.compile(r'^(.+)\.[0-9a-f]{12}(\.[^.]+)?$')
+_SHARD = re.compile(r'^[0-9a-f]{2}$')
+
+
+def asset_source(name):
+    '''
+    Return the name of the source of a compressed or fingerprinted asset
+    name or None if it is not an asset name
+    '''
+    if name.endswith(('.gz', '.br')):
+        source = name[:-3]
+        return asset_source(source) or source
+    match = _FINGERPRINTED.match(name)
+    if match:
+        return match.group(1) + (match.group(2) or '')
+
+
+@lru_cache(maxsize=65536)
+def relative_path(name, layout):
+    '''
+    Return the path of the file name relative to its folder directory.
+    The assets are sharded by their source name so they stay next to it.
+    '''
+    if layout != SHARDED:
+        return name
+    digest = hashlib.sha1(
+        (asset_source(name) or name).encode('utf-8')).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], name)
+
+
+def file_path(directory, name, layout):
+    "Return the path of the file name in the folder directory"
+    return os.path.join(directory, relative_path(name, layout))
+
+
+def get_layout(directory):
+    "Return the layout of the folder directory from its marker file"
+    if os.path.exists(os.path.join(directory, MARKER)):
+        return SHARDED
+    return FLAT
+
+
+def set_layout(directory, layout):
+    "Create or remove the marker file of the folder directory"
+    marker = os.path.join(directory, MARKER)
+    if layout == SHARDED:
+        if not os.path.exists(marker):
+            with open(marker, 'w'):
+                pass
+    else:
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+
+def _iter_entries(directory, files=True):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if files:
+                if (not entry.name.startswith('.')
+                        and entry.is_file(follow_symlinks=False)):
+                    yield entry
+            elif (_SHARD.match(entry.name)
+                    and entry.is_dir(follow_symlinks=False)):
+                yield entry
+
+
+def iter_directories(directory, layout):
+    "Yield the directories of the files of the folder directory in layout"
+    if layout != SHARDED:
+        yield directory
+        return
+    for first in _iter_entries(directory, files=False):
+        for second in _iter_entries(first.path, files=False):
+            yield second.path
+
+
+def iter_files(directory, layout):
+    '''
+    Yield the os.DirEntry of the files of the folder directory in layout.
+    Hidden files are skipped.
+    '''
+    for sub_directory in iter_directories(directory, layout):
+        yield from _iter_entries(sub_directory)
+
+
+def group_by_directory(directory, files, layout):
+    '''
+    Return a dictionary of directory: {name: value} of the files (name:
+    value) of the folder directory in layout
+    '''
+    groups = {}
+    for name, value in files.items():
+        path = file_path(directory, name, layout)
+        groups.setdefault(os.path.dirname(path), {})[name] = value
+    return groups
+
+
+def _link_job(job):
+    source, path = job
+    os.makedirs(os.path.dirname(path), 0o775, exist_ok=True)
+    static_pipeline.link_file(source, path)
+
+
+def link_files(directory, layout, workers=None, batch_size=1000):
+    '''
+    Hard link the files and the assets of the folder directory to their
+    path in layout, by batches on a thread pool, and copy the manifest
+    entries. The current paths and the marker file are kept so the files
+    are still served during the migration, remove_stale removes them and
+    sets the marker file once the folder uses layout.
+
+    :return: the number of files linked
+    '''
+    other = FLAT if layout == SHARDED else SHARDED
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entries in iter_chunks(iter_files(directory, other), batch_size):
+            jobs = [(e.path, file_path(directory, e.name, layout))
+                for e in entries]
+            for _ in executor.map(_link_job, jobs):
+                count += 1
+
+    for sub_directory in list(iter_directories(directory, other)):
+        manifest = static_pipeline.read_manifest(sub_directory)
+        for target, entries in group_by_directory(
+                directory, manifest, layout).items():
+            static_pipeline.merge_manifest(target, entries)
+    return count
+
+
+def remove_stale(directory, layout):
+    '''
+    Remove the paths of the other layout left by link_files in the folder
+    directory which uses layout. Nothing is removed until the marker file
+    of the folder is set to layout, when the migration is committed.
+
+    A file at the top of a sharded folder is kept when it is newer than its
+    sharded path (collect moves it), the sharded paths of a flat folder are
+    removed when the file exists at the top.
+
+    :return: the number of files removed
+    '''
+    if get_layout(directory) != layout:
+        return 0
+    other = FLAT if layout == SHARDED else SHARDED
+    removed = 0
+    for entry in list(iter_files(directory, other)):
+        try:
+            stat = os.stat(file_path(directory, entry.name, layout))
+        except FileNotFoundError:
+            continue
+        entry_stat = entry.stat(follow_symlinks=False)
+        if (layout == SHARDED
+                and entry_stat.st_ino != stat.st_ino
+                and entry_stat.st_mtime > stat.st_mtime):
+            continue
+        os.remove(entry.path)
+        removed += 1
+
+    manifests = [static_pipeline.MANIFEST, static_pipeline.MANIFEST + '.lock']
+    if layout == SHARDED:
+        for name in manifests:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    else:
+        for sub_directory in list(iter_directories(directory, SHARDED)):
+            for name in manifests:
+                try:
+                    os.remove(os.path.join(sub_directory, name))
+                except FileNotFoundError:
+                    pass
+            for path in (sub_directory, os.path.dirname(sub_directory)):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # Not empty
+                    pass
+    return removed
+
+
+def collect(directory):
+    '''
+    Move the files added at the top of the sharded folder directory to
+    their sharded path
+
+    :return: the number of files moved
+    '''
+    count = 0
+    for entry in list(iter_files(directory, FLAT)):
+        path = file_path(directory, entry.name, SHARDED)
+        os.makedirs(os.path.dirname(path), 0o775, exist_ok=True)
+        os.replace(entry.path, path)
+        count += 1
+    return count
@@ -0,0 +1,279 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ['MANIFEST', 'fingerprint_name', 'is_compressible', 'link_file',
+    'build', 'build_files', 'build_folder', 'remove', 'read_manifest',
+    'merge_manifest']
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '.manifest.json'
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/xml',
+    'application/rss+xml', 'application/atom+xml', 'application/wasm',
+    'application/vnd.ms-fontobject', 'application/x-font-ttf',
+    'font/ttf', 'font/otf', 'image/svg+xml', 'image/x-icon',
+    'image/vnd.microsoft.icon',
+    }
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+CHUNK_SIZE = 64 * 1024
+# Compression levels (gzip, brotli) of the builds and of the fast builds
+# done while a file is written
+LEVELS = (9, 11)
+FAST_LEVELS = (6, 5)
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def fingerprint_name(name, digest):
+    "Return name with the first 12 characters of digest before the extension"
+    stem, ext = os.path.splitext(name)
+    return '%s.%s%s' % (stem, digest[:12], ext)
+
+
+def is_compressible(name):
+    type_, encoding = mimetypes.guess_type(name)
+    if encoding or not type_:
+        return False
+    return type_.startswith('text/') or type_ in COMPRESSIBLE_TYPES
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix='.build-')
+    try:
+        with os.fdopen(fd, 'wb') as file_:
+            write(file_)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def link_file(source, path):
+    "Atomically replace path by a hard link to source"
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix='.link-')
+    os.close(fd)
+    os.unlink(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        # Hard links are not supported, fallback to a copy
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _gzip(source, path, level):
+    def write(file_):
+        with open(source, 'rb') as reader, gzip.GzipFile(
+                filename='', mode='wb', fileobj=file_, compresslevel=level,
+                mtime=0) as writer:
+            shutil.copyfileobj(reader, writer, CHUNK_SIZE)
+    _atomic_write(path, write)
+
+
+def _brotli(source, path, quality):
+    def write(file_):
+        compressor = brotli.Compressor(quality=quality)
+        with open(source, 'rb') as reader:
+            for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                file_.write(compressor.process(chunk))
+        file_.write(compressor.finish())
+    _atomic_write(path, write)
+
+
+def _remove(paths):
+    "Remove paths and their compressed variants"
+    for path in paths:
+        for name in (path, path + '.gz', path + '.br'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+def build(path, digest=None, fast=False):
+    '''
+    Build the assets of the file at path in its directory: a fingerprinted
+    hard link and, for compressible types, its gzip and brotli variants
+    (next to the file and to the fingerprinted link). With fast, lower
+    compression levels are used.
+
+    :return: the manifest entry of the file
+    '''
+    if digest is None:
+        digest = _digest(path)
+    directory, name = os.path.split(path)
+    fingerprinted = os.path.join(directory, fingerprint_name(name, digest))
+    link_file(path, fingerprinted)
+    entry = {
+        'hash': digest,
+        'fingerprint': os.path.basename(fingerprinted),
+        'encodings': [],
+        }
+    if (is_compressible(name)
+            and os.path.getsize(path) >= MIN_COMPRESS_SIZE):
+        gzip_level, brotli_quality = FAST_LEVELS if fast else LEVELS
+        _gzip(path, fingerprinted + '.gz', gzip_level)
+        link_file(fingerprinted + '.gz', path + '.gz')
+        entry['encodings'].append('gzip')
+        if brotli is not None:
+            _brotli(path, fingerprinted + '.br', brotli_quality)
+            link_file(fingerprinted + '.br', path + '.br')
+            entry['encodings'].append('br')
+    else:
+        _remove([path + '.gz', path + '.br'])
+    return entry
+
+
+def _update_manifest(directory, entries):
+    '''
+    Update the manifest of directory with entries (name: entry or None to
+    remove it) and remove the assets of the replaced versions
+    '''
+    lock_path = os.path.join(directory, MANIFEST + '.lock')
+    with open(lock_path, 'w') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        manifest = _load_manifest(os.path.join(directory, MANIFEST))
+        for name, entry in entries.items():
+            old = manifest.pop(name, None)
+            if old and (entry is None
+                    or old['fingerprint'] != entry['fingerprint']):
+                _remove([os.path.join(directory, old['fingerprint'])])
+            if entry is None:
+                _remove([os.path.join(directory, name + '.gz'),
+                        os.path.join(directory, name + '.br')])
+            else:
+                manifest[name] = entry
+        _atomic_write(os.path.join(directory, MANIFEST),
+            lambda f: f.write(json.dumps(manifest, sort_keys=True).encode()))
+
+
+def _load_manifest(path):
+    try:
+        with open(path, 'rb') as file_:
+            return json.loads(file_.read().decode())
+    except (IOError, ValueError):
+        return {}
+
+
+def _build_job(job):
+    path, digest, fast = job
+    try:
+        return os.path.basename(path), build(path, digest, fast=fast)
+    except OSError:
+        logger.warning('Unable to build %s', path, exc_info=True)
+        return os.path.basename(path), None
+
+
+def _build(directory, files, workers=None, fast=False):
+    '''
+    Build files (name: digest or None) of directory on a thread pool,
+    zlib and brotli release the GIL while they compress
+    '''
+    jobs = [(os.path.join(directory, n), d, fast) for n, d in files.items()
+        if os.path.exists(os.path.join(directory, n))]
+    entries = {}
+    if len(jobs) < 2 or workers == 1:
+        results = map(_build_job, jobs)
+        executor = None
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='galatea-pipeline')
+        results = executor.map(_build_job, jobs)
+    try:
+        for name, entry in results:
+            if entry is not None:
+                entries[name] = entry
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return entries
+
+
+def build_files(directory, files, workers=1, fast=False):
+    '''
+    Build the assets of files in directory and update its manifest
+
+    :param files: a dictionary of file name: content digest or None
+    :param workers: the number of threads, the default of the thread pool
+        if None
+    :param fast: use the fast compression levels
+    '''
+    entries = _build(directory, files, workers=workers, fast=fast)
+    if entries:
+        _update_manifest(directory, entries)
+
+
+def build_folder(directory, names, workers=None):
+    '''
+    Rebuild the assets of names in directory on a thread pool and rewrite
+    its manifest.
+
+    :return: the number of files built
+    '''
+    entries = _build(directory, dict.fromkeys(names), workers=workers)
+    _update_manifest(directory, entries)
+    return len(entries)
+
+
+def remove(directory, names):
+    "Remove the assets of names in directory"
+    if os.path.isdir(directory):
+        _update_manifest(directory, {n: None for n in names})
+
+
+def merge_manifest(directory, entries):
+    "Add the entries (name: entry) to the manifest of directory"
+    if entries:
+        _update_manifest(directory, entries)
+
+
+def read_manifest(directory):
+    "Return the manifest of directory, cached until the file changes"
+    path = os.path.join(directory, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _manifests_lock:
+        cached = _manifests.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    manifest = _load_manifest(path)
+    with _manifests_lock:
+        _manifests[path] = (mtime, manifest)
+    return manifest
@@ -0,0 +1,575 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Standalone server of the /galatea-static/<folder>/<name> urls.
+
+The urls are mapped to the files of the galatea base path
+(<database path>/<database name>/galatea) without Tryton, so the assets do
+not occupy the trytond workers. The layout of each folder is read from its
+marker file. It can run as its own HTTP server, which
+sends the files with os.sendfile:
+
+    python -m trytond.modules.galatea.static_server <base path>
+
+or inside a WSGI or ASGI server with make_wsgi_app or make_asgi_app (the
+base path is read from GALATEA_STATIC_ROOT when it is not given):
+
+    gunicorn 'trytond.modules.galatea.static_server:make_wsgi_app()'
+    uvicorn --factory trytond.modules.galatea.static_server:make_asgi_app
+'''
+import argparse
+import asyncio
+import email.utils
+import mimetypes
+import os
+import re
+import stat
+import threading
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from .static_layout import FLAT, SHARDED, file_path, get_layout
+from .static_pipeline import is_compressible
+from .tools import parse_range, range_not_satisfiable
+
+__all__ = ['PREFIX', 'resolve', 'StaticFiles', 'StaticResponse',
+    'StaticRequestHandler', 'WSGIApp', 'ASGIApp', 'make_wsgi_app',
+    'make_asgi_app', 'serve']
+
+PREFIX = '/galatea-static/'
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# name.<first 12 characters of the SHA-256>.ext of static_pipeline
+_FINGERPRINTED = re.compile(r'^.+\.[0-9a-f]{12}(\.[^.]+)?$')
+# Content-Encoding: extension of the variants built by static_pipeline
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def resolve(path):
+    '''
+    Return the tuple (folder, name) of a /galatea-static/<folder>/<name>
+    path or None. The names follow the rules of
+    GalateaStaticFolder.check_name and GalateaStaticFile.check_file_name
+    and hidden files are never served.
+    '''
+    if not path.startswith(PREFIX):
+        return
+    folder, _, name = path[len(PREFIX):].partition('/')
+    if (not folder or not name
+            or '.' in folder
+            or '..' in name or '/' in name or name.startswith('.')
+            or '\\' in folder + name or '\x00' in folder + name):
+        return
+    return folder, name
+
+
+def _accepts(header, coding):
+    "Return True if the Accept-Encoding header accepts coding"
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() == coding:
+            params = params.replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    return float(params[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def _etag_match(header, etag):
+    "Return True if the If-None-Match header matches etag (weak comparison)"
+    if header.strip() == '*':
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return any((t[2:] if t.startswith('W/') else t) == etag for t in tags)
+
+
+class _OpenFile(object):
+    "Shared file descriptor of the cache, read with positional calls"
+    __slots__ = ('path', 'fd', 'stat', 'checked', 'users', 'evicted')
+
+    def __init__(self, path, fd, stat_, checked):
+        self.path = path
+        self.fd = fd
+        self.stat = stat_
+        self.checked = checked
+        self.users = 0
+        self.evicted = False
+
+
+def _same_file(stat1, stat2):
+    return ((stat1.st_dev, stat1.st_ino, stat1.st_size, stat1.st_mtime_ns)
+        == (stat2.st_dev, stat2.st_ino, stat2.st_size, stat2.st_mtime_ns))
+
+
+class _FileCache(object):
+    '''
+    Least recently used cache of open file descriptors.
+
+    An entry is used without any system call for ttl seconds, then its path
+    is checked again with stat, so a replaced file is served at most ttl
+    seconds after the change. The descriptors are only read with offsets
+    (sendfile, pread) so they are shared by the threads, and an evicted
+    descriptor is closed when its last user releases it.
+    '''
+
+    def __init__(self, size=1024, ttl=1):
+        self.size = size
+        self.ttl = ttl
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _use(self, entry, now=None):
+        if now is not None:
+            entry.checked = now
+        entry.users += 1
+        self._files.move_to_end(entry.path)
+        return entry
+
+    def acquire(self, path):
+        "Return the _OpenFile of the regular file at path or None"
+        now = time.monotonic()
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and now - entry.checked < self.ttl:
+                return self._use(entry)
+        try:
+            stat_ = os.stat(path)
+        except OSError:
+            stat_ = None
+        if stat_ is None or not stat.S_ISREG(stat_.st_mode):
+            with self._lock:
+                entry = self._files.pop(path, None)
+                if entry is not None:
+                    self._discard(entry)
+            return
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and _same_file(entry.stat, stat_):
+                return self._use(entry, now)
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        except OSError:
+            return
+        entry = _OpenFile(path, fd, os.fstat(fd), now)
+        entry.users = 1
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self._discard(old)
+            self._files[path] = entry
+            while len(self._files) > self.size:
+                _, old = self._files.popitem(last=False)
+                self._discard(old)
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and not entry.users:
+                os.close(entry.fd)
+
+    def _discard(self, entry):
+        entry.evicted = True
+        if not entry.users:
+            os.close(entry.fd)
+
+    def clear(self):
+        with self._lock:
+            while self._files:
+                _, entry = self._files.popitem()
+                self._discard(entry)
+
+
+class StaticResponse(object):
+    '''
+    The status, headers and body of a response. The body is count bytes of
+    file from offset or None, close must be called once it is sent.
+    '''
+    __slots__ = ('status', 'headers', 'file', 'offset', 'count', '_cache')
+
+    def __init__(self, status, headers, file_=None, offset=0, count=0,
+            cache=None):
+        self.status = status
+        self.headers = headers
+        self.file = file_
+        self.offset = offset
+        self.count = count
+        self._cache = cache
+
+    def close(self):
+        if self.file is not None:
+            self._cache.release(self.file)
+            self.file = None
+
+    def iter_body(self, chunk_size=CHUNK_SIZE):
+        "Yield the body read with pread"
+        offset, end = self.offset, self.offset + self.count
+        while self.file is not None and offset < end:
+            chunk = os.pread(self.file.fd, min(chunk_size, end - offset),
+                offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+
+class StaticFiles(object):
+    "Build the responses of the /galatea-static/ urls from base_path"
+
+    def __init__(self, base_path, max_age=3600, fd_cache_size=1024,
+            fd_cache_ttl=1):
+        '''
+        :param max_age: the Cache-Control max-age of the files which are
+            not fingerprinted
+        '''
+        self.base_path = os.path.abspath(base_path)
+        self.max_age = max_age
+        self.files = _FileCache(fd_cache_size, fd_cache_ttl)
+        self._layouts = {}
+
+    def _error(self, status, headers=None):
+        return StaticResponse(status,
+            [('Content-Length', '0')] + (headers or []))
+
+    def get(self, method, path, headers, query=''):
+        '''
+        Return the StaticResponse of a request
+
+        :param path: the decoded path of the url
+        :param headers: a dictionary of lower-cased header names: value
+        :param query: the query string of the url
+        '''
+        if method not in {'GET', 'HEAD'}:
+            return self._error(405, [('Allow', 'GET, HEAD')])
+        resolved = resolve(path)
+        if resolved is None:
+            return self._error(404)
+        folder, name = resolved
+        directory = os.path.join(self.base_path, folder)
+        layout = self._get_layout(directory)
+        if layout is None:
+            return self._error(404)
+        file_, encoding = self._acquire(
+            file_path(directory, name, layout), name, headers)
+        if file_ is None:
+            # The folder may be migrating to the other layout
+            other = FLAT if layout == SHARDED else SHARDED
+            file_, encoding = self._acquire(
+                file_path(directory, name, other), name, headers)
+            if file_ is None:
+                return self._error(404)
+        try:
+            return self._response(method, name, query, headers, file_,
+                encoding)
+        except Exception:
+            self.files.release(file_)
+            raise
+
+    def _get_layout(self, directory):
+        '''
+        Return the layout of the folder directory, checked every ttl, or None
+        if it does not exist. Only the existing folders are cached so the
+        requests of random folders do not grow the cache.
+        '''
+        now = time.monotonic()
+        layout, checked = self._layouts.get(directory, (None, None))
+        if layout is None or now - checked >= self.files.ttl:
+            if not os.path.isdir(directory):
+                self._layouts.pop(directory, None)
+                return
+            layout = get_layout(directory)
+            self._layouts[directory] = (layout, now)
+        return layout
+
+    def _acquire(self, path, name, headers):
+        "Return the file of path or of its variant for Accept-Encoding"
+        accept_encoding = headers.get('accept-encoding', '')
+        if accept_encoding and is_compressible(name):
+            for coding, extension in ENCODINGS:
+                if _accepts(accept_encoding, coding):
+                    file_ = self.files.acquire(path + extension)
+                    if file_ is not None:
+                        return file_, coding
+        return self.files.acquire(path), None
+
+    def _response(self, method, name, query, headers, file_, encoding):
+        size = file_.stat.st_size
+        etag = '"%x-%x%s"' % (file_.stat.st_mtime_ns, size,
+            '-' + encoding if encoding else '')
+        last_modified = email.utils.formatdate(file_.stat.st_mtime,
+            usegmt=True)
+        if _FINGERPRINTED.match(name) or 'v=' in query:
+            cache_control = IMMUTABLE
+        else:
+            cache_control = 'public, max-age=%s' % self.max_age
+        common = [
+            ('ETag', etag),
+            ('Last-Modified', last_modified),
+            ('Cache-Control', cache_control),
+            ]
+        if is_compressible(name):
+            common.append(('Vary', 'Accept-Encoding'))
+
+        if_none_match = headers.get('if-none-match')
+        if_modified_since = headers.get('if-modified-since')
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = _etag_match(if_none_match, etag)
+        elif if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                since = None
+            not_modified = (since is not None
+                and int(file_.stat.st_mtime) <= since.timestamp())
+        if not_modified:
+            self.files.release(file_)
+            return StaticResponse(304, common)
+
+        type_, _ = mimetypes.guess_type(name)
+        common += [
+            ('Content-Type', type_ or 'application/octet-stream'),
+            ('Accept-Ranges', 'bytes'),
+            ]
+        if encoding:
+            common.append(('Content-Encoding', encoding))
+
+        byte_range = None
+        if_range = headers.get('if-range')
+        if method == 'GET' and (not if_range
+                or if_range in {etag, last_modified}):
+            range_ = headers.get('range')
+            if range_not_satisfiable(range_, size):
+                self.files.release(file_)
+                return self._error(416, common + [
+                        ('Content-Range', 'bytes */%s' % size)])
+            byte_range = parse_range(range_, size)
+        if byte_range is None:
+            return StaticResponse(200,
+                common + [('Content-Length', str(size))],
+                file_, 0, size, self.files)
+        start, end = byte_range
+        return StaticResponse(206, common + [
+                ('Content-Range', 'bytes %s-%s/%s' % (start, end, size)),
+                ('Content-Length', str(end - start + 1)),
+                ], file_, start, end - start + 1, self.files)
+
+
+class StaticRequestHandler(BaseHTTPRequestHandler):
+    "HTTP handler sending the files with os.sendfile"
+    protocol_version = 'HTTP/1.1'
+    static_files = None
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        response = self.static_files.get(self.command, unquote(path),
+            headers, query)
+        try:
+            self.send_response(response.status)
+            for name, value in response.headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if response.file is not None and self.command == 'GET':
+                self.wfile.flush()
+                self._sendfile(response)
+        finally:
+            response.close()
+
+    do_HEAD = do_GET
+
+    def _sendfile(self, response):
+        offset, remaining = response.offset, response.count
+        socket = self.connection.fileno()
+        while remaining > 0:
+            try:
+                sent = os.sendfile(socket, response.file.fd, offset,
+                    remaining)
+            except BlockingIOError:
+                continue
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WSGIApp(object):
+    '''
+    WSGI application of StaticFiles. The whole files are sent by the
+    wsgi.file_wrapper of the server (sendfile with most of them) and the
+    ranges are read with pread.
+    '''
+
+    def __init__(self, static_files):
+        self.static_files = static_files
+
+    def __call__(self, environ, start_response):
+        try:
+            path = environ.get('PATH_INFO', '').encode('latin-1').decode(
+                'utf-8')
+        except UnicodeError:
+            path = ''
+        headers = {k[5:].replace('_', '-').lower(): v
+            for k, v in environ.items() if k.startswith('HTTP_')}
+        method = environ['REQUEST_METHOD']
+        response = self.static_files.get(method, path, headers,
+            environ.get('QUERY_STRING', ''))
+        start_response('%s %s' % (response.status,
+                HTTPStatus(response.status).phrase), response.headers)
+        if response.file is None or method == 'HEAD':
+            response.close()
+            return []
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if (file_wrapper is not None and response.status == 200
+                and response.count):
+            reader = self._open(response.file)
+            if reader is not None:
+                response.close()
+                return file_wrapper(reader, CHUNK_SIZE)
+        return _Body(response)
+
+    @staticmethod
+    def _open(file_):
+        "Open a reader of its own on the file of the response or None"
+        try:
+            reader = open(file_.path, 'rb')
+        except OSError:
+            return
+        if not _same_file(os.fstat(reader.fileno()), file_.stat):
+            # Replaced since it was checked
+            reader.close()
+            return
+        return reader
+
+
+class _Body(object):
+    "WSGI iterable of a response body which releases its file"
+
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        return self.response.iter_body()
+
+    def close(self):
+        self.response.close()
+
+
+class ASGIApp(object):
+    '''
+    ASGI application of StaticFiles. The files are sent with the
+    http.response.zerocopysend extension (sendfile) when the server
+    supports it, otherwise they are read with pread in a thread.
+    '''
+
+    def __init__(self, static_files):
+        self.static_files = static_files
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.static_files.files.clear()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+            for k, v in scope.get('headers', [])}
+        response = self.static_files.get(scope['method'], scope['path'],
+            headers, scope.get('query_string', b'').decode('latin-1'))
+        try:
+            await send({
+                    'type': 'http.response.start',
+                    'status': response.status,
+                    'headers': [(k.lower().encode('latin-1'),
+                            v.encode('latin-1'))
+                        for k, v in response.headers],
+                    })
+            if response.file is None or scope['method'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            extensions = scope.get('extensions') or {}
+            if 'http.response.zerocopysend' in extensions:
+                # The descriptor is shared, the server reads it at offset
+                with open(response.file.fd, 'rb', closefd=False) as file_:
+                    await send({
+                            'type': 'http.response.zerocopysend',
+                            'file': file_,
+                            'offset': response.offset,
+                            'count': response.count,
+                            })
+                return
+            loop = asyncio.get_running_loop()
+            offset, end = response.offset, response.offset + response.count
+            while offset < end:
+                chunk = await loop.run_in_executor(None, os.pread,
+                    response.file.fd, min(CHUNK_SIZE, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                        })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            response.close()
+
+
+def _get_static_files(base_path=None, **options):
+    if base_path is None:
+        base_path = os.environ['GALATEA_STATIC_ROOT']
+    return StaticFiles(base_path, **options)
+
+
+def make_wsgi_app(base_path=None, **options):
+    "Return the WSGIApp of base_path (GALATEA_STATIC_ROOT by default)"
+    return WSGIApp(_get_static_files(base_path, **options))
+
+
+def make_asgi_app(base_path=None, **options):
+    "Return the ASGIApp of base_path (GALATEA_STATIC_ROOT by default)"
+    return ASGIApp(_get_static_files(base_path, **options))
+
+
+def serve(base_path, host='127.0.0.1', port=8010, **options):
+    "Serve the files of base_path over HTTP with os.sendfile"
+    handler = type('Handler', (StaticRequestHandler,), {
+            'static_files': StaticFiles(base_path, **options),
+            })
+    with ThreadingHTTPServer((host, port), handler) as server:
+        server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the /galatea-static/ urls')
+    parser.add_argument('base_path',
+        help='the galatea base path: <database path>/<database>/galatea')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--max-age', type=int, default=3600)
+    parser.add_argument('--fd-cache', type=int, default=1024,
+        help='the number of open files kept')
+    options = parser.parse_args()
+    serve(options.base_path, options.host, options.port,
+        max_age=options.max_age, fd_cache_size=options.fd_cache)
+
+
+if __name__ == '__main__':
+    main()
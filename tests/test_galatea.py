@@ -3,15 +3,1054 @@
 # copyright notices and license terms.
 import unittest
 import doctest
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import zipfile
+from email.mime.text import MIMEText
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from unittest.mock import ANY, Mock, patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_teardown, doctest_checker
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+
+
+def create_smtp_server():
+    "Create a validated SMTP server"
+    SMTPServer = Pool().get('smtp.server')
+    server, = SMTPServer.create([{
+                'name': 'SMTP',
+                'smtp_server': 'localhost',
+                'smtp_email': 'noreply@example.com',
+                'state': 'done',
+                }])
+    return server
+
+
+def create_website(company, name='website', **values):
+    "Create a website of the company"
+    pool = Pool()
+    Country = pool.get('country.country')
+    Website = pool.get('galatea.website')
+    country, = Country.search([('code', '=', 'ES')]) or Country.create([{
+                'name': 'Spain',
+                'code': 'ES',
+                }])
+    website, = Website.create([dict({
+                    'name': name,
+                    'uri': 'http://%s/' % name,
+                    'folder': '/tmp',
+                    'static_folder': 'static',
+                    'country': country.id,
+                    'currency': company.currency.id,
+                    'smtp_server': create_smtp_server().id,
+                    }, **values)])
+    return website
+
+
+def patch_static_storage(test, content_addressed=False):
+    """Store the static files of test in a temporary directory without
+    building the assets and return the directory"""
+    StaticFile = Pool().get('galatea.static.file')
+    base_path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, base_path)
+    for name, value in [
+            ('get_galatea_base_path', base_path),
+            ('static_pipeline', False),
+            ('content_addressed', content_addressed),
+            ]:
+        patcher = patch.object(StaticFile, name, return_value=value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return base_path
+
+
+def commit_files():
+    "Apply the file system changes of the transaction as if committed"
+    from trytond.modules.galatea.static_file import FilesDataManager
+    transaction = Transaction()
+    transaction.join(FilesDataManager()).tpc_finish(transaction)
+
+
+def rollback_files():
+    "Undo the file system changes of the transaction as if rolled back"
+    from trytond.modules.galatea.static_file import FilesDataManager
+    transaction = Transaction()
+    transaction.join(FilesDataManager()).tpc_abort(transaction)
 
 
 class GalateaTestCase(ModuleTestCase):
     'Test Galatea module'
     module = 'galatea'
 
+    def test_password_hashers(self):
+        'Test password hashers'
+        from trytond.modules.galatea.password import (get_hasher,
+            hash_password, verify_password)
+
+        for name in ('pbkdf2_sha256', 'scrypt'):
+            hashed = hash_password('secret', get_hasher(name))
+            self.assertTrue(hashed.startswith(name + '$'))
+            self.assertEqual(verify_password('secret', hashed)[0], True)
+            self.assertEqual(verify_password('wrong', hashed), (False, False))
+            self.assertEqual(verify_password('secret', name + '$1$bad'),
+                (False, False))
+
+        legacy = hashlib.sha1(b'secretSALT1234').hexdigest()
+        self.assertEqual(verify_password('secret', legacy, 'SALT1234'),
+            (True, True))
+        self.assertEqual(verify_password('wrong', legacy, 'SALT1234'),
+            (False, False))
+        legacy = hashlib.sha1('sécret'.encode('utf-8')).hexdigest()
+        self.assertEqual(verify_password('sécret', legacy), (True, True))
+        self.assertEqual(verify_password('secret', 'é' * 40), (False, False))
+
+        # The argon2-cffi package is not installed
+        with patch.dict('sys.modules', {'argon2': None}):
+            self.assertEqual(verify_password('secret', 'argon2$$v=19$m'),
+                (False, False))
+
+    @with_transaction()
+    def test_register_users(self):
+        'Test bulk user registration'
+        pool = Pool()
+        Country = pool.get('country.country')
+        Party = pool.get('party.party')
+        User = pool.get('galatea.user')
+        Website = pool.get('galatea.website')
+
+        company = create_company()
+        with set_company(company):
+            country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+            server = create_smtp_server()
+            registration, other = Website.create([{
+                        'name': name,
+                        'uri': 'http://%s/' % name,
+                        'folder': '/tmp',
+                        'static_folder': 'static',
+                        'country': country.id,
+                        'currency': company.currency.id,
+                        'smtp_server': server.id,
+                        'registration': name == 'registration',
+                        } for name in ['registration', 'other']])
+            party, = Party.create([{'name': 'Customer'}])
+
+            def values(email, **kwargs):
+                return dict(party=party.id, display_name='Customer',
+                    email=email, password='secret', **kwargs)
+
+            user, user_other = User.register_users([
+                    values('A@example.com'),
+                    values('b@example.com', websites=[other.id]),
+                    ])
+            self.assertEqual(user.email_normalized, 'a@example.com')
+            self.assertEqual(user.websites, (registration,))
+            self.assertEqual(user_other.websites, (other,))
+            self.assertTrue(user.check_password('secret'))
+
+            # Duplicated in the batch
+            with self.assertRaises(UserError):
+                User.register_users([
+                        values('c@example.com'), values('C@example.com')])
+            # Duplicated with an existing user
+            with self.assertRaises(UserError):
+                User.register_users([values('a@example.com')])
+            users = User.register_users([
+                    values('a@example.com'),
+                    values('d@example.com'),
+                    values('D@example.com'),
+                    ], skip_existing=True)
+            self.assertEqual([u.email for u in users], ['d@example.com'])
+            self.assertEqual(users[0].websites, (registration,))
+
+    @with_transaction()
+    def test_website_snapshot(self):
+        'Test website snapshots are invalidated on changes'
+        pool = Pool()
+        Country = pool.get('country.country')
+        Website = pool.get('galatea.website')
+        WebsiteCountry = pool.get('galatea.website-country.country')
+
+        company = create_company()
+        with set_company(company):
+            website = create_website(company)
+            snapshot = Website.get_snapshot(website)
+            self.assertEqual(snapshot.name, 'website')
+            self.assertEqual(snapshot.countries, ())
+            self.assertIs(Website.get_snapshot(website.id), snapshot)
+            self.assertIs(
+                Website.get_snapshot_by_uri('http://website/'), snapshot)
+            self.assertEqual(Website.get_registration_websites(), [])
+
+            Website.write([website], {
+                    'name': 'New',
+                    'uri': 'http://new/',
+                    'registration': True,
+                    })
+            snapshot = Website.get_snapshot(website)
+            self.assertEqual(snapshot.name, 'New')
+            self.assertEqual(snapshot.uri, 'http://new/')
+            self.assertIsNone(Website.get_snapshot_by_uri('http://website/'))
+            self.assertEqual(
+                Website.get_snapshot_by_uri('http://new/'), snapshot)
+            self.assertEqual(
+                Website.get_registration_websites(), [website.id])
+
+            # The changes of the relations invalidate them too
+            country, = Country.create([{'name': 'France', 'code': 'FR'}])
+            WebsiteCountry.create([{
+                        'website': website.id,
+                        'country': country.id,
+                        }])
+            self.assertEqual(
+                Website.get_snapshot(website).countries, (country.id,))
+
+    @with_transaction()
+    def test_reset_password(self):
+        'Test password reset of users in several languages'
+        from email import message_from_string
+        pool = Pool()
+        EmailQueue = pool.get('galatea.email.queue')
+        Lang = pool.get('ir.lang')
+        Party = pool.get('party.party')
+        User = pool.get('galatea.user')
+
+        company = create_company()
+        with set_company(company):
+            website = create_website(company)
+            es, = Lang.search([('code', '=', 'es')])
+            users = User.create([{
+                        'party': Party.create([{
+                                    'name': name,
+                                    'lang': lang,
+                                    }])[0].id,
+                        'display_name': name,
+                        'email': '%s@example.com' % name,
+                        'password': 'secret',
+                        'websites': [('add', [website.id])],
+                        } for name, lang in [
+                        ('ana', es.id), ('bob', None), ('eva', es.id)]])
+            templates = {
+                'galatea.msg_email_subject': '%(website)s [{lang}]',
+                'galatea.msg_email_text': '{lang} %(name)s %(password)s',
+                }
+            passwords = ['password-%s' % u.display_name for u in users]
+
+            with patch('trytond.modules.galatea.galatea.gettext',
+                    side_effect=lambda name, lang: templates[name].format(
+                        lang=lang)) as gettext, \
+                    patch.object(User, 'random_password',
+                        side_effect=passwords):
+                User.reset_password(users)
+            # The templates are rendered once per language
+            self.assertEqual(sorted(c[0] for c in gettext.call_args_list), [
+                    ('galatea.msg_email_subject', 'en'),
+                    ('galatea.msg_email_subject', 'es'),
+                    ('galatea.msg_email_text', 'en'),
+                    ('galatea.msg_email_text', 'es'),
+                    ])
+
+            emails = {e.to: e for e in EmailQueue.search([])}
+            self.assertEqual(len(emails), 3)
+            for user, password, lang in zip(users, passwords,
+                    ['es', 'en', 'es']):
+                user = User(user.id)
+                self.assertFalse(user.check_password('secret'))
+                self.assertTrue(user.check_password(password))
+                self.assertNotEqual(user.password, password)
+
+                email = emails[user.email]
+                self.assertEqual(email.subject, 'website [%s]' % lang)
+                body = message_from_string(email.message).get_payload(
+                    decode=True).decode('utf-8')
+                self.assertEqual(body, '%s %s %s' % (
+                        lang, user.display_name, password))
+
+    @with_transaction()
+    def test_get_user(self):
+        'Test login user lookup and its miss cache'
+        pool = Pool()
+        Party = pool.get('party.party')
+        User = pool.get('galatea.user')
+        UserWebsite = pool.get('galatea.user-galatea.website')
+
+        company = create_company()
+        with set_company(company):
+            website = create_website(company)
+            party, = Party.create([{'name': 'Customer'}])
+            user, other = User.create([{
+                        'party': party.id,
+                        'display_name': 'Customer',
+                        'email': email,
+                        'password': 'secret',
+                        'websites': websites,
+                        } for email, websites in [
+                        ('User@Example.com', [('add', [website.id])]),
+                        ('other@example.com', []),
+                        ]])
+            request = Mock(form={'email': ' USER@example.com '},
+                remote_addr='127.0.0.1', headers={})
+            self.assertEqual(User.get_user(website, request), [user])
+
+            # The users of other websites are unknown
+            request.form = {'email': 'other@example.com'}
+            self.assertEqual(User.get_user(website, request), [])
+            with patch.object(User, '_get_user_query') as query:
+                self.assertEqual(User.get_user(website, request), [])
+                query.assert_not_called()
+
+            UserWebsite.create([{'user': other.id, 'website': website.id}])
+            self.assertEqual(User.get_user(website, request), [other])
+
+            UserWebsite.delete(UserWebsite.search([('user', '=', other.id)]))
+            self.assertEqual(User.get_user(website, request), [])
+            User.write([other], {'websites': [('add', [website.id])]})
+            self.assertEqual(User.get_user(website, request), [other])
+
+    @with_transaction()
+    def test_session_user(self):
+        'Test session user snapshots and their cache key'
+        pool = Pool()
+        Party = pool.get('party.party')
+        User = pool.get('galatea.user')
+
+        company = create_company()
+        with set_company(company):
+            website = create_website(company)
+            party, = Party.create([{'name': 'Customer'}])
+            user, = User.create([{
+                        'party': party.id,
+                        'display_name': 'Customer',
+                        'email': 'user@example.com',
+                        'password': 'secret',
+                        'websites': [('add', [website.id])],
+                        }])
+            past = datetime.datetime(2000, 1, 1)
+
+            def age():
+                table = User.__table__()
+                cursor = Transaction().connection.cursor()
+                cursor.execute(*table.update(
+                        [table.create_date, table.write_date], [past, None],
+                        where=table.id == user.id))
+
+            age()
+            self.assertEqual(User._get_session_key(user.id), (user.id, past))
+            session_user = User.load_session_user(str(user.id))
+            self.assertEqual(session_user.id, user.id)
+            self.assertEqual(session_user.display_name, 'Customer')
+            self.assertEqual(session_user.websites, frozenset([website.id]))
+            with patch.object(User, 'get_session_user') as get_session_user:
+                self.assertEqual(
+                    User.load_session_user(user.id).display_name, 'Customer')
+                get_session_user.assert_not_called()
+
+            # A write of the user changes the key so the snapshot is stale
+            User.write([user], {'display_name': 'New Customer'})
+            key = User._get_session_key(user.id)
+            self.assertEqual(key[0], user.id)
+            self.assertNotEqual(key[1], past)
+            self.assertEqual(
+                User.load_session_user(user.id).display_name, 'New Customer')
+
+            # The snapshot of the old key is still cached until touched
+            age()
+            self.assertEqual(
+                User.load_session_user(user.id).display_name, 'Customer')
+            User.touch_sessions([user.id])
+            self.assertNotEqual(User._get_session_key(user.id)[1], past)
+            self.assertEqual(
+                User.load_session_user(user.id).display_name, 'New Customer')
+
+            User.write([user], {'active': False})
+            self.assertIsNone(User.load_session_user(user.id))
+            self.assertIsNone(User.load_session_user('invalid'))
+
+    @with_transaction()
+    def test_sync_files(self):
+        'Test static folder sync'
+        from trytond.modules.galatea import static_layout
+        pool = Pool()
+        Folder = pool.get('galatea.static.folder')
+        StaticFile = pool.get('galatea.static.file')
+
+        patch_static_storage(self)
+        folder, = Folder.create([{'name': 'images'}])
+        directory = folder.get_path()
+        os.makedirs(directory)
+
+        def write(name, data):
+            with open(os.path.join(directory, name), 'wb') as file_:
+                file_.write(data)
+
+        write('logo.png', b'logo')
+        write('My Logo.png', b'my logo')
+        write('a-b.png', b'a-b')
+        write('A B.png', b'A B')
+        # The paths of a rolled back migration to the sharded layout
+        static_layout.link_files(directory, static_layout.SHARDED)
+        sharded = static_layout.file_path(directory, 'logo.png',
+            static_layout.SHARDED)
+
+        result = folder._sync_files()
+        self.assertEqual(result['new'], 3)
+        files = StaticFile.search([('folder', '=', folder.id)],
+            order=[('name', 'ASC')])
+        self.assertEqual([f.name for f in files],
+            ['a-b.png', 'logo.png', 'my-logo.png'])
+        self.assertEqual(files[2].content_hash,
+            hashlib.sha256(b'my logo').hexdigest())
+        # Nothing is renamed nor removed before the commit
+        self.assertTrue(os.path.exists(os.path.join(directory, 'My Logo.png')))
+        self.assertTrue(os.path.exists(sharded))
+
+        commit_files()
+        # "A B.png" is skipped as its slug exists
+        self.assertEqual(sorted(os.listdir(directory)),
+            ['A B.png', 'a-b.png', 'logo.png', 'my-logo.png'])
+        with open(os.path.join(directory, 'my-logo.png'), 'rb') as file_:
+            self.assertEqual(file_.read(), b'my logo')
+
+        write('New File.png', b'new')
+        folder._sync_files()
+        rollback_files()
+        self.assertEqual(sorted(os.listdir(directory)),
+            ['A B.png', 'New File.png', 'a-b.png', 'logo.png', 'my-logo.png'])
+
+    @with_transaction()
+    def test_static_file_blobs(self):
+        'Test static files content-addressed storage'
+        pool = Pool()
+        Folder = pool.get('galatea.static.folder')
+        StaticFile = pool.get('galatea.static.file')
+
+        patch_static_storage(self, content_addressed=True)
+        folder, = Folder.create([{'name': 'css'}])
+
+        def read(static_file):
+            with open(static_file.file_path, 'rb') as file_:
+                return file_.read()
+
+        # The same content is stored once
+        a, b = StaticFile.create([{
+                    'name': name,
+                    'folder': folder.id,
+                    'file_binary': b'body{}',
+                    } for name in ['a.css', 'b.css']])
+        commit_files()
+        digest = hashlib.sha256(b'body{}').hexdigest()
+        self.assertEqual([a.content_hash, b.content_hash], [digest, digest])
+        blob = StaticFile.get_blob_path(digest)
+        self.assertTrue(os.path.samefile(a.file_path, blob))
+        self.assertTrue(os.path.samefile(b.file_path, blob))
+        self.assertEqual(StaticFile.blob_references(digest), 2)
+
+        # Rewriting a file keeps the link of the other
+        StaticFile.write([a], {'file_binary': b'p{}'})
+        commit_files()
+        new_digest = hashlib.sha256(b'p{}').hexdigest()
+        self.assertEqual(read(a), b'p{}')
+        self.assertEqual(read(b), b'body{}')
+        self.assertTrue(os.path.samefile(b.file_path, blob))
+        self.assertEqual(StaticFile.blob_references(digest), 1)
+        self.assertEqual(StaticFile.blob_references(new_digest), 1)
+
+        # A rolled back content leaves no blob nor temporary file
+        StaticFile.write([b], {'file_binary': b'h1{}'})
+        rollback_files()
+        self.assertFalse(os.path.exists(StaticFile.get_blob_path(
+                    hashlib.sha256(b'h1{}').hexdigest())))
+        self.assertEqual(read(b), b'body{}')
+        self.assertEqual(StaticFile.blob_references(digest), 1)
+        self.assertEqual(sorted(os.listdir(folder.get_path())),
+            ['a.css', 'b.css'])
+
+    @with_transaction()
+    def test_static_file_paths(self):
+        'Test static file path and url getters'
+        pool = Pool()
+        Folder = pool.get('galatea.static.folder')
+        StaticFile = pool.get('galatea.static.file')
+
+        folder, = Folder.create([{'name': 'images'}])
+        local, remote = StaticFile.create([{
+                    'name': 'Logo.png',
+                    'folder': folder.id,
+                    }, {
+                    'name': 'cdn.png',
+                    'type': 'remote',
+                    'remote_path': 'https://cdn.example.com/cdn.png',
+                    }])
+        path = os.path.abspath(os.path.join(
+                StaticFile.get_galatea_base_path(), 'images', 'logo.png'))
+        self.assertEqual(local.file_path, path)
+        self.assertEqual(local.get_file_path('file_path'), path)
+        self.assertEqual(local.get_url('url'),
+            '/galatea-static/images/logo.png')
+        self.assertEqual(remote.get_url('url'),
+            'https://cdn.example.com/cdn.png')
+        self.assertEqual(StaticFile.lookup('images', 'logo.png'),
+            (local.id, path))
+        self.assertIsNone(StaticFile.lookup('images', 'cdn.png'))
+
+    @with_transaction()
+    def test_email_queue(self):
+        'Test email queue'
+        pool = Pool()
+        SMTPServer = pool.get('smtp.server')
+        EmailQueue = pool.get('galatea.email.queue')
+
+        server = create_smtp_server()
+        msg = MIMEText('Your password: secret')
+        msg['From'] = 'noreply@example.com'
+        msg['Subject'] = 'Welcome'
+        email, = EmailQueue.enqueue([(server, ['a@example.com'], msg)])
+        self.assertEqual(email.state, 'pending')
+        self.assertIn('Date: ', email.message)
+
+        smtp = Mock()
+        with patch.object(SMTPServer, 'get_smtp_server', return_value=smtp):
+            EmailQueue.send_all()
+            smtp.sendmail.assert_called_once_with('noreply@example.com',
+                ['a@example.com'], ANY)
+            email = EmailQueue(email.id)
+            self.assertEqual(email.state, 'sent')
+            self.assertIsNone(email.message)
+
+            email, = EmailQueue.enqueue([(server, ['b@example.com'], msg)])
+            smtp.sendmail.side_effect = smtplib.SMTPException('Down')
+            EmailQueue.send_all()
+            email = EmailQueue(email.id)
+            self.assertEqual(email.state, 'pending')
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.error, 'Down')
+            self.assertIsNotNone(email.next_attempt)
+            self.assertIsNotNone(email.message)
+
+            # Not sent before the next attempt
+            smtp.sendmail.reset_mock()
+            EmailQueue.send_all()
+            smtp.sendmail.assert_not_called()
+
+            for _ in range(4):
+                EmailQueue.write([email], {'next_attempt': None})
+                EmailQueue.send_all()
+            email = EmailQueue(email.id)
+            self.assertEqual(email.state, 'failed')
+            self.assertEqual(email.attempts, 5)
+
+            EmailQueue.retry([email])
+            smtp.sendmail.side_effect = None
+            EmailQueue.send_all()
+            email = EmailQueue(email.id)
+            self.assertEqual(email.state, 'sent')
+            self.assertEqual(email.attempts, 0)
+
+    @with_transaction()
+    def test_attachment_derivative(self):
+        'Test attachment derivative'
+        from PIL import Image
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Party = pool.get('party.party')
+        User = pool.get('galatea.user')
+
+        company = create_company()
+        with set_company(company):
+            party, other_party = Party.create([
+                    {'name': 'Customer'}, {'name': 'Other'}])
+            user, other_user = User.create([{
+                        'party': p.id,
+                        'display_name': p.name,
+                        'email': '%s@example.com' % p.id,
+                        'password': 'secret',
+                        } for p in [party, other_party]])
+            buffer = io.BytesIO()
+            Image.new('RGB', (800, 400)).save(buffer, 'PNG')
+            attachment, = Attachment.create([{
+                        'name': 'logo.png',
+                        'resource': str(user),
+                        'data': buffer.getvalue(),
+                        'allow_galatea': True,
+                        'galatea_party': True,
+                        }])
+            self.addCleanup(Attachment.evict_galatea_derivatives,
+                [attachment])
+
+            self.assertIsNone(attachment.get_galatea_derivative(200))
+            self.assertIsNone(
+                attachment.get_galatea_derivative(200, user=other_user))
+            path = attachment.get_galatea_derivative(200, user=user)
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (300, 150))
+                self.assertEqual(image.format, 'PNG')
+            path = attachment.get_galatea_derivative(200, format_='webp',
+                crop=True, user=user)
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (300, 300))
+                self.assertEqual(image.format, 'WEBP')
+
+            with patch.object(Attachment, 'get_galatea_derivative_sizes',
+                    return_value=[]):
+                self.assertIsNone(
+                    attachment.get_galatea_derivative(200, user=user))
+
+    def test_slugify(self):
+        'Test slugify'
+        from trytond.modules.galatea.tools import (slugify, slugify_file,
+            slugify_files, unique_file_slug)
+
+        self.assertEqual(slugify('Ça va très bien!'), 'ca-va-tres-bien')
+        self.assertEqual(slugify('Straße Øre'), 'strasse-ore')
+        self.assertEqual(slugify_file('Archive.TAR.gz'), 'archive.tar.gz')
+        self.assertEqual(slugify_file('My Photo.JPG'), 'my-photo.jpg')
+        self.assertEqual(slugify_files(['a b.png', 'C.css', 'a b.png']),
+            ['a-b.png', 'c.css', 'a-b.png'])
+        self.assertEqual(slugify('!!!'), '')
+        self.assertEqual(slugify_file('.htaccess'), 'htaccess')
+        for value in ['日本.png', '!!.png']:
+            slug = slugify_file(value)
+            self.assertRegex(slug, r'^[a-z0-9-]+\.png$')
+            self.assertNotEqual(slug, slugify_file('中国.png'))
+        self.assertRegex(slugify_file('...'), r'^[0-9a-f]{8}$')
+        names = set()
+        self.assertEqual([unique_file_slug(n, names)
+                for n in ['a.tar.gz', 'a.tar.gz', 'b', 'a.tar.gz', 'b']],
+            ['a.tar.gz', 'a-2.tar.gz', 'b', 'a-3.tar.gz', 'b-2'])
+
+    def test_files_datamanager(self):
+        "Test the files are moved on commit and removed on rollback"
+        from trytond.modules.galatea.static_file import FilesDataManager
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        called = []
+
+        def write(name):
+            path = os.path.join(directory, name)
+            with open(path, 'w') as file_:
+                file_.write(name)
+            return path
+
+        datamanager = FilesDataManager()
+        self.assertEqual(datamanager, FilesDataManager())
+        datamanager.move(write('.tmp1'), os.path.join(directory, 'a', 'b'))
+        datamanager.move(write('.tmp2'), None)
+        datamanager.move(write('.tmp3'), os.path.join(directory, 'c'))
+        datamanager.discard(os.path.join(directory, '.tmp3'))
+        datamanager.on_commit(called.append, 'commit')
+        datamanager.on_abort(called.append, 'abort')
+        datamanager.tpc_finish(None)
+        self.assertEqual(sorted(os.listdir(directory)), ['a'])
+        with open(os.path.join(directory, 'a', 'b')) as file_:
+            self.assertEqual(file_.read(), '.tmp1')
+        self.assertEqual(called, ['commit'])
+
+        datamanager.move(write('.tmp4'), os.path.join(directory, 'd'))
+        datamanager.on_commit(called.append, 'commit')
+        datamanager.on_abort(called.append, 'abort')
+        datamanager.tpc_abort(None)
+        self.assertEqual(sorted(os.listdir(directory)), ['a'])
+        self.assertEqual(called, ['commit', 'abort'])
+
+    def test_rate_limiter(self):
+        'Test login rate limiter'
+        from trytond.modules.galatea.rate_limit import (RateLimiter,
+            parse_rule, parse_networks, client_ip)
+
+        self.assertEqual(parse_rule('5/300'), (5, 300))
+        self.assertIsNone(parse_rule('0/60'))
+        limiter = RateLimiter({'email': (2, 60), 'ip': (3, 60)})
+        self.assertIsNone(limiter.hit(email='a', ip='1.1.1.1'))
+        self.assertIsNone(limiter.hit(email='a', ip='1.1.1.1'))
+        self.assertEqual(limiter.hit(email='a', ip='1.1.1.1'), 'email')
+        self.assertIsNone(limiter.hit(email='b', ip='1.1.1.1'))
+        self.assertEqual(limiter.hit(email='c', ip='1.1.1.1'), 'ip')
+        limiter.reset('email', 'a')
+        self.assertIsNone(limiter.hit(email='a', ip='2.2.2.2'))
+        self.assertEqual(limiter.metrics(), {
+                'allowed': 4, 'blocked': 2,
+                'blocked_email': 1, 'blocked_ip': 1,
+                })
+
+        proxies = parse_networks('10.0.0.0/8, 192.168.1.1')
+        self.assertEqual(client_ip('1.1.1.1', '2.2.2.2', proxies), '1.1.1.1')
+        self.assertEqual(
+            client_ip('10.0.0.1', '2.2.2.2, 3.3.3.3, 192.168.1.1', proxies),
+            '3.3.3.3')
+        self.assertEqual(client_ip('10.0.0.1', None, proxies), '10.0.0.1')
+
+    def test_cache_manager_purge(self):
+        'Test cache manager purge'
+        from trytond.modules.galatea import cache_manager
+
+        directory = tempfile.mkdtemp()
+        digest = '0123456789abcdef'
+        for subdirectory in ['', 'thumbs', 'thumbs/big']:
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+            for name in ['logo', 'banner', 'logo-big']:
+                with open(os.path.join(directory, subdirectory,
+                            '%s-%s-300.png' % (name, digest)),
+                        'wb') as file_:
+                    file_.write(b'x' * 10)
+
+        self.assertEqual(
+            cache_manager.purge([directory], sources=['logo.png']), (3, 30))
+        self.assertEqual(
+            cache_manager.purge([directory], prefix='thumbs'), (4, 40))
+        self.assertEqual(sorted(os.listdir(directory)), [
+                'banner-%s-300.png' % digest, 'logo-big-%s-300.png' % digest])
+        self.assertEqual(
+            cache_manager.purge([directory], sources=['logo-big.png']),
+            (1, 10))
+        self.assertEqual(cache_manager.purge([directory]), (1, 10))
+
+    def test_thumbnail(self):
+        'Test thumbnail derivatives'
+        from PIL import Image
+        from trytond.modules.galatea import cache_manager, thumbnail
+        from trytond.modules.galatea.tools import thumbly
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(buffer, 'JPEG')
+        data = buffer.getvalue()
+
+        paths = thumbnail.generate(data, directory, [600, 300],
+            formats=('jpeg', 'webp'), source='logo.jpg')
+        self.assertEqual(len(paths), 4)
+        for (size, format_), path in paths.items():
+            self.assertTrue(os.path.basename(path).startswith('logo-'))
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (size, size // 2))
+                self.assertEqual(image.format, format_.upper())
+        paths = thumbnail.generate(data, directory, [300], crop=True,
+            source='logo.jpg')
+        with Image.open(paths[(300, 'jpeg')]) as image:
+            self.assertEqual(image.size, (300, 300))
+        self.assertIsNone(
+            thumbnail.generate(b'image', directory, [300], source='a.jpg'))
+        # Decompression bombs are not images
+        with patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            self.assertIsNone(thumbnail.generate(data, directory, [100]))
+        # The other formats saved by PIL are still created by thumbly
+        self.assertTrue(
+            thumbly(directory, os.path.join(directory, 'logo.bmp'), data,
+                size=100))
+        with Image.open(os.path.join(directory, 'logo.bmp')) as image:
+            self.assertEqual((image.format, image.size), ('BMP', (100, 50)))
+        os.remove(os.path.join(directory, 'logo.bmp'))
+        self.assertFalse(
+            thumbly(directory, os.path.join(directory, 'logo.txt'), data))
+
+        self.assertEqual(
+            cache_manager.purge([directory], sources=['logo.png'])[0], 5)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_static_import_source(self):
+        'Test static import of a zip archive'
+        from trytond.modules.galatea.static_import import (import_source,
+            ImportLimitError)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('css/main.css', b'main')
+            archive.writestr('css/.hidden', b'hidden')
+            archive.writestr('../escape.txt', b'escape')
+        self.assertEqual(
+            import_source(buffer, lambda parts, file_: (parts, file_.read())),
+            [(['css', 'main.css'], b'main')])
+        with self.assertRaises(ImportLimitError):
+            import_source(buffer, lambda parts, file_: None, max_file_size=3)
+        with self.assertRaises(ImportLimitError):
+            import_source(buffer, lambda parts, file_: None, max_size=3)
+
+    def test_static_import_directory(self):
+        'Test static import of a directory skips the symbolic links'
+        from trytond.modules.galatea.static_import import import_source
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        secret = tempfile.NamedTemporaryFile()
+        self.addCleanup(secret.close)
+        os.makedirs(os.path.join(directory, 'css'))
+        with open(os.path.join(directory, 'css', 'main.css'), 'wb') as file_:
+            file_.write(b'main')
+        os.symlink(secret.name, os.path.join(directory, 'css', 'secret'))
+        os.symlink(os.path.dirname(secret.name),
+            os.path.join(directory, 'tmp'))
+        self.assertEqual(
+            import_source(directory,
+                lambda parts, file_: (parts, file_.read())),
+            [(['css', 'main.css'], b'main')])
+
+    def test_static_pipeline(self):
+        'Test static assets pipeline'
+        import gzip
+        from trytond.modules.galatea import static_pipeline
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        contents = {
+            'main.css': b'body{color:red}' * 100,
+            'tiny.css': b'p{}',
+            'logo.png': os.urandom(1024),
+            }
+        for name, content in contents.items():
+            with open(os.path.join(directory, name), 'wb') as file_:
+                file_.write(content)
+
+        static_pipeline.build_files(directory, dict.fromkeys(contents))
+        manifest = static_pipeline.read_manifest(directory)
+        self.assertEqual(sorted(manifest), sorted(contents))
+        for name, content in contents.items():
+            digest = hashlib.sha256(content).hexdigest()
+            entry = manifest[name]
+            self.assertEqual(entry['hash'], digest)
+            self.assertEqual(entry['fingerprint'],
+                static_pipeline.fingerprint_name(name, digest))
+            self.assertRegex(entry['fingerprint'],
+                r'^[a-z]+\.[0-9a-f]{12}\.[a-z]+$')
+            self.assertTrue(os.path.samefile(os.path.join(directory, name),
+                    os.path.join(directory, entry['fingerprint'])))
+
+        encodings = manifest['main.css']['encodings']
+        self.assertEqual(encodings[0], 'gzip')
+        for path in ['main.css.gz', manifest['main.css']['fingerprint']
+                + '.gz']:
+            with gzip.open(os.path.join(directory, path)) as file_:
+                self.assertEqual(file_.read(), contents['main.css'])
+        # Small and incompressible files are not compressed
+        for name in ['tiny.css', 'logo.png']:
+            self.assertEqual(manifest[name]['encodings'], [])
+            self.assertFalse(
+                os.path.exists(os.path.join(directory, name + '.gz')))
+            self.assertFalse(
+                os.path.exists(os.path.join(directory, name + '.br')))
+
+        # A new version replaces the fingerprinted link
+        old = manifest['tiny.css']['fingerprint']
+        with open(os.path.join(directory, 'tiny.css'), 'wb') as file_:
+            file_.write(b'h1{}')
+        static_pipeline.build_files(directory, {'tiny.css': None})
+        manifest = static_pipeline.read_manifest(directory)
+        self.assertFalse(os.path.exists(os.path.join(directory, old)))
+        self.assertEqual(manifest['tiny.css']['hash'],
+            hashlib.sha256(b'h1{}').hexdigest())
+
+    def test_static_layout(self):
+        'Test sharded static layout migration'
+        from trytond.modules.galatea import static_layout
+
+        self.assertEqual(static_layout.relative_path('logo.png', 'flat'),
+            'logo.png')
+        path = static_layout.relative_path('logo.png', 'sharded')
+        self.assertRegex(path, r'^[0-9a-f]{2}/[0-9a-f]{2}/logo\.png$')
+        self.assertEqual(
+            static_layout.relative_path('logo.0123456789ab.png.gz',
+                'sharded'),
+            os.path.join(os.path.dirname(path), 'logo.0123456789ab.png.gz'))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'logo.png'), 'wb') as file_:
+            file_.write(b'logo')
+        self.assertEqual(static_layout.link_files(directory, 'sharded'), 1)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'logo.png')))
+        self.assertEqual(static_layout.get_layout(directory), 'flat')
+        # Not before the migration is committed
+        self.assertEqual(static_layout.remove_stale(directory, 'sharded'), 0)
+        static_layout.set_layout(directory, 'sharded')
+        self.assertEqual(static_layout.remove_stale(directory, 'sharded'), 1)
+        with open(os.path.join(directory, path), 'rb') as file_:
+            self.assertEqual(file_.read(), b'logo')
+
+        # Rolled back migration to the flat layout
+        static_layout.link_files(directory, 'flat')
+        self.assertEqual(static_layout.remove_stale(directory, 'sharded'), 1)
+        self.assertEqual(sorted(os.listdir(directory)), ['.sharded', path[:2]])
+
+    def test_iter_zip(self):
+        'Test streamed zip archive'
+        from trytond.modules.galatea.zip_stream import iter_zip
+
+        content = os.urandom(300 * 1024)
+        chunks = list(iter_zip([
+                    ('invoice/a.txt', None, 3, [b'abc']),
+                    ('invoice/b.pdf', None, None,
+                        [content[i:i + 65536]
+                            for i in range(0, len(content), 65536)]),
+                    ]))
+        self.assertGreater(len(chunks), 2)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('invoice/a.txt'), b'abc')
+            self.assertEqual(archive.read('invoice/b.pdf'), content)
+
+    def test_sitemap(self):
+        'Test sitemap urlset'
+        from trytond.modules.galatea.sitemap import iter_chunks, iter_urlset
+
+        self.assertEqual(list(iter_chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+        data = b''.join(iter_urlset([
+                    ('http://a/es/?p=1&q=2', '2026-01-02T03:04:05+00:00',
+                        [('es', 'http://a/es/'), ('en', 'http://a/en/')]),
+                    ]))
+        self.assertIn(b'<loc>http://a/es/?p=1&amp;q=2</loc>', data)
+        self.assertIn(b'<lastmod>2026-01-02T03:04:05+00:00</lastmod>', data)
+        self.assertIn(b'hreflang="en" href="http://a/en/"', data)
+        self.assertTrue(data.endswith(b'</urlset>\n'))
+
+    def test_sitemap_generate(self):
+        'Test incremental sitemap generation'
+        from trytond.modules.galatea import sitemap
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        keys = [(i, datetime.datetime(2026, 1, 1))
+            for i in [1, 3, 4, 5, 6, 7]]
+        rendered = []
+
+        def render(first, last):
+            rendered.append((first, last))
+            return [('http://a/%s' % i, None, [])
+                for i, _ in keys if first <= i <= last]
+
+        def generate():
+            del rendered[:]
+            return sitemap.generate(directory, [('sitemap-a', keys, render)],
+                ('http://a', ['es']), 2, lambda n: 'http://a/' + n)
+
+        self.assertEqual(generate(), (4, 4))
+        self.assertEqual(rendered, [(0, 1), (2, 3), (4, 5), (6, 7)])
+        mtimes = {n: os.stat(os.path.join(directory, n)).st_mtime_ns
+            for n in os.listdir(directory)}
+
+        self.assertEqual(generate(), (0, 4))
+        self.assertEqual(rendered, [])
+        self.assertEqual(mtimes, {
+                n: os.stat(os.path.join(directory, n)).st_mtime_ns
+                for n in os.listdir(directory)})
+
+        # A record inserted near the start changes only its shard
+        keys.insert(1, (2, datetime.datetime(2026, 2, 1)))
+        self.assertEqual(generate(), (1, 4))
+        self.assertEqual(rendered, [(2, 3)])
+        for name in ['sitemap-a-0-1.xml', 'sitemap-a-4-5.xml',
+                'sitemap-a-6-7.xml']:
+            self.assertEqual(
+                os.stat(os.path.join(directory, name)).st_mtime_ns,
+                mtimes[name])
+        with open(os.path.join(directory, 'sitemap-a-2-3.xml'), 'rb') as file_:
+            self.assertIn(b'<loc>http://a/2</loc>', file_.read())
+
+        del keys[-2:]
+        self.assertEqual(generate(), (0, 3))
+        self.assertFalse(
+            os.path.exists(os.path.join(directory, 'sitemap-a-6-7.xml')))
+        with open(os.path.join(directory, sitemap.INDEX), 'rb') as file_:
+            index = file_.read()
+        self.assertIn(b'<loc>http://a/sitemap-a-2-3.xml</loc>'
+            b'<lastmod>2026-02-01T00:00:00+00:00</lastmod>', index)
+        self.assertNotIn(b'sitemap-a-6-7.xml', index)
+
+    def test_static_server(self):
+        'Test static server responses'
+        from trytond.modules.galatea.static_server import StaticFiles, resolve
+
+        self.assertEqual(resolve('/galatea-static/css/main.css'),
+            ('css', 'main.css'))
+        for path in ['/galatea-static/css/.manifest.json',
+                '/galatea-static/../etc/passwd',
+                '/galatea-static/css/a/../../b', '/static/main.css']:
+            self.assertIsNone(resolve(path))
+
+        base_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_path)
+        os.makedirs(os.path.join(base_path, 'css'))
+        with open(os.path.join(base_path, 'css', 'main.css'), 'wb') as file_:
+            file_.write(b'body{}')
+        files = StaticFiles(base_path)
+        self.addCleanup(files.files.clear)
+        response = files.get('GET', '/galatea-static/css/main.css',
+            {'range': 'bytes=1-2'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(b''.join(response.iter_body()), b'od')
+        etag = dict(response.headers)['ETag']
+        response.close()
+        response = files.get('GET', '/galatea-static/css/main.css',
+            {'if-none-match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertIsNone(response.file)
+        response = files.get('GET', '/galatea-static/js/main.css', {})
+        self.assertEqual(response.status, 404)
+        self.assertEqual(list(files._layouts),
+            [os.path.join(base_path, 'css')])
+
+        for range_ in ['bytes=6-', 'bytes=-0']:
+            response = files.get('GET', '/galatea-static/css/main.css',
+                {'range': range_})
+            self.assertEqual(response.status, 416)
+            self.assertIn(('Content-Range', 'bytes */6'), response.headers)
+            self.assertIsNone(response.file)
+        response = files.get('GET', '/galatea-static/css/main.css',
+            {'range': 'bytes=4-1'})
+        self.assertEqual(response.status, 200)
+        response.close()
+
+    def test_remote_cache(self):
+        'Test remote cache revalidation'
+        from trytond.modules.galatea.remote_cache import RemoteCache
+
+        origin = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, origin)
+        with open(os.path.join(origin, 'logo.png'), 'wb') as file_:
+            file_.write(b'logo')
+        requests = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def send_response(self, code, message=None):
+                requests.append(code)
+                super().send_response(code, message)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0),
+            partial(Handler, directory=origin))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%s/logo.png' % server.server_address[1]
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = RemoteCache(directory, ttl=60)
+        path = cache.get(url)
+        with open(path, 'rb') as file_:
+            self.assertEqual(file_.read(), b'logo')
+        self.assertEqual(cache.get(url), path)
+        self.assertEqual(requests, [200])
+
+        cache.ttl = 0
+        self.assertEqual(cache.get(url), path)
+        self.assertEqual(requests, [200, 304])
+
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(cache.get(url), path)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -21,4 +1060,9 @@ def suite():
             tearDown=doctest_teardown, encoding='utf-8',
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
             checker=doctest_checker))
+    suite.addTests(doctest.DocFileSuite(
+            'scenario_galatea_party_attachment.rst',
+            tearDown=doctest_teardown, encoding='utf-8',
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE,
+            checker=doctest_checker))
     return suite
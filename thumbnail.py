@@ -0,0 +1,139 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import io
+import os
+import tempfile
+
+__all__ = ['thumbnail_name', 'generate', 'generate_batch']
+
+# format: (PIL format, extension, save options)
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True,
+            'progressive': True}),
+    'png': ('PNG', 'png', {'optimize': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'gif': ('GIF', 'gif', {}),
+    }
+
+
+def _get_format(format_):
+    "Return the (PIL format, extension, save options) of format_"
+    if format_ in FORMATS:
+        return FORMATS[format_]
+    # The other formats are saved by PIL from their extension
+    return (None, format_, {})
+
+
+def thumbnail_name(key, size, format_, crop=False):
+    "Return the file name of a derivative of the image with key (digest)"
+    return '%s-%s%s.%s' % (key, size, 'c' if crop else '',
+        _get_format(format_)[1])
+
+
+def _crop_square(image):
+    width, height = image.size
+    if width > height:
+        left = (width - height) // 2
+        return image.crop((left, 0, left + height, height))
+    upper = (height - width) // 2
+    return image.crop((0, upper, width, upper + width))
+
+
+def _save(image, path, format_):
+    from PIL import Image
+    pil_format, extension, options = _get_format(format_)
+    if pil_format is None:
+        pil_format = Image.registered_extensions()['.' + extension]
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.thumb-')
+    try:
+        with os.fdopen(fd, 'wb') as file_:
+            image.save(file_, pil_format, **options)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def generate(data, directory, sizes, formats=('jpeg',), crop=False,
+        key=None, source=None):
+    '''
+    Create the derivatives of an image for each size and format.
+
+    The image is decoded once, JPEG images are decoded at the smallest
+    scale that fits the biggest size and each size is resized from the
+    previous one. The derivatives are named by the SHA-256 of data so
+    existing ones are never generated again, after the name of source so
+    cache_manager.purge removes them by source.
+
+    :param data: the image bytes
+    :param directory: the directory where the derivatives are written
+    :param sizes: the list of maximum width/height
+    :param formats: the list of formats (jpeg, png, webp, gif or the
+        extension of another format saved by PIL)
+    :param crop: crop the image to a square
+    :param key: the name prefix of the derivatives instead of the SHA-256
+    :param source: the file name of the image
+    :return: a dictionary {(size, format): path} or None if data is not an
+        image
+    '''
+    if key is None:
+        key = hashlib.sha256(data).hexdigest()
+        if source:
+            key = '%s-%s' % (
+                os.path.splitext(os.path.basename(source))[0], key[:16])
+    paths = {(size, format_): os.path.join(directory,
+            thumbnail_name(key, size, format_, crop))
+        for size in sizes for format_ in formats}
+    missing = {k for k, path in paths.items() if not os.path.exists(path)}
+    if not missing:
+        return paths
+
+    from PIL import Image
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o775, exist_ok=True)
+    try:
+        image = Image.open(io.BytesIO(data))
+        max_size = max(size for size, _ in missing)
+        # draft keeps both sides bigger than the requested size
+        image.draft('RGB', (max_size, max_size))
+        image.load()
+    except (IOError, SyntaxError, ValueError,
+            Image.DecompressionBombError):
+        return
+
+    if crop:
+        image = _crop_square(image)
+    for size in sorted({size for size, _ in missing}, reverse=True):
+        image = image.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        for format_ in formats:
+            if (size, format_) in missing:
+                _save(image, paths[(size, format_)], format_)
+    return paths
+
+
+def _generate_job(job):
+    return generate(**job)
+
+
+def generate_batch(jobs, workers=None):
+    '''
+    Run generate for each job in a process pool.
+
+    :param jobs: a list of dictionaries with the generate arguments
+    :param workers: the number of processes, the number of CPUs by default
+    :return: the list of generate results
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_generate_job, jobs,
+                chunksize=max(1, len(jobs) // ((workers or os.cpu_count()
+                            or 1) * 4))))
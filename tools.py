@@ -1,29 +1,72 @@
 # This file is part galatea module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from PIL import Image
-import logging
+from functools import lru_cache
+import hashlib
 import os
-
-try:
-    import slug
-except ImportError:
-    logger = logging.getLogger(__name__)
-    logger.error('Unable to import slug. Install slug package.')
+import re
+import unicodedata
+import uuid
 
 IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/gif']
 
+# Letters that NFKD normalization does not decompose into ASCII
+_TRANSLITERATION = str.maketrans({
+        'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE',
+        'ø': 'o', 'Ø': 'O', 'đ': 'd', 'Đ': 'D', 'ð': 'd', 'Ð': 'D',
+        'ł': 'l', 'Ł': 'L', 'þ': 'th', 'Þ': 'TH', 'ħ': 'h', 'Ħ': 'H',
+        'ı': 'i', 'ŀ': 'l', 'Ŀ': 'L',
+        })
+_NOT_SLUG = re.compile(r'[^a-z0-9]+')
+
+
+def _slug(value):
+    value = unicodedata.normalize('NFKD', value.translate(_TRANSLITERATION))
+    value = value.encode('ascii', 'ignore').decode('ascii').lower()
+    return _NOT_SLUG.sub('-', value).strip('-')
+
 
+def _short_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:8]
+
+
+@lru_cache(maxsize=8192)
 def slugify(value):
-    """Convert value to slug: az09 and replace spaces by -"""
-    if not slug:
-        name = ''
+    """Convert value to slug: az09 and replace spaces by -
+    The letters of the non latin scripts are transliterated with unidecode
+    when it is installed, else the slug is a short hash of value"""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    slug = _slug(value)
+    if not slug and any(c.isalnum() for c in value):
+        try:
+            from unidecode import unidecode
+        except ImportError:
+            pass
+        else:
+            slug = _slug(unidecode(value))
+        slug = slug or _short_hash(value)
+    return slug
+
+
+@lru_cache(maxsize=None)
+def timezones():
+    """Return the selection of the timezone names, computed on first use
+    from zoneinfo (pytz on Python < 3.9 or without any timezone database)"""
+    try:
+        from zoneinfo import available_timezones
+    except ImportError:
+        names = None
     else:
-        if isinstance(value, unicode):
-            name = slug.slug(value)
+        names = available_timezones() - {'Factory', 'localtime', 'posixrules'}
+    if not names:
+        try:
+            import pytz
+        except ImportError:
+            names = ['UTC']
         else:
-            name = slug.slug(unicode(value, 'UTF-8'))
-    return name
+            names = pytz.common_timezones
+    return [(x, x) for x in sorted(names)]
 
 
 def seo_lenght(string):
@@ -33,61 +76,120 @@ def seo_lenght(string):
     return string
 
 
+@lru_cache(maxsize=8192)
 def slugify_file(value):
-    """Convert attachment name to slug: az09 and replace spaces by -"""
-    if not slug:
-        return value
-    fname = value.lower().split('.')
-    fn = fname[0]
-    if isinstance(fn, unicode):
-        name = slug.slug(fn)
-    else:
-        name = slug.slug(unicode(fn, 'UTF-8'))
+    """Convert attachment name to slug: az09 and replace spaces by -
+    Each part between dots is slugified, so all the extensions are kept
+    (archive.tar.gz). A short hash of value is the name when nothing is
+    left of it (!!.png)"""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    parts = value.split('.')
+    slugs = [slugify(p) for p in parts]
+    stem = slugs[:-1] if len(parts) > 1 and parts[0] else slugs
+    if not any(stem):
+        slugs.insert(0, _short_hash(value))
+    return '.'.join(filter(None, slugs))
+
+
+def slugify_many(values):
+    """Slugify a list of values (bulk imports), each distinct value is
+    slugified once"""
+    slugs = {v: slugify(v) for v in set(values)}
+    return [slugs[v] for v in values]
+
+
+def slugify_files(values):
+    """Slugify a list of file names (bulk imports), each distinct name is
+    slugified once"""
+    slugs = {v: slugify_file(v) for v in set(values)}
+    return [slugs[v] for v in values]
 
-    if len(fname) > 1:
-        return '%s.%s' % (name, fname[1])
-    else:
-        return name
+
+def unique_file_slug(name, names):
+    """Return the file slug name or name-2, name-3... (before the extensions)
+    which is not in names and add it to names"""
+    stem, dot, extensions = name.partition('.')
+    unique, i = name, 1
+    while unique in names:
+        i += 1
+        unique = '%s-%s%s%s' % (stem, i, dot, extensions)
+    names.add(unique)
+    return unique
+
+
+def _parse_range_spec(header):
+    "Return the (first, last) positions of a single range or None"
+    if not header or not header.startswith('bytes='):
+        return
+    spec = header[6:].strip()
+    if ',' in spec or '-' not in spec:
+        # Multiple ranges are not supported
+        return
+    first, last = (p.strip() for p in spec.split('-', 1))
+    if (not first and not last) or not all(
+            p.isdigit() for p in (first, last) if p):
+        return
+    first = int(first) if first else None
+    last = int(last) if last else None
+    if first is not None and last is not None and first > last:
+        return
+    return first, last
+
+
+def parse_range(header, size):
+    '''Parse a single HTTP Range header value
+    :param header: the Range header value (like "bytes=0-499")
+    :param size: the size of the content
+    :return: a tuple (first, last) of inclusive byte positions or None when
+        the header is missing, invalid or not satisfiable
+    '''
+    spec = _parse_range_spec(header)
+    if spec is None or not size:
+        return
+    first, last = spec
+    if first is None:
+        if last <= 0:
+            return
+        return max(size - last, 0), size - 1
+    if first >= size:
+        return
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def range_not_satisfiable(header, size):
+    '''Return True if the Range header value is a valid single range which
+    is not satisfiable by a content of size (416 response)
+    '''
+    spec = _parse_range_spec(header)
+    return spec is not None and parse_range(header, size) is None
 
 
 def thumbly(directory, filename, data, size=300, crop=False):
-    '''Create thumbnail image
+    '''Create thumbnail image with the thumbnail engine. New code should
+    use thumbnail.generate, which names and caches the derivatives.
     :param directory: directory name
-    :param filename: file name
+    :param filename: file name, its extension is the image format
     :param data: data image
     :param size: size to thumb
     :param crop: crop thumb image
+    :return: True if the thumbnail is created
     '''
+    from PIL import Image
+    from . import thumbnail
+    extension = os.path.splitext(filename)[1][1:].lower()
+    format_ = {'jpg': 'jpeg'}.get(extension, extension)
+    if (format_ not in thumbnail.FORMATS
+            and '.' + extension not in Image.registered_extensions()):
+        return False
+    os.umask(0o022)
     if not os.path.isdir(directory):
         os.makedirs(directory, 0o775)
-    os.umask(0o022)
-    with open(filename, 'wb') as file_p:
-        file_p.write(data)
-
-    # square and thumbnail thumb image
-    thumb_size = size, size
-    try:
-        im = Image.open(filename)
-    except:
-        if os.path.exists(filename):
-            os.remove(filename)
+    # Generated next to filename so it is moved in place
+    paths = thumbnail.generate(data,
+        os.path.dirname(os.path.abspath(filename)), [size],
+        formats=(format_,), crop=crop, key='.thumbly-%s' % uuid.uuid4().hex)
+    if not paths:
         return False
-
-    if crop:
-        width, height = im.size
-        if width > height:
-            delta = width - height
-            left = int(delta / 2)
-            upper = 0
-            right = height + left
-            lower = height
-        else:
-            delta = height - width
-            left = 0
-            upper = int(delta / 2)
-            right = width
-            lower = width + upper
-        im = im.crop((left, upper, right, lower))
-    im.thumbnail(thumb_size, Image.ANTIALIAS)
-    im.save(filename)
+    os.replace(paths[(size, format_)], filename)
     return True
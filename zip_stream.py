@@ -0,0 +1,83 @@
+# This file is part galatea module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import os
+import time
+import zipfile
+
+__all__ = ['iter_zip', 'unique_name']
+
+# Extensions of compressed formats which are stored without deflate
+STORED_EXTENSIONS = {
+    '.7z', '.avif', '.br', '.bz2', '.docx', '.gif', '.gz', '.jpeg', '.jpg',
+    '.mp3', '.mp4', '.odp', '.ods', '.odt', '.pdf', '.png', '.pptx',
+    '.webp', '.xlsx', '.xz', '.zip',
+    }
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class _Buffer(object):
+    "Unseekable file object collecting the bytes written by ZipFile"
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def unique_name(name, names):
+    "Return name or name (n) which is not in names and add it to names"
+    stem, ext = os.path.splitext(name)
+    unique, i = name, 1
+    while unique in names:
+        i += 1
+        unique = '%s (%s)%s' % (stem, i, ext)
+    names.add(unique)
+    return unique
+
+
+def iter_zip(members, compresslevel=6):
+    '''
+    Yield the bytes of a zip archive of members as it is built.
+
+    The archive is never stored: only the chunks of the member being
+    written are kept in memory, the sizes and CRC are written after each
+    member (data descriptor).
+
+    :param members: an iterable of (name, date, size or None, iterable of
+        bytes chunks), date is a datetime or None
+    '''
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED,
+            compresslevel=compresslevel) as archive:
+        for name, date, size, chunks in members:
+            info = zipfile.ZipInfo(name,
+                date.timetuple()[:6] if date else time.localtime()[:6])
+            info.external_attr = 0o644 << 16
+            if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            force_zip64 = size is None or size > ZIP64_LIMIT
+            with archive.open(info, 'w', force_zip64=force_zip64) as dest:
+                for chunk in chunks:
+                    dest.write(chunk)
+                    data = buffer.pop()
+                    if data:
+                        yield data
+            data = buffer.pop()
+            if data:
+                yield data
+    data = buffer.pop()
+    if data:
+        yield data